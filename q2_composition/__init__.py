@@ -13,9 +13,10 @@ from ._format import (FrictionlessCSVFileFormat,
                       DataLoafPackageDirFmt)
 from ._type import DifferentialAbundance
 
-from ._impute import add_pseudocount
-from ._ancom import ancom
-from ._ancombc import ancombc
+from ._impute import (add_pseudocount, add_scaled_pseudocount,
+                      multiplicative_replacement)
+from ._ancom import ancom, ancom_multiple
+from ._ancombc import ancombc, ancombc_batch
 from ._dataloaf_tabulate import tabulate
 from ._diff_abundance_plots import da_barplot
 
@@ -24,4 +25,6 @@ del get_versions
 
 __all__ = ['FrictionlessCSVFileFormat', 'DataPackageSchemaFileFormat',
            'DataLoafPackageDirFmt', 'DifferentialAbundance', 'add_pseudocount',
-           'ancom', 'ancombc', 'tabulate', 'da_barplot']
+           'add_scaled_pseudocount', 'multiplicative_replacement', 'ancom',
+           'ancom_multiple', 'ancombc', 'ancombc_batch', 'tabulate',
+           'da_barplot']
@@ -6,26 +6,55 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import functools
 import json
+import math
 import os
 import pkg_resources
-from distutils.dir_util import copy_tree
+import shutil
 
+import biom
 import qiime2
 import q2templates
+import numpy as np
 import pandas as pd
-from skbio.stats.composition import ancom as skbio_ancom
-from skbio.stats.composition import clr
 
-from numpy import log, sqrt
-from scipy.stats import f_oneway
+from ._ancom_stats import (ancom_tests, percentile_abundances, group_means,
+                           f_statistic, _BLOCK_ENTRIES)
+from ._cache import ResultCache, content_key, table_key
 
-_difference_functions = {'mean_difference': lambda x, y: x.mean() - y.mean(),
-                         'f_statistic': f_oneway}
 
-_transform_functions = {'sqrt': sqrt,
-                        'log': log,
-                        'clr': clr}
+def _mean_difference(matrix, labels):
+    if labels.max() != 1:
+        raise ValueError('The mean difference can only be computed between '
+                         'two groups. Use the f_statistic difference '
+                         'function with more than two groups.')
+    means = group_means(matrix, labels)
+    return means[0] - means[1]
+
+
+# Each takes a (samples x features) array and the group index of each
+# sample, and computes the difference for all features at once.
+_difference_functions = {'mean_difference': _mean_difference,
+                         'f_statistic': f_statistic}
+
+
+def _clr(matrix, out=None, log_means=None):
+    # the closure applied by skbio's clr cancels out once the log abundances
+    # are centered, so it is skipped here. log_means are the samples' mean log
+    # abundances over all of the features, if matrix is a block of them.
+    out = np.log(matrix, out=out)
+    if log_means is None:
+        log_means = out.mean(axis=1)
+    out -= log_means[:, None]
+    return out
+
+
+# Each transforms a (samples x features) array as a whole, writing the result
+# to out if it is provided.
+_transform_functions = {'sqrt': np.sqrt,
+                        'log': np.log,
+                        'clr': _clr}
 
 TEMPLATES = pkg_resources.resource_filename('q2_composition', 'assets')
 
@@ -38,18 +67,54 @@ def transform_functions():
     return list(_transform_functions.keys())
 
 
+def _bytes(megabytes):
+    """A memory budget given in megabytes (as by the user), in bytes"""
+    if megabytes is None:
+        return None
+    return megabytes * 2 ** 20
+
+
+def _transform(matrix, transform_function, inplace=False):
+    """Apply one of the named transforms to a (samples x features) array
+
+    If inplace, matrix (which must be of a floating point dtype) is
+    overwritten rather than a transformed copy being allocated.
+    """
+    transform_function = _transform_functions[transform_function]
+    if inplace:
+        if not np.issubdtype(matrix.dtype, np.floating):
+            raise ValueError('Only floating point values can be transformed '
+                             'in place.')
+        return transform_function(matrix, out=matrix)
+    return transform_function(matrix.astype(np.float64))
+
+
 def ancom(output_dir: str,
-          table: pd.DataFrame,
+          table: biom.Table,
           metadata: qiime2.CategoricalMetadataColumn,
           transform_function: str = 'clr',
           difference_function: str = None,
-          filter_missing: bool = False) -> None:
-    metadata = metadata.filter_ids(table.index)
+          filter_missing: bool = False,
+          significance_test: str = 'f_oneway',
+          pseudocount: float = None,
+          memory_budget: int = None,
+          n_jobs: int = 1,
+          permutations: int = 999,
+          seed: int = None,
+          adaptive: bool = False,
+          compact_volcano: bool = False,
+          paged_tables: bool = False,
+          volcano_max_points: int = None,
+          binary_format: str = None,
+          link_assets: bool = False,
+          rejected_abundances_only: bool = False) -> None:
+    metadata = metadata.filter_ids(table.ids())
     if metadata.has_missing_values():
         missing_data_sids = metadata.get_ids(where_values_missing=True)
         if filter_missing:
             metadata = metadata.to_series().drop(missing_data_sids)
-            table = table.drop(index=missing_data_sids)
+            table = table.filter(metadata.index, axis='sample',
+                                 inplace=False)
             missing_data_sids = ', '.join(sorted(missing_data_sids))
         else:
             raise ValueError(f'Metadata column {metadata.name} is missing '
@@ -59,45 +124,404 @@ def ancom(output_dir: str,
     else:
         metadata = metadata.to_series()
 
-    ancom_results = skbio_ancom(table,
-                                metadata,
-                                significance_test=f_oneway)
-    ancom_results[0].sort_values(by='W', ascending=False, inplace=True)
-    ancom_results[0].rename(columns={'reject': 'Reject null hypothesis'},
-                            inplace=True)
-    significant_features = ancom_results[0][
-        ancom_results[0]['Reject null hypothesis']]
+    ancom_results, = _ancom_statistics(
+        table, metadata.to_frame(), significance_test=significance_test,
+        pseudocount=pseudocount, memory_budget=_bytes(memory_budget),
+        n_jobs=n_jobs, permutations=permutations, seed=seed,
+        adaptive=adaptive,
+        rejected_only=rejected_abundances_only).values()
+    fold_change, = _fold_changes(
+        table, transform_function,
+        [_volcano_grouping(metadata, table.ids(), difference_function)],
+        pseudocount=pseudocount)
+    _visualize_ancom(output_dir, ancom_results, fold_change,
+                     transform_function, compact_volcano=compact_volcano,
+                     paged_tables=paged_tables,
+                     volcano_max_points=volcano_max_points,
+                     binary_format=binary_format, link_assets=link_assets)
 
-    context = dict()
-    if not significant_features.empty:
-        context['significant_features'] = q2templates.df_to_html(
-            significant_features['W'].to_frame())
-        context['percent_abundances'] = q2templates.df_to_html(
-            ancom_results[1].loc[significant_features.index])
 
-    cats = list(set(metadata))
-    transform_function_name = transform_function
-    transform_function = _transform_functions[transform_function]
-    transformed_table = table.apply(
-        transform_function, axis=1, result_type='broadcast')
+def ancom_multiple(output_dir: str,
+                   table: biom.Table,
+                   metadata: qiime2.Metadata,
+                   transform_function: str = 'clr',
+                   difference_function: str = None,
+                   filter_missing: bool = False,
+                   significance_test: str = 'f_oneway',
+                   pseudocount: float = None,
+                   memory_budget: int = None,
+                   n_jobs: int = 1,
+                   permutations: int = 999,
+                   seed: int = None,
+                   adaptive: bool = False,
+                   compact_volcano: bool = False,
+                   paged_tables: bool = False,
+                   volcano_max_points: int = None,
+                   binary_format: str = None,
+                   link_assets: bool = False,
+                   rejected_abundances_only: bool = False) -> None:
+    metadata = metadata.filter_ids(table.ids())
+    metadata = metadata.filter_columns(column_type='categorical')
+    if metadata.column_count == 0:
+        raise ValueError('Metadata does not contain any categorical columns '
+                         'to test for differential abundance across.')
+    metadata = metadata.to_dataframe()
+
+    # all of the columns are tested on the same samples, so that the work
+    # that doesn't depend on the grouping can be shared between them
+    missing = metadata.isnull()
+    if missing.values.any():
+        if filter_missing:
+            keep = ~missing.any(axis=1)
+            metadata = metadata[keep]
+            table = table.filter(metadata.index, axis='sample',
+                                 inplace=False)
+        else:
+            column = missing.any()[missing.any()].index[0]
+            missing_data_sids = metadata.index[missing[column]]
+            raise ValueError(f'Metadata column {column} is missing '
+                             f'values for samples '
+                             f'{", ".join(sorted(missing_data_sids))}')
+
+    results = _ancom_statistics(
+        table, metadata, significance_test=significance_test,
+        pseudocount=pseudocount, memory_budget=_bytes(memory_budget),
+        n_jobs=n_jobs, permutations=permutations, seed=seed,
+        adaptive=adaptive, rejected_only=rejected_abundances_only)
+    # the table is transformed once, for the volcano plots of all columns
+    fold_changes = _fold_changes(
+        table, transform_function,
+        [_volcano_grouping(metadata[column], table.ids(),
+                           difference_function)
+         for column in results],
+        pseudocount=pseudocount)
+
+    columns = []
+    for i, (column, ancom_results) in enumerate(results.items(), start=1):
+        # column names may not be valid file names, so each column's results
+        # are written to a numbered directory
+        column_dir = 'column-%d' % i
+        os.mkdir(os.path.join(output_dir, column_dir))
+        result = ancom_results[0]
+        _visualize_ancom(os.path.join(output_dir, column_dir), ancom_results,
+                         fold_changes[i - 1], transform_function,
+                         compact_volcano=compact_volcano,
+                         paged_tables=paged_tables,
+                         volcano_max_points=volcano_max_points,
+                         binary_format=binary_format,
+                         link_assets=link_assets)
+        columns.append({'name': column, 'url': '%s/index.html' % column_dir,
+                        'n_significant':
+                            int(result['Reject null hypothesis'].sum())})
+
+    index = os.path.join(TEMPLATES, 'ancom_multiple', 'index.html')
+    q2templates.render(index, output_dir, context={'columns': columns})
+
+
+def _ancom_statistics(table, groupings, significance_test='f_oneway',
+                      pseudocount=None, memory_budget=None, n_jobs=1,
+                      permutations=999, seed=None, adaptive=False,
+                      rejected_only=False):
+    """The ANCOM results and percentile abundances of each grouping
+
+    Returns a dict of (``ancom_test`` result, ``percentile_abundances``) pairs,
+    keyed by column of groupings; if rejected_only, the percentiles are only of
+    the rejected features (the ones the visualization shows), which skips most
+    of the table. If a cache is configured (see
+    ``ResultCache.from_environment``), each grouping's pair is looked up by the
+    contents of the table and of the grouping, and by the parameters that
+    affect it. Re-running with different visualization parameters then skips
+    the statistics, and only the groupings that missed the cache are computed
+    (together, as by ``ancom_tests``). Results that depend on an unseeded
+    random number generator aren't cached.
+    """
+    params = (significance_test, pseudocount, adaptive, rejected_only)
+    if significance_test == 'permutation':
+        params += (permutations, seed)
+    if adaptive:
+        # the blocks of features that are decided together depend on the
+        # tile size
+        params += (seed, memory_budget, n_jobs)
+    random = seed is None and (adaptive or significance_test == 'permutation')
+
+    cache = None if random else ResultCache.from_environment()
+    feature_ids = table.ids(axis='observation')
+    keys = {}
+    results = {}
+    if cache is not None:
+        digest = table_key(table)
+        for column in groupings:
+            grouping = groupings[column].reindex(table.ids())
+            keys[column] = content_key(
+                'ancom', _CACHE_VERSION, digest,
+                tuple(str(group) for group in grouping), params)
+            entry = cache.get(keys[column])
+            if entry is not None:
+                results[column] = _from_arrays(entry, feature_ids)
+
+    missing = [column for column in groupings if column not in results]
+    if missing:
+        computed = ancom_tests(table, groupings[missing],
+                               significance_test=significance_test,
+                               pseudocount=pseudocount,
+                               memory_budget=memory_budget, n_jobs=n_jobs,
+                               permutations=permutations, seed=seed,
+                               adaptive=adaptive)
+        for column in missing:
+            results[column] = (
+                computed[column],
+                percentile_abundances(
+                    table, groupings[column], pseudocount=pseudocount,
+                    features=(computed[column]['Reject null hypothesis']
+                              if rejected_only else None)))
+            if cache is not None:
+                cache.put(keys[column], _to_arrays(*results[column]))
+    return {column: results[column] for column in groupings}
+
+
+# Changing the layout of cached results invalidates earlier cache entries.
+_CACHE_VERSION = 3
+
+
+def _to_arrays(ancom_result, percentiles):
+    arrays = {'W': ancom_result['W'].values,
+              'reject': ancom_result['Reject null hypothesis'].values,
+              'percentiles': percentiles.values,
+              'percentile': percentiles.columns.get_level_values(
+                  'Percentile').values.astype(np.float64),
+              'group': percentiles.columns.get_level_values(
+                  'Group').values.astype(str),
+              # the features whose percentiles were computed
+              'features': ancom_result.index.isin(percentiles.index)}
+    if 'Decided early' in ancom_result:
+        arrays['decided'] = ancom_result['Decided early'].values
+    return arrays
+
+
+def _from_arrays(arrays, feature_ids):
+    result = {'W': arrays['W'], 'Reject null hypothesis': arrays['reject']}
+    if 'decided' in arrays:
+        result['Decided early'] = arrays['decided']
+    columns = pd.MultiIndex.from_arrays(
+        [arrays['percentile'], arrays['group']],
+        names=['Percentile', 'Group'])
+    return (pd.DataFrame(result, index=pd.Index(feature_ids)),
+            pd.DataFrame(arrays['percentiles'], columns=columns,
+                         index=pd.Index(feature_ids)[arrays['features']]))
+
 
+def _volcano_grouping(metadata, sample_ids, difference_function=None):
+    """The group labels and difference function of a volcano plot"""
+    cats = list(set(metadata))
     if difference_function is None:
         if len(cats) == 2:
             difference_function = 'mean_difference'
         else:  # len(categories) > 2
             difference_function = 'f_statistic'
 
-    _d_func = _difference_functions[difference_function]
+    # groups are indexed in the order of cats, so that the mean difference
+    # is taken in the same direction as the categories are listed
+    labels = pd.Categorical(metadata.reindex(sample_ids),
+                            categories=cats).codes
+    return labels, _difference_functions[difference_function]
+
+
+def _fold_changes(table, transform_function, groupings, pseudocount=None):
+    """Compute the volcano plot differences of several groupings at once
+
+    groupings is a list of (labels, difference function) pairs, as returned
+    by ``_volcano_grouping``. The table is densified (and the pseudocount
+    added) a block of features at a time, and each block is transformed in
+    place. The clr transform centers each sample on its mean log abundance
+    over all features, which is computed by a first pass over the blocks.
+    """
+    matrix = table.matrix_data.T.tocsc()
+    n_samples, n_features = matrix.shape
+    block_size = max(1, _BLOCK_ENTRIES // max(1, n_samples))
+    blocks = [slice(start, start + block_size)
+              for start in range(0, n_features, block_size)]
+
+    def densify(cols):
+        block = matrix[:, cols].toarray().astype(np.float64, copy=False)
+        if pseudocount is not None:
+            block += pseudocount
+        return block
+
+    if transform_function == 'clr':
+        log_means = sum(np.log(densify(cols)).sum(axis=1)
+                        for cols in blocks) / n_features
+
+    fold_changes = [np.empty(n_features) for _ in groupings]
+    for cols in blocks:
+        block = densify(cols)
+        if transform_function == 'clr':
+            _clr(block, out=block, log_means=log_means)
+        else:
+            _transform(block, transform_function, inplace=True)
+        for fold_change, (labels, d_func) in zip(fold_changes, groupings):
+            fold_change[cols] = d_func(block, labels)
+
+    feature_ids = table.ids(axis='observation')
+    return [pd.Series(fold_change, index=feature_ids)
+            for fold_change in fold_changes]
+
+
+def _downsample_volcano(x, y, keep, max_points):
+    """Select at most max_points points of a volcano plot to draw
+
+    All of the points in keep (i.e., the significant features) are
+    selected, even if there are more than max_points of them. The others
+    are binned on a grid, and thinned by water-filling: each cell keeps up
+    to the same number of its points (chosen at random, but reproducibly),
+    which is the largest for which the total fits. Sparse regions, and
+    outliers in particular, are therefore fully drawn, and only dense
+    regions are thinned.
+
+    Returns a boolean mask of the selected points.
+    """
+    selected = keep.copy()
+    others = np.flatnonzero(~keep)
+    budget = max_points - keep.sum()
+    if len(others) <= budget:
+        selected[others] = True
+        return selected
+    if budget <= 0:
+        return selected
+
+    # there are at most as many cells as points to select, so that each
+    # cell keeps at least one
+    n_bins = max(1, math.isqrt(budget))
+    cells = np.zeros(len(others), dtype=np.int64)
+    for values in x[others], y[others]:
+        lo, hi = values.min(), values.max()
+        scale = n_bins / (hi - lo) if hi > lo else 0
+        bins = np.minimum(((values - lo) * scale).astype(np.int64),
+                          n_bins - 1)
+        cells = cells * n_bins + bins
+
+    counts = np.bincount(cells)
+    counts = counts[counts > 0]
+    # the largest per-cell quota whose total is within the budget (a quota
+    # of one always is)
+    lo, hi = 1, counts.max()
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if np.minimum(counts, mid).sum() <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    quota = lo
+
+    order = np.random.default_rng(0).permutation(len(others))
+    order = order[np.argsort(cells[order], kind='stable')]
+    starts = np.searchsorted(cells[order], cells[order], side='left')
+    ranks = np.arange(len(order)) - starts
+    selected[others[order[ranks < quota]]] = True
+    return selected
+
+
+def _write_table_json(df, path):
+    """Write a table as loaded by the page's pagedTable"""
+    table = json.loads(df.to_json(orient='split'))
+    table['names'] = list(df.columns.names)
+    with open(path, 'w') as fh:
+        json.dump(table, fh, separators=(',', ':'))
+
 
-    def diff_func(x):
-        args = _d_func(*[x[metadata == c] for c in cats])
-        if isinstance(args, tuple):
-            return args[0]
+def _install_assets(assets_dir, output_dir, link=False):
+    """Install a visualization's static assets (scripts, styles, etc.)
+
+    The assets are copied or, if link, hardlinked where possible, as they
+    are identical in every visualization. The template is skipped: it is
+    rendered into the output directory, and rendering into a hardlink would
+    overwrite the installed template.
+    """
+    shutil.copytree(assets_dir, output_dir,
+                    copy_function=functools.partial(_install_file, link=link),
+                    ignore=shutil.ignore_patterns('index.html'),
+                    dirs_exist_ok=True)
+
+
+def _install_file(src, dst, link=False):
+    if os.path.lexists(dst):
+        # never write through an existing (possibly hardlinked) file
+        os.remove(dst)
+    if link:
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            # e.g., the output directory is on another file system
+            pass
+    shutil.copy2(src, dst)
+    return dst
+
+
+def _write_binary_table(df, path, binary_format):
+    """Write a table as Parquet or Arrow IPC, alongside its TSV
+
+    The file extension (.parquet or .arrow) is added to path. Float columns
+    whose values are all exactly representable as float32 (e.g.,
+    percentiles of counts) are stored as such. The index, and the levels
+    of the percentile table's columns, are restored by
+    ``pandas.read_parquet`` and ``pandas.read_feather``.
+    """
+    # pyarrow is only needed for these files, so it's only imported when
+    # they're asked for
+    import pyarrow
+
+    downcast = {}
+    for column, dtype in df.dtypes.items():
+        if dtype == np.float64:
+            values = df[column].values
+            if np.array_equal(values.astype(np.float32), values,
+                              equal_nan=True):
+                downcast[column] = np.float32
+    table = pyarrow.Table.from_pandas(df.astype(downcast),
+                                      preserve_index=True)
+
+    if binary_format == 'parquet':
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(table, path + '.parquet')
+    else:
+        import pyarrow.feather
+        pyarrow.feather.write_feather(table, path + '.arrow')
+
+
+def _visualize_ancom(output_dir, ancom_results, fold_change,
+                     transform_function, compact_volcano=False,
+                     paged_tables=False, volcano_max_points=None,
+                     binary_format=None, link_assets=False):
+    # the tables that are written as TSV (and, optionally, binary) files
+    tables = {'ancom': ancom_results[0],
+              'percent-abundances': ancom_results[1]}
+    ancom_results[0].sort_values(by='W', ascending=False, inplace=True)
+    significant_features = ancom_results[0][
+        ancom_results[0]['Reject null hypothesis']]
+
+    context = dict()
+    if not significant_features.empty:
+        significant_table = significant_features['W'].to_frame()
+        percent_table = ancom_results[1].loc[significant_features.index]
+        if paged_tables:
+            # the tables are loaded by the page, and rendered a page of rows
+            # at a time
+            context['paged_tables'] = True
+            context['significant_features'] = 'significant-features.json'
+            _write_table_json(significant_table,
+                              os.path.join(output_dir,
+                                           'significant-features.json'))
+            context['percent_abundances'] = 'percent-abundances.json'
+            _write_table_json(percent_table,
+                              os.path.join(output_dir,
+                                           'percent-abundances.json'))
         else:
-            return args
+            context['significant_features'] = q2templates.df_to_html(
+                significant_table)
+            context['percent_abundances'] = q2templates.df_to_html(
+                percent_table)
 
-    # effectively doing a groupby operation wrt to the metadata
-    fold_change = transformed_table.apply(diff_func, axis=0)
+    transform_function_name = transform_function
     if not pd.isnull(fold_change).all():
         pre_filtered_ids = set(fold_change.index)
         with pd.option_context('mode.use_inf_as_na', True):
@@ -108,17 +532,37 @@ def ancom(output_dir: str,
         volcano_results = pd.DataFrame({transform_function_name: fold_change,
                                         'W': filtered_ancom_results.W})
         volcano_results.index.name = 'id'
-        volcano_results.to_csv(os.path.join(output_dir, 'data.tsv'),
-                               header=True, index=True, sep='\t')
-        volcano_results = volcano_results.reset_index(drop=False)
+        tables['data'] = volcano_results
+        if volcano_max_points is not None:
+            significant = filtered_ancom_results.loc[
+                volcano_results.index, 'Reject null hypothesis'].values
+            drawn = _downsample_volcano(
+                volcano_results[transform_function_name].values,
+                volcano_results['W'].values.astype(np.float64), significant,
+                volcano_max_points)
+            if not drawn.all():
+                context['volcano_downsampled'] = {
+                    'drawn': int(drawn.sum()), 'total': len(drawn)}
+                volcano_results = volcano_results[drawn]
+
+        if compact_volcano:
+            # the points are loaded by vega, rather than embedded in the
+            # page, as a table (which doesn't repeat the field names)
+            volcano_results.to_csv(os.path.join(output_dir, 'volcano.tsv'),
+                                   header=True, index=True, sep='\t')
+            values = {'url': 'volcano.tsv',
+                      'format': {'type': 'tsv',
+                                 'parse': {transform_function_name: 'number',
+                                           'W': 'number'}}}
+        else:
+            values = {'values': volcano_results.reset_index(
+                drop=False).to_dict(orient='records')}
 
         spec = {
             '$schema': 'https://vega.github.io/schema/vega/v4.json',
             'width': 300,
             'height': 300,
-            'data': [
-                {'name': 'values',
-                 'values': volcano_results.to_dict(orient='records')}],
+            'data': [dict(name='values', **values)],
             'scales': [
                 {'name': 'xScale',
                  'domain': {'data': 'values',
@@ -153,11 +597,13 @@ def ancom(output_dir: str,
         if filtered_ids:
             context['filtered_ids'] = ', '.join(sorted(filtered_ids))
 
-    copy_tree(os.path.join(TEMPLATES, 'ancom'), output_dir)
-    ancom_results[0].to_csv(os.path.join(output_dir, 'ancom.tsv'),
-                            header=True, index=True, sep='\t')
-    ancom_results[1].to_csv(os.path.join(output_dir,
-                                         'percent-abundances.tsv'),
-                            header=True, index=True, sep='\t')
+    _install_assets(os.path.join(TEMPLATES, 'ancom'), output_dir,
+                    link=link_assets)
+    for name, table in tables.items():
+        table.to_csv(os.path.join(output_dir, '%s.tsv' % name),
+                     header=True, index=True, sep='\t')
+        if binary_format is not None:
+            _write_binary_table(table, os.path.join(output_dir, name),
+                                binary_format)
     index = os.path.join(TEMPLATES, 'ancom', 'index.html')
     q2templates.render(index, output_dir, context=context)
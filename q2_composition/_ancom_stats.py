@@ -0,0 +1,1347 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import os
+import tempfile
+import warnings
+
+import biom
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from scipy.special import chdtrc, fdtrc
+from scipy.stats import rankdata
+
+# Sums of squares that are this small relative to the quantities they were
+# derived from are round-off, and are treated as exactly zero. This mirrors
+# computing the statistics directly from the (exactly constant) log ratios.
+_EPS = 1e-10
+
+
+def ancom_test(table, grouping, alpha=0.05, tau=0.02, theta=0.1,
+               significance_test='f_oneway', pseudocount=None,
+               memory_budget=None, n_jobs=1, permutations=999, seed=None,
+               adaptive=False):
+    """Compute the ANCOM W statistic and reject calls for each feature
+
+    This is equivalent to ``skbio.stats.composition.ancom`` (with
+    Holm-Bonferroni correction), but the pairwise log-ratio tests are
+    computed in batches, a tile of feature pairs at a time, rather than one
+    test per feature pair.
+
+    Parameters
+    ----------
+    table : pd.DataFrame or biom.Table
+        Abundances: a DataFrame with samples as rows and features as
+        columns, or a (possibly sparse) biom Table. These must be strictly
+        positive, unless a pseudocount is provided.
+    grouping : pd.Series
+        The group of each sample, indexed by sample id.
+    alpha, tau, theta : float
+        As defined by ``skbio.stats.composition.ancom``.
+    significance_test : str
+        The test applied to each log ratio: 'f_oneway' (one-way ANOVA, as
+        ``scipy.stats.f_oneway``), 'kruskal' (Kruskal-Wallis H-test, as
+        ``scipy.stats.kruskal``), 'welch' (Welch's ANOVA, which doesn't
+        assume equal variances across groups) or 'permutation' (a
+        permutation test of the one-way ANOVA F statistic).
+    pseudocount : float, optional
+        If provided, the tests are of the log ratios of the abundances plus
+        this pseudocount. It is never added to the table: the log
+        abundances are computed as log(pc) + log1p(x / pc), of which only
+        the second term (which is zero wherever x is) is kept, as the first
+        cancels out of every log ratio. A sparse table then stays sparse.
+    memory_budget : int, optional
+        The approximate number of bytes of pairwise statistics and
+        candidate p-values that may be held in memory at once. See
+        ``w_statistics``.
+    n_jobs : int
+        The number of tiles of pairwise comparisons evaluated concurrently.
+        See ``w_statistics``.
+    permutations : int
+        The number of permutations of the grouping, if significance_test is
+        'permutation'. The smallest attainable p-value is
+        1 / (permutations + 1), so a comparison can only be rejected if
+        permutations + 1 exceeds (n_features - 1) / alpha: the default can
+        not reject any comparison among more than 50 features at
+        alpha=0.05. A warning is issued when there are too few.
+    seed : int, optional
+        The seed of the permutations, if significance_test is
+        'permutation', and of the order of the comparisons, if adaptive.
+    adaptive : bool
+        If True, stop evaluating the comparisons of a feature once it is
+        clear that it won't be rejected. The reject calls are unchanged, but
+        the W of such a feature is a lower bound. See
+        ``adaptive_w_statistics``.
+
+    Returns
+    -------
+    pd.DataFrame
+        Indexed by feature id, with columns "W" and "Reject null hypothesis".
+        If adaptive, a "Decided early" column flags the features whose W is
+        a lower bound.
+    """
+    results = ancom_tests(table, grouping.to_frame(name='grouping'),
+                          alpha=alpha, tau=tau, theta=theta,
+                          significance_test=significance_test,
+                          pseudocount=pseudocount,
+                          memory_budget=memory_budget, n_jobs=n_jobs,
+                          permutations=permutations, seed=seed,
+                          adaptive=adaptive)
+    return results['grouping']
+
+
+def ancom_tests(table, groupings, alpha=0.05, tau=0.02, theta=0.1,
+                significance_test='f_oneway', pseudocount=None,
+                memory_budget=None, n_jobs=1, permutations=999, seed=None,
+                adaptive=False):
+    """Compute ANCOM for several groupings of the same samples
+
+    The log abundances, and the part of each pairwise log-ratio test that
+    doesn't depend on the grouping, are computed once and shared by all of
+    the groupings. See ``ancom_test`` for the parameters.
+
+    Parameters
+    ----------
+    groupings : pd.DataFrame
+        The groups of each sample, with one column per grouping, indexed by
+        sample id.
+
+    Returns
+    -------
+    dict of pd.DataFrame
+        The ``ancom_test`` result of each grouping, keyed by column name.
+    """
+    matrix, sample_ids, feature_ids = _as_matrix(table)
+    log_matrix, labels = _validate(matrix, sample_ids, groupings,
+                                   pseudocount)
+
+    kwargs = dict(alpha=alpha, significance_test=significance_test,
+                  memory_budget=memory_budget, n_jobs=n_jobs,
+                  permutations=permutations, seed=seed)
+    if adaptive:
+        Ws = adaptive_w_statistics(log_matrix, labels, theta=theta, **kwargs)
+    else:
+        Ws = [(W, None) for W in w_statistics(log_matrix, labels, **kwargs)]
+
+    results = {}
+    for column, (W, decided) in zip(groupings.columns, Ws):
+        reject = ancom_reject(W, tau=tau, theta=theta)
+        result = {'W': W, 'Reject null hypothesis': reject}
+        if adaptive:
+            result['Decided early'] = decided
+        results[column] = pd.DataFrame(result, index=feature_ids)
+    return results
+
+
+def percentile_abundances(table, grouping,
+                          percentiles=(0.0, 25.0, 50.0, 75.0, 100.0),
+                          pseudocount=None, features=None):
+    """Compute the percentile abundances of each feature in each group
+
+    The result is laid out as by ``skbio.stats.composition.ancom``: indexed
+    by feature id, with (Percentile, Group) columns. The table may be a
+    DataFrame or a biom Table (see ``ancom_test``); if a pseudocount is
+    provided, the percentiles are of the abundances plus the pseudocount.
+    If features (a boolean mask, or positions, of the table's features) is
+    provided, only those features are included; ANCOM only reports the
+    percentiles of the features it rejects, which are usually few.
+
+    The samples are sorted by group once, so that each group is a
+    contiguous run of rows, and (sparse) tables are densified a block of
+    features at a time; the percentiles of all of a block's features are
+    then computed together, one group at a time.
+    """
+    matrix, sample_ids, feature_ids = _as_matrix(table)
+    if features is not None:
+        features = np.asarray(features)
+        matrix = matrix[:, features]
+        feature_ids = feature_ids[features]
+    groups, labels = np.unique(grouping.reindex(sample_ids).values,
+                               return_inverse=True)
+    order = np.argsort(labels, kind='stable')
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(labels))])
+    matrix = matrix[order]
+    if scipy.sparse.issparse(matrix):
+        matrix = matrix.tocsc()
+    n_samples, n_features = matrix.shape
+
+    block_size = max(1, _BLOCK_ENTRIES // n_samples)
+    data = np.empty((len(groups), len(percentiles), n_features))
+    for start in range(0, n_features, block_size):
+        stop = min(start + block_size, n_features)
+        block = matrix[:, start:stop]
+        if scipy.sparse.issparse(block):
+            block = block.toarray()
+        if pseudocount is not None:
+            block = block + pseudocount
+        for i in range(len(groups)):
+            data[i, :, start:stop] = np.percentile(
+                block[bounds[i]:bounds[i + 1]], percentiles, axis=0)
+
+    # the columns are ordered by group, then percentile
+    columns = pd.MultiIndex.from_arrays(
+        [np.tile(percentiles, len(groups)),
+         np.repeat(groups, len(percentiles))],
+        names=['Percentile', 'Group'])
+    data = data.reshape(len(groups) * len(percentiles), n_features)
+    return pd.DataFrame(data.T, columns=columns, index=feature_ids)
+
+
+def w_statistic(log_matrix, labels, alpha=0.05, significance_test='f_oneway',
+                memory_budget=None, n_jobs=1, permutations=999, seed=None):
+    """Count, for each feature, the log ratios that differ between groups
+
+    See ``w_statistics``, of which this is the single grouping case.
+    """
+    return w_statistics(log_matrix, [labels], alpha=alpha,
+                        significance_test=significance_test,
+                        memory_budget=memory_budget, n_jobs=n_jobs,
+                        permutations=permutations, seed=seed)[0]
+
+
+def w_statistics(log_matrix, labels, alpha=0.05,
+                 significance_test='f_oneway', memory_budget=None, n_jobs=1,
+                 permutations=999, seed=None):
+    """Compute the W statistic of each feature for each of several groupings
+
+    The pairwise comparisons are evaluated in square tiles of features, so that
+    only one tile of pairwise statistics is held in memory at a time. What the
+    test of each log ratio in a tile needs that doesn't depend on the grouping
+    (e.g., the total sum of squares, or the ranks of the log ratios) is
+    computed once, and shared by all of the groupings. Of each tile, only what
+    is needed to later apply the Holm-Bonferroni correction is kept: the
+    p-values below alpha (the only ones that can be rejected) and the number of
+    undefined comparisons of each feature.
+
+    Tiles may be evaluated concurrently by a pool of threads: the work is
+    dominated by matrix products and ufuncs, which release the GIL. Results
+    are merged in tile order, so W doesn't depend on the number of jobs.
+
+    Parameters
+    ----------
+    log_matrix : np.ndarray
+        Log abundances, with samples as rows and features as columns.
+    labels : list of np.ndarray
+        For each grouping, the group index (0 to n_groups - 1) of each
+        sample.
+    alpha : float
+        Significance level, applied after Holm-Bonferroni correction of the
+        p-values of each feature's comparisons.
+    significance_test : str
+        The test applied to each log ratio. See ``ancom_test``.
+    memory_budget : int, optional
+        The approximate number of bytes that may be held in memory at once.
+        Half is for the pairwise statistics of the tiles being evaluated,
+        which determines the tile size, and is shared between concurrently
+        evaluated tiles. The other half is for the candidates, which are
+        spilled to temporary files beyond it (see ``_CandidateBuffer``). By
+        default, 256 MiB.
+    n_jobs : int
+        The number of tiles evaluated concurrently.
+    permutations : int
+        The number of permutations of each grouping, if significance_test
+        is 'permutation'. Their labels are held in memory, out of the half
+        of memory_budget that is for the tiles, which are then evaluated a
+        batch of permutations at a time. See ``ancom_test`` for how many
+        are needed.
+    seed : int, optional
+        The seed of the permutations. They are drawn once, up front, so
+        that every tile sees the same permutations, and W doesn't depend on
+        the tiling or the number of jobs.
+
+    Returns
+    -------
+    list of np.ndarray
+        The W statistic of each feature, for each grouping.
+    """
+    n_features = log_matrix.shape[1]
+    test, stats, groups, size, capacity = _setup(
+        log_matrix, labels, significance_test, alpha, memory_budget, n_jobs,
+        permutations, np.random.default_rng(seed))
+    counters = [_WCounter(n_features, alpha, capacity) for _ in groups]
+
+    def evaluate(tile):
+        return _tile_candidates(test, stats, groups, *tile, alpha)
+
+    try:
+        with _executor(n_jobs) as executor:
+            # map yields in submission order, regardless of which tiles
+            # finish first
+            tiles = _tiles(n_features, size)
+            for candidates in executor.map(evaluate, tiles):
+                for counter, c in zip(counters, candidates):
+                    counter.add(c)
+        return [counter.w() for counter in counters]
+    finally:
+        for counter in counters:
+            counter.close()
+
+
+def adaptive_w_statistics(log_matrix, labels, alpha=0.05, theta=0.1,
+                          significance_test='f_oneway', memory_budget=None,
+                          n_jobs=1, permutations=999, seed=None):
+    """Compute W, skipping comparisons that can't change the reject calls
+
+    The features are shuffled into blocks, and the pairs of blocks are
+    evaluated in rounds, in each of which every block is compared with
+    (about) two others. After each round, the W of each feature is bounded
+    from the comparisons evaluated so far: the unevaluated comparisons can
+    at most all be rejected, and at least none of them. A feature whose W
+    can't reach the lowest cutoff that ``ancom_reject`` may choose (given
+    the bounds of the largest W), or with theta that no feature can be
+    rejected, is decided: its remaining comparisons are skipped (unless
+    they are needed by another, undecided, feature).
+
+    The largest W is never that of a decided feature, so the cutoff, and
+    therefore the reject calls, are those of ``w_statistics``. The W of a
+    decided feature is a lower bound, counted from the comparisons that
+    were evaluated, which depend on the seed and the size of the blocks
+    (but not on the number of jobs, as rounds are merged in order).
+
+    Parameters
+    ----------
+    theta : float
+        As defined by ``skbio.stats.composition.ancom``.
+
+    See ``w_statistics`` for the other parameters. seed also determines
+    the blocks of features.
+
+    Returns
+    -------
+    list of (np.ndarray, np.ndarray)
+        The W statistic of each feature, and whether it was decided early,
+        for each grouping.
+    """
+    n_features = log_matrix.shape[1]
+    rng = np.random.default_rng(seed)
+    test, stats, groups, size, capacity = _setup(
+        log_matrix, labels, significance_test, alpha, memory_budget, n_jobs,
+        permutations, rng)
+    counters = [_AdaptiveWCounter(n_features, alpha, theta, capacity)
+                for _ in groups]
+
+    # blocks are (much) smaller than the tiles of w_statistics, so that
+    # decisions can be made after a fraction of the comparisons. The first
+    # block holds the features most likely to have the largest W, and is
+    # compared with all of the others first, so that the lower bound of the
+    # largest W (and so the bar for deciding the others) is tight early on.
+    size = min(size, -(-n_features // _ADAPTIVE_BLOCKS))
+    probes = np.argsort(-_probe_scores(stats, groups), kind='stable')[:size]
+    order = rng.permutation(np.setdiff1d(np.arange(n_features), probes))
+    blocks = [probes] + [order[start:start + size]
+                         for start in range(0, len(order), size)]
+
+    try:
+        with _executor(n_jobs) as executor:
+            for tiles in _rounds(len(blocks)):
+                # a comparison is needed if either feature is undecided for
+                # any of the groupings
+                undecided = ~np.logical_and.reduce(
+                    [counter.decided for counter in counters])
+                if not undecided.any():
+                    break
+
+                def evaluate(tile):
+                    a, b = tile
+                    return _adaptive_tile_candidates(
+                        test, stats, groups, counters, undecided, blocks[a],
+                        blocks[b], a == b, alpha)
+
+                for candidates in executor.map(evaluate, tiles):
+                    for counter, c in zip(counters, candidates):
+                        counter.add(c)
+                for counter in counters:
+                    counter.decide()
+        return [(counter.w(), counter.decided) for counter in counters]
+    finally:
+        for counter in counters:
+            counter.close()
+
+
+def _setup(log_matrix, labels, significance_test, alpha, memory_budget,
+           n_jobs, permutations, rng):
+    """The test, statistics, tile size and candidate capacity (of each
+    grouping) shared by the W computations"""
+    n_samples, n_features = log_matrix.shape
+    test = _significance_tests[significance_test]
+    stats = _log_ratio_stats(log_matrix)
+    groups = [_group_stats(stats, grouping) for grouping in labels]
+    n_groups = max(len(g.counts) for g in groups)
+    if memory_budget is None:
+        memory_budget = _DEFAULT_MEMORY_BUDGET
+    tiles_budget = memory_budget / 2
+    if significance_test == 'permutation':
+        if (permutations + 1) * alpha <= n_features - 1:
+            warnings.warn(
+                'With %d permutations, no p-value is small enough to be '
+                'rejected among the %d comparisons of each feature at '
+                'alpha=%g, so every W will be 0. At least %d permutations are '
+                'needed.' % (permutations, n_features - 1, alpha,
+                             int((n_features - 1) / alpha)),
+                UserWarning)
+        groups = [g._replace(permutations=_permuted_labels(
+                      g.labels, permutations, rng))
+                  for g in groups]
+        # the permuted labels, and the indicators of each job's batch
+        tiles_budget -= sum(g.permutations.nbytes for g in groups)
+        tiles_budget -= (n_jobs * _PERMUTATION_BATCH * n_groups * n_samples *
+                         np.dtype(np.float64).itemsize)
+    size = _tile_size(n_features, max(0, tiles_budget) / n_jobs,
+                      test.tile_arrays(n_samples),
+                      test.row_arrays(n_samples, n_groups))
+    capacity = max(1, int(memory_budget / 2 / _CANDIDATE_BYTES / len(groups)))
+    return test, stats, groups, size, capacity
+
+
+class _SerialExecutor:
+    """Stands in for a ThreadPoolExecutor when there is only one job"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def map(self, fn, iterable):
+        return map(fn, iterable)
+
+
+class _WindowedExecutor(ThreadPoolExecutor):
+    """A ThreadPoolExecutor whose map submits calls as results are consumed
+
+    ThreadPoolExecutor.map submits every call up front, so that the results
+    of all tiles could pile up ahead of the one being merged. Here, at most
+    twice max_workers calls are in flight (submitted, but not yet yielded):
+    enough that workers don't idle while results are merged.
+    """
+    def __init__(self, max_workers):
+        super().__init__(max_workers=max_workers)
+        self.window = 2 * max_workers
+
+    def map(self, fn, iterable):
+        futures = collections.deque()
+        try:
+            for item in iterable:
+                if len(futures) == self.window:
+                    yield futures.popleft().result()
+                futures.append(self.submit(fn, item))
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def _executor(n_jobs):
+    if n_jobs == 1:
+        return _SerialExecutor()
+    return _WindowedExecutor(n_jobs)
+
+
+def group_means(matrix, labels):
+    """The mean of each column of matrix within each group of rows
+
+    Returns an array with one row per group (0 to n_groups - 1).
+    """
+    indicator = _indicator(labels)
+    return (indicator @ matrix) / indicator.sum(axis=1)[:, None]
+
+
+def f_statistic(matrix, labels):
+    """The one-way ANOVA F statistic of each column of matrix
+
+    As with ``scipy.stats.f_oneway``, columns that are constant within
+    groups (but not overall) have an F statistic of inf, and columns that
+    are constant overall have an F statistic of NaN.
+    """
+    stats = _log_ratio_stats(matrix)
+    groups = _group_stats(stats, labels)
+    # centering a constant column can leave round-off behind
+    constant = stats.total <= _EPS * np.einsum('ij,ij->j', matrix, matrix)
+    between = np.where(constant, 0, groups.between)
+    total = np.where(constant, 0, stats.total)
+    return _f_ratio(between, total, groups.dfn, groups.dfd)
+
+
+# The offsets, relative to the largest W, of the cutoffs ancom_reject chooses
+# from.
+_CUTOFFS = np.linspace(0.05, 0.25, 5)
+
+
+def ancom_reject(W, tau=0.02, theta=0.1):
+    """Select the W cutoff, and apply it, as skbio's ancom does"""
+    n_features = len(W)
+    c_start = W.max() / n_features
+    if c_start < theta:
+        return np.zeros_like(W, dtype=bool)
+
+    cutoff = c_start - _CUTOFFS
+    prop_cut = np.array([(W > n_features * cut).mean() for cut in cutoff])
+    dels = np.abs(prop_cut - np.roll(prop_cut, -1))
+    dels[-1] = 0
+
+    if (dels[0] < tau) and (dels[1] < tau) and (dels[2] < tau):
+        nu = cutoff[1]
+    elif (dels[0] >= tau) and (dels[1] < tau) and (dels[2] < tau):
+        nu = cutoff[2]
+    elif (dels[1] >= tau) and (dels[2] < tau) and (dels[3] < tau):
+        nu = cutoff[3]
+    else:
+        nu = cutoff[4]
+    return W >= nu * n_features
+
+
+def _as_matrix(table):
+    """The (samples x features) matrix of a DataFrame or biom Table
+
+    The matrix of a biom Table is returned as a CSC matrix, so that its
+    features can be sliced cheaply.
+    """
+    if isinstance(table, biom.Table):
+        matrix = table.matrix_data.T.tocsc().astype(np.float64)
+        return (matrix, pd.Index(table.ids()),
+                pd.Index(table.ids(axis='observation')))
+    return table.values.astype(np.float64), table.index, table.columns
+
+
+def _validate(matrix, sample_ids, groupings, pseudocount=None):
+    """Validate the inputs, and compute the log matrix and group labels
+
+    The log matrix is sparse if matrix is and a pseudocount is provided.
+    """
+    if groupings.isnull().values.any():
+        raise ValueError('Cannot handle missing values in `grouping`.')
+    groupings = groupings.reindex(sample_ids)
+    if groupings.isnull().values.any():
+        raise ValueError('`table` contains samples that are not present in '
+                         '`grouping`.')
+
+    values = matrix.data if scipy.sparse.issparse(matrix) else matrix
+    if np.isnan(values).any():
+        raise ValueError('Cannot handle missing values in `table`.')
+    if pseudocount is None:
+        if scipy.sparse.issparse(matrix):
+            matrix = matrix.toarray()
+        if (matrix <= 0).any():
+            raise ValueError('Cannot handle zeros or negative values in '
+                             '`table`. Use pseudocounts or '
+                             '``multiplicative_replacement``.')
+        log_matrix = np.log(matrix)
+    else:
+        if pseudocount <= 0:
+            raise ValueError('`pseudocount` must be greater than zero.')
+        if (values < 0).any():
+            raise ValueError('Cannot handle negative values in `table`.')
+        # log(x + pc) - log(pc), as log(pc) cancels out of the log ratios
+        if scipy.sparse.issparse(matrix):
+            log_matrix = matrix.copy()
+            log_matrix.data = np.log1p(log_matrix.data / pseudocount)
+        else:
+            log_matrix = np.log1p(matrix / pseudocount)
+
+    labels = []
+    for column in groupings.columns:
+        groups, grouping_labels = np.unique(groupings[column].values,
+                                            return_inverse=True)
+        if len(groups) == len(grouping_labels):
+            raise ValueError('All values in `grouping` are unique. This '
+                             'method cannot operate on a grouping vector '
+                             'with only unique values (e.g., there are no '
+                             '\'within\' variance because each group of '
+                             'samples contains only a single sample).')
+        if len(groups) == 1:
+            raise ValueError('All values the `grouping` are the same. This '
+                             'method cannot operate on a grouping vector '
+                             'with only a single group of samples (e.g., '
+                             'there are no \'between\' variance because '
+                             'there is only a single group).')
+        labels.append(grouping_labels)
+    return log_matrix, labels
+
+
+# The number of tile sized float64 arrays that are alive at once while the
+# p-values of a tile are computed.
+_TILE_ARRAYS = 6
+
+# The bytes each candidate (a feature index and a p-value) takes.
+_CANDIDATE_BYTES = 16
+
+# The default memory budget of the W computations, in bytes: half for the
+# tiles being evaluated, and half for the candidates kept of them.
+_DEFAULT_MEMORY_BUDGET = 2 ** 28
+
+# The number of blocks the features are divided into by the adaptive
+# computation of W, unless the memory budget calls for more.
+_ADAPTIVE_BLOCKS = 32
+
+# The number of permutations whose pairwise statistics are computed at once,
+# by the permutation test.
+_PERMUTATION_BATCH = 16
+
+# The number of matrix entries that are densified at once when a sparse table
+# is processed a block at a time (here, and by _ancom and _impute).
+_BLOCK_ENTRIES = 2 ** 22
+
+_LogRatioStats = collections.namedtuple(
+    '_LogRatioStats', ['log_matrix', 'mean', 'total'])
+
+# permutations is only computed for the permutation test: the permuted
+# labels, one permutation per row (see _permuted_labels).
+_GroupStats = collections.namedtuple(
+    '_GroupStats', ['labels', 'counts', 'weighted_sums', 'group_sums',
+                    'between', 'dfn', 'dfd', 'permutations'],
+    defaults=[None])
+
+
+def _log_ratio_stats(log_matrix):
+    """Per-feature sufficient statistics for pairwise log-ratio ANOVAs
+
+    The log ratio of features i and j is log x_i - log x_j, so its total
+    and between-group sums of squares follow from the cross products of the
+    (centered) per-feature log abundances and group sums, respectively:
+    ||a - b||^2 = a.a + b.b - 2 a.b. This precomputes everything but the
+    cross products, which are computed per tile. The statistics of each
+    grouping are computed separately, by ``_group_stats``.
+
+    log_matrix may be sparse, in which case the centered log abundances are
+    never materialized (beyond a tile's features at a time): the sums of
+    squares and cross products are computed from the non-zero values, and
+    then corrected for the means.
+    """
+    n_samples = log_matrix.shape[0]
+    if scipy.sparse.issparse(log_matrix):
+        mean = np.asarray(log_matrix.mean(axis=0)).ravel()
+        squares = np.asarray(
+            log_matrix.multiply(log_matrix).sum(axis=0)).ravel()
+        total = squares - n_samples * mean ** 2
+        total[total <= _EPS * squares] = 0
+    else:
+        mean = log_matrix.mean(axis=0)
+        centered = log_matrix - mean
+        total = np.einsum('ij,ij->j', centered, centered)
+    return _LogRatioStats(log_matrix=log_matrix, mean=mean, total=total)
+
+
+def _columns(stats, cols):
+    """The (dense) log abundances of a slice of features"""
+    columns = stats.log_matrix[:, cols]
+    if scipy.sparse.issparse(columns):
+        columns = columns.toarray()
+    return columns
+
+
+def _centered(stats, cols):
+    """The (dense) centered log abundances of a slice of features"""
+    return _columns(stats, cols) - stats.mean[cols]
+
+
+def _group_stats(stats, labels):
+    n_samples = stats.log_matrix.shape[0]
+    indicator = _indicator(labels)
+    counts = indicator.sum(axis=1)
+    n_groups = len(counts)
+
+    # the group sums of the centered log abundances
+    if scipy.sparse.issparse(stats.log_matrix):
+        group_sums = (stats.log_matrix.T @ indicator.T).T
+    else:
+        group_sums = indicator @ stats.log_matrix
+    group_sums -= counts[:, None] * stats.mean
+    weighted_sums = group_sums / counts[:, None]
+
+    return _GroupStats(
+        labels=labels,
+        counts=counts,
+        weighted_sums=weighted_sums,
+        group_sums=group_sums,
+        between=np.einsum('ij,ij->j', weighted_sums, group_sums),
+        dfn=n_groups - 1,
+        dfd=n_samples - n_groups)
+
+
+def _pairwise_total(stats, rows, cols):
+    """Total sums of squares of the log ratios of a tile of feature pairs"""
+    if scipy.sparse.issparse(stats.log_matrix):
+        n_samples = stats.log_matrix.shape[0]
+        gram = (stats.log_matrix[:, rows].T
+                @ stats.log_matrix[:, cols]).toarray()
+        gram -= n_samples * np.outer(stats.mean[rows], stats.mean[cols])
+    else:
+        gram = _centered(stats, rows).T @ _centered(stats, cols)
+    return _pairwise_sq_dist(gram, stats.total[rows], stats.total[cols])
+
+
+def _f_oneway_pvalues(total, groups, rows, cols):
+    """One-way ANOVA p-values of the log ratios of a tile of feature pairs
+
+    total is the tile's ``_pairwise_total``, and groups the grouping's
+    ``_group_stats``.
+    """
+    between = _pairwise_sq_dist(
+        groups.weighted_sums[:, rows].T @ groups.group_sums[:, cols],
+        groups.between[rows], groups.between[cols])
+    f = _f_ratio(between, total, groups.dfn, groups.dfd)
+    return fdtrc(groups.dfn, groups.dfd, f)
+
+
+def _pairwise_ranks(stats, rows, cols):
+    """Ranks of the log ratios of a tile of feature pairs, across samples
+
+    Returns the (n_samples, n_rows, n_cols) ranks, and the sum of t^3 - t
+    over the groups of t tied log ratios of each pair. The latter follows
+    from the sum of the squared (average) ranks, as each group of ties
+    reduces it by (t^3 - t) / 12.
+    """
+    n_samples = stats.log_matrix.shape[0]
+    ratios = (_columns(stats, rows)[:, :, None]
+              - _columns(stats, cols)[:, None, :])
+    ranks = rankdata(ratios, axis=0)
+    del ratios
+    untied = n_samples * (n_samples + 1) * (2 * n_samples + 1) / 6
+    ties = 12 * (untied - np.einsum('ijk,ijk->jk', ranks, ranks))
+    return ranks, ties
+
+
+def _permutation_pvalues(shared, groups, rows, cols):
+    """Permutation test p-values of the log ratios of a tile of feature pairs
+
+    shared is the tile's ``_LogRatioStats`` and ``_pairwise_total``. The
+    test statistic is the between-group sum of squares, which orders the
+    permutations as the F statistic does, as the total sum of squares
+    doesn't depend on the labels. The permutations are evaluated a batch
+    at a time: the group sums of the tile's features under the batch are
+    computed by a single product with the stacked indicator matrices of
+    its permuted labels, and the between-group sums of squares of the
+    pairs then follow from their cross products. As for the one-way ANOVA,
+    pairs whose log ratio is constant have a p-value of NaN.
+    """
+    stats, total = shared
+    observed = _pairwise_sq_dist(
+        groups.weighted_sums[:, rows].T @ groups.group_sums[:, cols],
+        groups.between[rows], groups.between[cols])
+    # permuted sums of squares that are equal to the observed one, up to
+    # round-off, are counted as at least as extreme
+    threshold = observed - _EPS * total
+
+    counts = groups.counts[:, None]
+    n_permutations = len(groups.permutations)
+    extreme = np.zeros(observed.shape, dtype=np.int64)
+    for start in range(0, n_permutations, _PERMUTATION_BATCH):
+        indicators = _permuted_indicators(
+            groups.permutations[start:start + _PERMUTATION_BATCH],
+            len(groups.counts))
+        sums_rows = _permuted_group_sums(stats, indicators, rows)
+        sums_cols = _permuted_group_sums(stats, indicators, cols)
+        weighted_rows = (sums_rows / counts).transpose(0, 2, 1)
+        between = _pairwise_sq_dist(
+            weighted_rows @ sums_cols,
+            np.einsum('pik,pki->pi', weighted_rows, sums_rows),
+            np.einsum('pki,pki->pi', sums_cols / counts, sums_cols))
+        extreme += (between >= threshold).sum(axis=0)
+
+    pvalues = (extreme + 1) / (n_permutations + 1)
+    pvalues[total == 0] = np.nan
+    return pvalues
+
+
+def _permuted_group_sums(stats, indicators, cols):
+    """Group sums of the centered log abundances of a slice of features
+
+    Returns an (n_permutations, n_groups, n_cols) array, given the
+    ``_permuted_indicators``.
+    """
+    n_permutations, n_groups, n_samples = indicators.shape
+    indicator = indicators.reshape(-1, n_samples)
+    if scipy.sparse.issparse(stats.log_matrix):
+        sums = (stats.log_matrix[:, cols].T @ indicator.T).T
+    else:
+        sums = indicator @ stats.log_matrix[:, cols]
+    sums = sums.reshape(n_permutations, n_groups, -1)
+    # every permutation has the same group sizes
+    sums -= indicators[0].sum(axis=1)[:, None] * stats.mean[cols]
+    return sums
+
+
+def _permuted_labels(labels, n_permutations, rng):
+    """An (n_permutations, n_samples) array of permutations of labels
+
+    The labels are stored in the smallest integer type that holds them,
+    and the random keys they are sorted by are drawn a chunk of
+    permutations at a time, so that many permutations of many samples
+    stay within a small multiple of the table's size.
+    """
+    n_samples = len(labels)
+    labels = labels.astype(np.min_scalar_type(labels.max()))
+    permuted = np.empty((n_permutations, n_samples), dtype=labels.dtype)
+    chunk = _PERMUTATION_BATCH * 64
+    for start in range(0, n_permutations, chunk):
+        keys = rng.random((min(chunk, n_permutations - start), n_samples))
+        permuted[start:start + chunk] = labels[np.argsort(keys, axis=1)]
+    return permuted
+
+
+def _permuted_indicators(permuted, n_groups):
+    """The (n_permutations, n_groups, n_samples) indicators of a batch of
+    ``_permuted_labels``
+    """
+    n_permutations, n_samples = permuted.shape
+    indicator = np.zeros((n_permutations, n_groups, n_samples))
+    indicator[np.arange(n_permutations)[:, None], permuted,
+              np.arange(n_samples)] = 1
+    return indicator
+
+
+def _kruskal_pvalues(ranked, groups, rows, cols):
+    """Kruskal-Wallis p-values of the log ratios of a tile of feature pairs
+
+    ranked is the tile's ``_pairwise_ranks``, and groups the grouping's
+    ``_group_stats``. Pairs whose log ratio is constant have a p-value of
+    NaN (where ``scipy.stats.kruskal`` raises an error).
+    """
+    ranks, ties = ranked
+    n_samples, n_rows, n_cols = ranks.shape
+    rank_sums = _indicator(groups.labels) @ ranks.reshape(n_samples, -1)
+    h = (rank_sums ** 2 / groups.counts[:, None]).sum(axis=0)
+    h = h.reshape(n_rows, n_cols)
+    h *= 12 / (n_samples * (n_samples + 1))
+    h -= 3 * (n_samples + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        h /= 1 - ties / (n_samples ** 3 - n_samples)
+    return chdtrc(groups.dfn, h)
+
+
+def _welch_pvalues(stats, groups, rows, cols):
+    """Welch's ANOVA p-values of the log ratios of a tile of feature pairs
+
+    The mean and variance of a log ratio within each group follow from the
+    per-feature means and the within-group cross products of the features,
+    as for the sums of squares of the one-way ANOVA. The statistic is
+    accumulated one group at a time, from sums over the groups' weights
+    w = n / s^2, so that only a few tile sized arrays are needed. Groups of
+    a single sample, or log ratios that are constant within a group, leave
+    the p-value undefined (NaN).
+    """
+    n_groups = groups.dfn + 1
+    sum_w = sum_wm = sum_wm2 = sum_wn = sum_w2n = 0
+    centered_rows = _centered(stats, rows)
+    centered_cols = _centered(stats, cols)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for g in range(n_groups):
+            members = groups.labels == g
+            n = groups.counts[g]
+            means = groups.weighted_sums[g]
+            within_rows, rows_sq = _within(centered_rows[members],
+                                           means[rows])
+            within_cols, cols_sq = _within(centered_cols[members],
+                                           means[cols])
+            variance = _pairwise_sq_dist(within_rows.T @ within_cols,
+                                         rows_sq, cols_sq)
+            mean = means[rows, None] - means[None, cols]
+
+            w = n * (n - 1) / variance
+            sum_w = sum_w + w
+            sum_wm = sum_wm + w * mean
+            sum_wm2 = sum_wm2 + w * mean ** 2
+            sum_wn = sum_wn + w / (n - 1)
+            sum_w2n = sum_w2n + w ** 2 / (n - 1)
+
+        between = (sum_wm2 - sum_wm ** 2 / sum_w) / (n_groups - 1)
+        # sum((1 - w / sum_w) ** 2 / (n - 1)), expanded
+        tmp = ((1 / (groups.counts - 1)).sum() - 2 * sum_wn / sum_w
+               + sum_w2n / sum_w ** 2)
+        f = between / (1 + 2 * (n_groups - 2) / (n_groups ** 2 - 1) * tmp)
+        dfd = (n_groups ** 2 - 1) / (3 * tmp)
+        return fdtrc(n_groups - 1, dfd, f)
+
+
+def _within(members, means):
+    """Center the log abundances of a group's members on the group means
+
+    Returns the centered values, and their sums of squares. Features that
+    are constant within the group are set to exactly zero, rather than to
+    the round-off left by centering them.
+    """
+    within = members - means
+    squares = np.einsum('ij,ij->j', within, within)
+    constant = squares <= _EPS * np.einsum('ij,ij->j', members, members)
+    within[:, constant] = 0
+    squares[constant] = 0
+    return within, squares
+
+
+def _f_ratio(between, total, dfn, dfd):
+    """F statistics from between-group and total sums of squares"""
+    within = total - between
+    within[within <= _EPS * total] = 0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (between / dfn) / (within / dfd)
+
+
+def _indicator(labels):
+    """A (n_groups, n_samples) matrix of group membership"""
+    n_samples = len(labels)
+    indicator = np.zeros((labels.max() + 1, n_samples))
+    indicator[labels, np.arange(n_samples)] = 1
+    return indicator
+
+
+def _pairwise_sq_dist(gram, rows_sq, cols_sq):
+    """Squared distances between pairs of vectors given their cross products
+    """
+    scale = rows_sq[..., :, None] + cols_sq[..., None, :]
+    dist = scale - 2 * gram
+    dist[dist <= _EPS * scale] = 0
+    return dist
+
+
+def _tile_size(n_features, memory_budget=None, tile_arrays=_TILE_ARRAYS,
+               row_arrays=0):
+    if memory_budget is None:
+        return max(1, n_features)
+    itemsize = np.dtype(np.float64).itemsize
+    # the largest size whose tile_arrays tiles and row_arrays rows of a tile
+    # fit in the budget
+    squares, rows = itemsize * tile_arrays, itemsize * row_arrays
+    size = int((np.sqrt(rows ** 2 + 4 * squares * memory_budget) - rows) /
+               (2 * squares))
+    return max(1, min(size, n_features))
+
+
+def _tiles(n_features, size):
+    """Yield the (rows, cols) slices of the tiles on or above the diagonal"""
+    starts = range(0, n_features, size)
+    for i in starts:
+        for j in starts:
+            if j >= i:
+                yield slice(i, i + size), slice(j, j + size)
+
+
+# Each significance test is evaluated a tile at a time, in two steps: shared
+# computes what doesn't depend on the grouping, from the _LogRatioStats, and
+# pvalues computes the p-values for a grouping, from the result of shared and
+# the grouping's _GroupStats. tile_arrays is the number of tile sized float64
+# arrays alive at once, given the number of samples, and row_arrays the number
+# of float64 arrays the size of a row of a tile, given the number of samples
+# and the largest number of groups.
+_SignificanceTest = collections.namedtuple(
+    '_SignificanceTest', ['shared', 'pvalues', 'tile_arrays', 'row_arrays'],
+    defaults=[lambda n_samples, n_groups: 0])
+
+_significance_tests = {
+    'f_oneway': _SignificanceTest(
+        shared=_pairwise_total,
+        pvalues=_f_oneway_pvalues,
+        tile_arrays=lambda n_samples: _TILE_ARRAYS),
+    'kruskal': _SignificanceTest(
+        shared=_pairwise_ranks,
+        pvalues=_kruskal_pvalues,
+        # the log ratios, their ranks and rankdata's sorting indices
+        tile_arrays=lambda n_samples: 3 * n_samples + _TILE_ARRAYS),
+    'welch': _SignificanceTest(
+        shared=lambda stats, rows, cols: stats,
+        pvalues=_welch_pvalues,
+        tile_arrays=lambda n_samples: 2 * _TILE_ARRAYS),
+    'permutation': _SignificanceTest(
+        shared=lambda stats, rows, cols: (stats,
+                                          _pairwise_total(stats, rows, cols)),
+        pvalues=_permutation_pvalues,
+        # the pairwise statistics of a batch of permutations, and the group
+        # sums of the rows and columns of the tile under the batch
+        tile_arrays=lambda n_samples: _TILE_ARRAYS + 2 * _PERMUTATION_BATCH,
+        row_arrays=lambda n_samples, n_groups: (
+            4 * n_groups * _PERMUTATION_BATCH)),
+}
+
+
+def significance_tests():
+    return list(_significance_tests.keys())
+
+
+# evaluated, the number of comparisons of each row, is only needed by the
+# adaptive computation of W.
+_Candidates = collections.namedtuple(
+    '_Candidates', ['rows', 'undefined', 'features', 'pvalues', 'evaluated'],
+    defaults=[None])
+
+
+def _tile_candidates(test, stats, groups, rows, cols, alpha):
+    """Evaluate a tile, keeping only what is needed to compute W
+
+    Only p-values below alpha can be rejected by Holm-Bonferroni, so these
+    (along with the number of undefined comparisons of each feature) are
+    all that is kept of each tile. Returns, for each grouping, a list of
+    ``_Candidates``.
+    """
+    shared = test.shared(stats, rows, cols)
+    return [_candidates(test.pvalues(shared, grouping, rows, cols),
+                        rows, cols, alpha)
+            for grouping in groups]
+
+
+def _adaptive_tile_candidates(test, stats, groups, counters, undecided,
+                              rows, cols, diagonal, alpha):
+    """Evaluate the comparisons of a tile that undecided features need
+
+    rows and cols are arrays of feature indices. Each comparison is credited
+    to those of its features that are undecided for the grouping.
+    """
+    if diagonal:
+        # every row is compared with all of the others, so each comparison
+        # of two undecided features is evaluated (and credited) twice
+        subtiles = [(rows[undecided[rows]], cols, True, False)]
+    else:
+        subtiles = [(rows[undecided[rows]], cols, True, True),
+                    (rows[~undecided[rows]], cols[undecided[cols]],
+                     False, True)]
+
+    results = [[] for _ in groups]
+    for sub_rows, sub_cols, credit_rows, credit_cols in subtiles:
+        if not len(sub_rows) or not len(sub_cols):
+            continue
+        shared = test.shared(stats, sub_rows, sub_cols)
+        for result, grouping, counter in zip(results, groups, counters):
+            pvalues = test.pvalues(shared, grouping, sub_rows, sub_cols)
+            if diagonal:
+                pvalues[sub_rows[:, None] == sub_cols[None, :]] = np.inf
+            blocks = []
+            if credit_rows:
+                blocks.append((sub_rows, pvalues))
+            if credit_cols:
+                blocks.append((sub_cols, pvalues.T))
+            for block_rows, block in blocks:
+                credited = ~counter.decided[block_rows]
+                block = block[credited]
+                i, j = np.nonzero(block < alpha)
+                result.append(_Candidates(
+                    rows=block_rows[credited],
+                    undefined=np.isnan(block).sum(axis=1),
+                    features=block_rows[credited][i],
+                    pvalues=block[i, j],
+                    # self-comparisons are inf
+                    evaluated=(block != np.inf).sum(axis=1)))
+    return results
+
+
+def _rounds(n_blocks):
+    """Yield the lists of (a, b) pairs of blocks evaluated in each round
+
+    The first round compares the first block with every block (itself
+    included). Of the other blocks, the next round compares each with
+    itself, and each later round each block with the one offset blocks
+    after it (cyclically), so that every pair of blocks is evaluated
+    exactly once.
+    """
+    yield [(0, b) for b in range(n_blocks)]
+    n_others = n_blocks - 1
+    if n_others == 0:
+        return
+    yield [(a, a) for a in range(1, n_blocks)]
+    for offset in range(1, n_others // 2 + 1):
+        if 2 * offset == n_others:
+            # a + offset + offset is a again
+            starts = range(offset)
+        else:
+            starts = range(n_others)
+        yield [(1 + a, 1 + (a + offset) % n_others) for a in starts]
+
+
+def _probe_scores(stats, groups):
+    """How strongly each feature differs between groups, as a cheap guess
+    at which features have the largest W
+
+    The score is the ratio of the between to the within-group sum of
+    squares of the feature's clr transformed log abundances, the largest
+    over the groupings. These follow from the statistics of the log
+    abundances and of the samples' (centered) mean log abundances, which
+    are subtracted by the clr transform.
+    """
+    log_matrix = stats.log_matrix
+    sample_means = np.asarray(log_matrix.mean(axis=1)).ravel()
+    sample_means -= sample_means.mean()
+    cross = np.asarray(log_matrix.T @ sample_means).ravel()
+    total = stats.total - 2 * cross + sample_means @ sample_means
+
+    scores = np.zeros(log_matrix.shape[1])
+    for grouping in groups:
+        shift = _indicator(grouping.labels) @ sample_means
+        group_sums = grouping.group_sums - shift[:, None]
+        between = np.einsum('ij,ij->j', group_sums / grouping.counts[:, None],
+                            group_sums)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = between / (total - between)
+        scores = np.fmax(scores, ratio)
+    return scores
+
+
+def _candidates(pvalues, rows, cols, alpha):
+    if rows == cols:
+        # a feature is never compared with itself
+        np.fill_diagonal(pvalues, np.inf)
+        blocks = [(rows, pvalues)]
+    else:
+        # tiles are symmetric, so only those above the diagonal are
+        # evaluated, and each contributes to the rows and columns' W
+        blocks = [(rows, pvalues), (cols, pvalues.T)]
+
+    candidates = []
+    for block_rows, block in blocks:
+        i, j = np.nonzero(block < alpha)
+        candidates.append(_Candidates(
+            rows=block_rows,
+            undefined=np.isnan(block).sum(axis=1),
+            features=i + block_rows.start,
+            pvalues=block[i, j]))
+    return candidates
+
+
+class _CandidateBuffer:
+    """The candidates of a W computation, of which at most about capacity
+    are held in memory
+
+    Candidates are held in memory until they outnumber capacity, when they
+    are spilled to temporary files, one per partition of the features. Each
+    partition has few enough features that all of their candidates (at most
+    n_features - 1 each) fit within capacity, so that W can be computed a
+    partition at a time. Spilling only happens when there are more
+    candidates than capacity, so most computations never touch the disk.
+    """
+    def __init__(self, n_features, capacity):
+        self.n_features = n_features
+        self.capacity = capacity
+        size = max(1, capacity // max(1, n_features - 1))
+        self.bounds = np.append(np.arange(0, n_features, size), n_features)
+        # the most candidates held in memory at once
+        self.peak = 0
+        self._features = []
+        self._pvalues = []
+        self._n_held = 0
+        self._directory = None
+
+    def add(self, features, pvalues):
+        self._features.append(features)
+        self._pvalues.append(pvalues)
+        self._n_held += len(features)
+        self.peak = max(self.peak, self._n_held)
+        if self._n_held > self.capacity:
+            self._spill()
+
+    def partitions(self):
+        """Yield the (start, stop, features, pvalues) of each partition of
+        the features, with its candidates sorted by ``_sort_candidates``"""
+        features, pvalues = _sort_candidates(*self._held())
+        if self._directory is None:
+            # kept sorted, so that sorting them again is cheap
+            self._features, self._pvalues = [features], [pvalues]
+            yield 0, self.n_features, features, pvalues
+            return
+        splits = np.searchsorted(features, self.bounds)
+        for p, (start, stop) in enumerate(zip(self.bounds[:-1],
+                                              self.bounds[1:])):
+            spilled = self._read(p)
+            held = slice(splits[p], splits[p + 1])
+            self.peak = max(self.peak, self._n_held + len(spilled[0]))
+            yield (start, stop,
+                   *_sort_candidates(np.concatenate([spilled[0],
+                                                     features[held]]),
+                                     np.concatenate([spilled[1],
+                                                     pvalues[held]])))
+
+    def discard(self, mask):
+        """Discard the candidates of the features where mask is True"""
+        features, pvalues = self._held()
+        keep = ~mask[features]
+        self._features, self._pvalues = [features[keep]], [pvalues[keep]]
+        self._n_held = int(keep.sum())
+        if self._directory is None:
+            return
+        for p, (start, stop) in enumerate(zip(self.bounds[:-1],
+                                              self.bounds[1:])):
+            if mask[start:stop].any():
+                features, pvalues = self._read(p)
+                keep = ~mask[features]
+                self._write(p, features[keep], pvalues[keep], 'wb')
+
+    def close(self):
+        """Remove the spilled candidates"""
+        if self._directory is not None:
+            self._directory.cleanup()
+            self._directory = None
+
+    def _held(self):
+        features = np.concatenate(self._features + [np.empty(0, dtype=int)])
+        pvalues = np.concatenate(self._pvalues + [np.empty(0)])
+        return features, pvalues
+
+    def _spill(self):
+        if self._directory is None:
+            self._directory = tempfile.TemporaryDirectory(
+                prefix='q2-composition-')
+        features, pvalues = self._held()
+        order = np.argsort(features, kind='stable')
+        features, pvalues = features[order], pvalues[order]
+        splits = np.searchsorted(features, self.bounds)
+        for p in range(len(self.bounds) - 1):
+            held = slice(splits[p], splits[p + 1])
+            if held.start < held.stop:
+                self._write(p, features[held], pvalues[held], 'ab')
+        self._features, self._pvalues = [], []
+        self._n_held = 0
+
+    def _path(self, p, name):
+        return os.path.join(self._directory.name, '%d.%s' % (p, name))
+
+    def _write(self, p, features, pvalues, mode):
+        with open(self._path(p, 'features'), mode) as fh:
+            features.astype(np.int64).tofile(fh)
+        with open(self._path(p, 'pvalues'), mode) as fh:
+            pvalues.astype(np.float64).tofile(fh)
+
+    def _read(self, p):
+        if not os.path.exists(self._path(p, 'features')):
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        return (np.fromfile(self._path(p, 'features'), dtype=np.int64),
+                np.fromfile(self._path(p, 'pvalues'), dtype=np.float64))
+
+
+class _WCounter:
+    """Accumulate, tile by tile, the candidates needed to compute W
+
+    At most about capacity candidates are held in memory (see
+    ``_CandidateBuffer``); by default, all of them are.
+    """
+    def __init__(self, n_features, alpha, capacity=None):
+        self.n_features = n_features
+        self.alpha = alpha
+        self.undefined = np.zeros(n_features, dtype=np.int64)
+        if capacity is None:
+            capacity = n_features ** 2
+        self.candidates = _CandidateBuffer(n_features, capacity)
+
+    def add(self, candidates):
+        for c in candidates:
+            self.undefined[c.rows] += c.undefined
+            self.candidates.add(c.features, c.pvalues)
+
+    def w(self):
+        w = np.empty(self.n_features, dtype=np.int64)
+        for start, stop, features, pvalues in self.candidates.partitions():
+            w[start:stop] = _holm_count(
+                features - start, pvalues, self.undefined[start:stop],
+                self.n_features - 1, self.alpha, presorted=True)
+        return w
+
+    def close(self):
+        self.candidates.close()
+
+
+class _AdaptiveWCounter(_WCounter):
+    """Also track which features' reject calls are decided
+
+    See ``adaptive_w_statistics``. A decided feature is no longer credited
+    with comparisons: its W is frozen at the lower bound it was decided
+    with, and its candidates are dropped.
+    """
+    def __init__(self, n_features, alpha, theta, capacity=None):
+        super().__init__(n_features, alpha, capacity)
+        self.theta = theta
+        self.evaluated = np.zeros(n_features, dtype=np.int64)
+        self.decided = np.zeros(n_features, dtype=bool)
+        self.frozen = np.zeros(n_features, dtype=np.int64)
+
+    def add(self, candidates):
+        super().add(candidates)
+        for c in candidates:
+            self.evaluated[c.rows] += c.evaluated
+
+    def w(self):
+        return np.where(self.decided, self.frozen, super().w())
+
+    def decide(self):
+        m = self.n_features - 1
+        unevaluated = m - self.evaluated
+        lower = np.empty(self.n_features, dtype=np.int64)
+        upper = np.empty(self.n_features, dtype=np.int64)
+        for start, stop, features, pvalues in self.candidates.partitions():
+            features = features - start
+            undefined = self.undefined[start:stop]
+            lower[start:stop] = _holm_count(features, pvalues, undefined, m,
+                                            self.alpha, presorted=True)
+            upper[start:stop] = _holm_count(
+                features, pvalues, undefined, m, self.alpha,
+                unevaluated=unevaluated[start:stop], presorted=True)
+        lower[self.decided] = self.frozen[self.decided]
+        if upper.max() < self.theta * self.n_features:
+            # ancom_reject won't reject any feature
+            decided = np.ones(self.n_features, dtype=bool)
+        else:
+            # the lowest cutoff ancom_reject can choose is that far below
+            # the largest W (relative to the number of features)
+            decided = upper < lower.max() - _CUTOFFS.max() * self.n_features
+        # features whose comparisons have all been evaluated weren't decided
+        # early, as their W is exact
+        decided &= (self.evaluated < m) & ~self.decided
+        self.frozen[decided] = lower[decided]
+        self.decided |= decided
+        self.candidates.discard(self.decided)
+
+
+def _sort_candidates(features, pvalues):
+    """Sort candidates by feature, and then by p-value"""
+    # equivalent to np.lexsort((pvalues, features)), but two stable sorts
+    # take advantage of candidates that are already (partly) sorted
+    order = np.argsort(pvalues, kind='stable')
+    order = order[np.argsort(features[order], kind='stable')]
+    return features[order], pvalues[order]
+
+
+def _holm_count(features, pvalues, undefined, m, alpha, unevaluated=None,
+                presorted=False):
+    """Count the hypotheses of each feature rejected by Holm-Bonferroni
+
+    Each feature has a family of m comparisons. Only the candidate p-values
+    (those below alpha, as all others can't be rejected) are given, as
+    parallel arrays of feature indices and p-values, along with the number
+    of undefined (NaN) comparisons of each feature.
+
+    Undefined comparisons are handled as by skbio's Holm-Bonferroni
+    implementation, which assigns them the largest adjusted p-value of the
+    family: they are counted as rejected when all of the others are.
+
+    If provided, unevaluated is the number of comparisons of each feature
+    that haven't been evaluated (and are neither candidates nor counted as
+    undefined). They are taken to have p-values of zero, so that the count
+    is an upper bound. Otherwise, the count is a lower bound, as if they
+    had p-values of one.
+
+    If presorted, the candidates are already sorted by ``_sort_candidates``.
+    """
+    n_features = len(undefined)
+    if unevaluated is None:
+        unevaluated = np.zeros(n_features, dtype=np.int64)
+    if not presorted:
+        features, pvalues = _sort_candidates(features, pvalues)
+
+    n_candidates = np.bincount(features, minlength=n_features)
+    starts = np.cumsum(n_candidates) - n_candidates
+    # the unevaluated comparisons precede all of the candidates
+    ranks = np.arange(len(features)) - starts[features] \
+        + unevaluated[features]
+
+    # each feature's count is the rank of its first candidate that isn't
+    # rejected (or the number of candidates, if all are)
+    counts = n_candidates + unevaluated
+    failed = pvalues * (m - ranks) >= alpha
+    # candidates are sorted by feature, and then by rank
+    failed_features, first = np.unique(features[failed], return_index=True)
+    counts[failed_features] = ranks[failed][first]
+
+    n_defined = m - undefined
+    return np.where(counts == n_defined, counts + undefined, counts)
@@ -5,12 +5,21 @@
 #
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import subprocess
+import sys
 import tempfile
+import threading
+import time
+import numpy as np
 import pandas as pd
 import os
 import json
+import re
 import formulaic
+import scipy.io
+import scipy.sparse
 
 import qiime2
 from qiime2.metadata import NumericMetadataColumn, CategoricalMetadataColumn
@@ -32,11 +41,176 @@ def run_commands(cmds, verbose=True):
         subprocess.run(cmd, check=True)
 
 
+# The ANCOM-BC worker is opt-in: if this is set (to 1, true or yes), R and its
+# libraries are loaded once, by a worker process that then runs every
+# ancombc call of this Python process, rather than once per call.
+WORKER_VARIABLE = 'Q2_COMPOSITION_ANCOMBC_WORKER'
+# The number of seconds that the worker may be idle before it is stopped.
+WORKER_TIMEOUT_VARIABLE = 'Q2_COMPOSITION_ANCOMBC_WORKER_TIMEOUT'
+_DEFAULT_WORKER_TIMEOUT = 300
+
+
+class RWorker:
+    """A long-lived ``run_ancombc.R --worker`` process
+
+    Each request is the script's options, as a JSON object on a line of the
+    worker's stdin, and is answered by a JSON line on its stdout once the
+    fit is done (anything else the worker prints goes to stderr). The worker
+    is started by the first request, and replaced by the next request if it
+    dies (e.g., if R crashes). It is stopped, by closing its stdin, once it
+    has been idle for idle_timeout seconds, and when Python exits.
+    """
+    command = ['run_ancombc.R', '--worker']
+
+    def __init__(self, idle_timeout=_DEFAULT_WORKER_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._process = None
+        self._last_used = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls):
+        """The worker configured by the environment, or None"""
+        enabled = os.environ.get(WORKER_VARIABLE, '')
+        if enabled.lower() not in ('1', 'true', 'yes'):
+            return None
+        timeout = float(os.environ.get(WORKER_TIMEOUT_VARIABLE,
+                                       _DEFAULT_WORKER_TIMEOUT))
+        return cls(timeout)
+
+    def run(self, options):
+        """Run the script with options (a dict of strings) in the worker
+
+        Raises subprocess.CalledProcessError if the fit fails (with R's
+        error message as its stderr), or the worker dies while running it.
+        """
+        with self._lock:
+            try:
+                response = self._request(options)
+            finally:
+                self._last_used = time.monotonic()
+                self._schedule_stop(self.idle_timeout)
+        if response['status'] != 'ok':
+            raise subprocess.CalledProcessError(
+                1, self.command, stderr=response.get('message'))
+
+    def close(self):
+        """Stop the worker, if it is running"""
+        with self._lock:
+            self._stop()
+
+    def _request(self, options):
+        self._send(json.dumps(options) + '\n')
+        try:
+            for line in self._process.stdout:
+                try:
+                    response = json.loads(line)
+                except ValueError:
+                    response = None
+                if isinstance(response, dict) and 'status' in response:
+                    return response
+                # e.g., printed by R before the worker redirected its output
+                sys.stdout.write(line)
+        except OSError:
+            pass
+        # the worker died: the next request starts another
+        process = self._discard()
+        raise subprocess.CalledProcessError(process.returncode, self.command)
+
+    def _send(self, request):
+        """Send a request to the worker, first starting one if there is none
+        or it has exited
+
+        A worker can also die between requests (e.g., killed while idle)
+        without having exited yet, so that the request can't be written: it
+        is then sent to a new worker.
+        """
+        for _ in range(2):
+            if self._process is None or self._process.poll() is not None:
+                if self._process is not None:
+                    self._discard()
+                self._process = subprocess.Popen(
+                    self.command, stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE, text=True, bufsize=1)
+            try:
+                self._process.stdin.write(request)
+                self._process.stdin.flush()
+                return
+            except OSError:
+                process = self._discard()
+        raise subprocess.CalledProcessError(process.returncode, self.command)
+
+    def _discard(self):
+        """Stop the worker, which is no longer usable, and return it"""
+        process, self._process = self._process, None
+        self._close(process)
+        return process
+
+    def _schedule_stop(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self._stop_if_idle)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _stop_if_idle(self):
+        with self._lock:
+            idle = time.monotonic() - self._last_used
+            if idle >= self.idle_timeout:
+                self._stop()
+            else:
+                # used since this was scheduled
+                self._schedule_stop(self.idle_timeout - idle)
+
+    def _stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._process is not None:
+            self._discard()
+
+    @staticmethod
+    def _close(process):
+        try:
+            # the worker exits at the end of its stdin
+            process.stdin.close()
+            process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            process.kill()
+            process.wait()
+        process.stdout.close()
+
+
+_workers = []
+_worker_lock = threading.Lock()
+
+
+def _get_workers(n_workers):
+    """n_workers workers of this process, if they are configured, or None
+
+    The workers are started as they are first needed, and are then reused by
+    later calls.
+    """
+    with _worker_lock:
+        if RWorker.from_environment() is None:
+            # disabled since they were started
+            for worker in _workers:
+                worker.close()
+            _workers.clear()
+            return None
+        while len(_workers) < n_workers:
+            worker = RWorker.from_environment()
+            atexit.register(worker.close)
+            _workers.append(worker)
+        return _workers[:n_workers]
+
+
 def ancombc(table: pd.DataFrame, metadata: qiime2.Metadata, formula: str,
             p_adj_method: str = 'holm', prv_cut: float = 0.1, lib_cut: int = 0,
             reference_levels: str = None,
             tol: float = 1e-05, max_iter: int = 100, conserve: bool = False,
-            alpha: float = 0.05) -> DataLoafPackageDirFmt:
+            alpha: float = 0.05, n_jobs: int = 1) -> DataLoafPackageDirFmt:
 
     return _ancombc(
         table=table,
@@ -50,6 +224,31 @@ def ancombc(table: pd.DataFrame, metadata: qiime2.Metadata, formula: str,
         max_iter=max_iter,
         conserve=conserve,
         alpha=alpha,
+        n_jobs=n_jobs,
+    )
+
+
+def ancombc_batch(table: pd.DataFrame, metadata: qiime2.Metadata,
+                  formulas: list, p_adj_method: str = 'holm',
+                  prv_cut: float = 0.1, lib_cut: int = 0,
+                  reference_levels: list = None,
+                  tol: float = 1e-05, max_iter: int = 100,
+                  conserve: bool = False, alpha: float = 0.05,
+                  n_jobs: int = 1) -> DataLoafPackageDirFmt:
+
+    return _ancombc_batch(
+        table=table,
+        metadata=metadata,
+        formulas=formulas,
+        p_adj_method=p_adj_method,
+        prv_cut=prv_cut,
+        lib_cut=lib_cut,
+        reference_levels=reference_levels,
+        tol=tol,
+        max_iter=max_iter,
+        conserve=conserve,
+        alpha=alpha,
+        n_jobs=n_jobs,
     )
 
 
@@ -83,39 +282,88 @@ def _get_ref_level_defaults_from_formula_terms(metadata, term,
     return reference_levels
 
 
-def _ancombc(table, metadata, formula, p_adj_method, prv_cut, lib_cut,
-             reference_levels, tol, max_iter, conserve, alpha):
-
-    meta = metadata.to_dataframe()
-    # rename index to sample-id before export to R
-    meta = meta.rename_axis('sample-id', axis=0)
-
-    md_column_types = {}
-    for name, attrs in metadata.columns.items():
-        # MetadataColumn type
-        if attrs[0] == 'numeric':
-            md_column_types[name] = 'numeric'
-        elif attrs[0] == 'categorical':
-            md_column_types[name] = 'categorical'
-        # deadman switch in case we ever add any other md column types
-        else:
-            raise TypeError('Unexpected MetadataColumn type: "%s"'
-                            ' Expected types are either "categorical" or'
-                            ' "numeric".' % attrs[0])
-
-    md_column_types_json = json.dumps(md_column_types)
-
-    # error on IDs found in table but not in metadata
-    missing_ids = table.index.difference(meta.index).values
-
-    if missing_ids.size > 0:
-        raise KeyError('Not all samples present within the table were found in'
-                       ' the associated metadata file. Please make sure that'
-                       ' all samples in the FeatureTable are also present in'
-                       ' the metadata.'
-                       ' Sample IDs not found in the metadata: %s'
-                       % missing_ids)
-
+def _prefilter(table, prv_cut, lib_cut):
+    """Drop the features and samples that ANCOM-BC would exclude anyway
+
+    ANCOM-BC excludes the features with a prevalence (the fraction of
+    samples in which they are nonzero) below prv_cut, and then the samples
+    with a library size (their total, of the remaining features) below
+    lib_cut. Dropping these before exporting the table only saves writing
+    and parsing them if ANCOM-BC's own filters, re-applied to the smaller
+    table, exclude exactly the rest of what they would have. So a feature
+    is only dropped if it is excluded by both of ANCOM-BC's formulations of
+    the prevalence cut (see ``_prevalence_cuts``), and a sample if its
+    library size, of all of its features, is below lib_cut. Samples are
+    only dropped if that doesn't change the prevalence cut of any remaining
+    feature, which is computed before samples are excluded.
+
+    Returns the filtered table, and the ids of the dropped features and
+    samples.
+    """
+    values = table.values
+    present = values != 0
+
+    keep_features = ~np.logical_and(*_prevalence_cuts(present, prv_cut))
+    keep_samples = ~(values.sum(axis=1) < lib_cut)
+    if not keep_samples.all():
+        present = present[:, keep_features]
+        for before, after in zip(
+                _prevalence_cuts(present, prv_cut),
+                _prevalence_cuts(present[keep_samples], prv_cut)):
+            if (before != after).any():
+                keep_samples[:] = True
+
+    return (table.loc[keep_samples, keep_features],
+            table.columns[~keep_features], table.index[~keep_samples])
+
+
+def _prevalence_cuts(present, prv_cut):
+    # Versions of ANCOM-BC have excluded features either by their prevalence
+    # or by their fraction of zeros (each computed as it is here), which can
+    # disagree at the cut, e.g., for a prevalence of exactly prv_cut
+    prevalence = present.sum(axis=0) / present.shape[0]
+    zeros = (~present).sum(axis=0) / present.shape[0]
+    return prevalence < prv_cut, zeros >= 1 - prv_cut
+
+
+def _write_table(table, temp_dir_name):
+    """Write the table for run_ancombc.R, returning the script's options
+
+    The table is written as a Matrix Market file of its nonzero entries,
+    already transposed to the (features x samples) layout of a phyloseq
+    OTU table, with its feature and sample IDs listed one per line in
+    separate files. This is a small fraction of the size of a TSV of a
+    sparse table, and R neither parses the zeros nor copies the table to
+    transpose it.
+    """
+    paths = {'inp_abundances_path': 'input.abundances.mtx',
+             'inp_feature_ids_path': 'input.feature-ids.txt',
+             'inp_sample_ids_path': 'input.sample-ids.txt'}
+    paths = {name: os.path.join(temp_dir_name, fn)
+             for name, fn in paths.items()}
+
+    values = table.values
+    if np.issubdtype(values.dtype, np.floating) and \
+            np.array_equal(values, np.round(values)):
+        # counts are written as integers, rather than as (longer) reals
+        values = values.astype(np.int64)
+    scipy.io.mmwrite(paths['inp_abundances_path'],
+                     scipy.sparse.coo_matrix(values.T))
+
+    for name, ids in (('inp_feature_ids_path', table.columns),
+                      ('inp_sample_ids_path', table.index)):
+        with open(paths[name], 'w', encoding='utf-8', newline='\n') as fh:
+            fh.writelines('%s\n' % id_ for id_ in ids)
+    return paths
+
+
+def _validate_reference_levels(table, metadata, meta, formula,
+                               reference_levels):
+    """Validate the formula and reference levels of a fit
+
+    Returns the reference levels, including the default of each term of the
+    formula that isn't provided.
+    """
     # column validation for the formula parameter
     formula_terms = _parse_terms(formula=formula)
     for term in formula_terms:
@@ -226,36 +474,199 @@ def _ancombc(table, metadata, formula, p_adj_method, prv_cut, lib_cut,
                     metadata=metadata, term=term,
                     reference_levels=reference_levels)
 
+    return reference_levels
+
+
+def _ancombc(table, metadata, formula, p_adj_method, prv_cut, lib_cut,
+             reference_levels, tol, max_iter, conserve, alpha, n_jobs=1):
+    return _ancombc_fits(table=table, metadata=metadata,
+                         fits=[(formula, reference_levels)],
+                         p_adj_method=p_adj_method, prv_cut=prv_cut,
+                         lib_cut=lib_cut, tol=tol, max_iter=max_iter,
+                         conserve=conserve, alpha=alpha, n_jobs=n_jobs)[0]
+
+
+def _ancombc_batch(table, metadata, formulas, p_adj_method, prv_cut, lib_cut,
+                   reference_levels, tol, max_iter, conserve, alpha,
+                   n_jobs=1):
+    """Fit ANCOM-BC with each of formulas, returning a DataLoaf per formula
+
+    Each of reference_levels applies to the formulas with a term of its
+    column; formulas without any use the defaults, as by ``ancombc``. The
+    DataLoaves are keyed as by ``_collection_keys``.
+    """
+    if len(set(formulas)) != len(formulas):
+        raise ValueError('Each `formula` may only be provided once.')
+
+    fits = []
+    used_levels = set()
+    for formula in formulas:
+        levels = None
+        if reference_levels is not None:
+            terms = _parse_terms(formula=formula)
+            # pairs without a separator are left to fail validation
+            levels = [level for level in reference_levels
+                      if '::' not in level or level.split('::')[0] in terms]
+            used_levels.update(levels)
+        fits.append((formula, levels or None))
+
+    for level in reference_levels or []:
+        if level not in used_levels:
+            raise ValueError('`reference_levels` column "%s" was not found'
+                             ' within the terms of any `formula`.'
+                             % level.split('::')[0])
+
+    output_loafs = _ancombc_fits(table=table, metadata=metadata, fits=fits,
+                                 p_adj_method=p_adj_method, prv_cut=prv_cut,
+                                 lib_cut=lib_cut, tol=tol, max_iter=max_iter,
+                                 conserve=conserve, alpha=alpha,
+                                 n_jobs=n_jobs)
+    return dict(zip(_collection_keys(formulas), output_loafs))
+
+
+def _collection_keys(formulas):
+    """The keys of the collection output by ancombc_batch, one per formula
+
+    A formula (e.g., "a + b") isn't a valid key, so each run of characters
+    other than letters, digits, "-" and "_" is replaced by "_" (e.g., "a_b").
+    Formulas whose keys would then be the same are told apart by their
+    position. The formula itself is recorded in each DataLoaf's metadata.
+    """
+    keys = []
+    for i, formula in enumerate(formulas, start=1):
+        key = re.sub(r'[^A-Za-z0-9_-]+', '_', formula).strip('_') or 'formula'
+        while key in keys:
+            key = '%s-%d' % (key, i)
+        keys.append(key)
+    return keys
+
+
+def _split_jobs(n_jobs, n_fits):
+    """Split n_fits fits, and n_jobs cores, between R processes
+
+    Returns the indices of the fits, and the number of cores, of each
+    process. There are up to n_jobs processes, to which the fits are
+    assigned in turn, and each uses its cores through ANCOM-BC's own
+    cluster (its n_cl). The cores are shared as equally as possible, and
+    add up to n_jobs, so that a call never uses more.
+
+    Processes are either started for the call, or are persistent workers
+    (see ``_get_workers``). A worker runs one request at a time, so calls
+    that share it wait for each other, rather than together using more
+    cores than either asked for.
+    """
+    n_processes = min(n_jobs, n_fits)
+    return [(list(range(i, n_fits, n_processes)),
+             n_jobs // n_processes + (i < n_jobs % n_processes))
+            for i in range(n_processes)]
+
+
+def _ancombc_fits(table, metadata, fits, p_adj_method, prv_cut, lib_cut,
+                  tol, max_iter, conserve, alpha, n_jobs=1, verbose=True):
+    """Fit ANCOM-BC with each (formula, reference_levels) pair of fits
+
+    The table and metadata are validated, filtered and exported once. The
+    fits and the n_jobs cores are then split between up to n_jobs R
+    processes (see ``_split_jobs``), which are run concurrently and each
+    load the exported data once. Returns the DataLoaf of each fit.
+    If verbose, what was dropped by ``_prefilter`` and the commands that are
+    run are printed, as by ``run_commands``.
+    """
+    meta = metadata.to_dataframe()
+    # rename index to sample-id before export to R
+    meta = meta.rename_axis('sample-id', axis=0)
+
+    md_column_types = {}
+    for name, attrs in metadata.columns.items():
+        # MetadataColumn type
+        if attrs[0] == 'numeric':
+            md_column_types[name] = 'numeric'
+        elif attrs[0] == 'categorical':
+            md_column_types[name] = 'categorical'
+        # deadman switch in case we ever add any other md column types
+        else:
+            raise TypeError('Unexpected MetadataColumn type: "%s"'
+                            ' Expected types are either "categorical" or'
+                            ' "numeric".' % attrs[0])
+
+    md_column_types_json = json.dumps(md_column_types)
+
+    # error on IDs found in table but not in metadata
+    missing_ids = table.index.difference(meta.index).values
+
+    if missing_ids.size > 0:
+        raise KeyError('Not all samples present within the table were found in'
+                       ' the associated metadata file. Please make sure that'
+                       ' all samples in the FeatureTable are also present in'
+                       ' the metadata.'
+                       ' Sample IDs not found in the metadata: %s'
+                       % missing_ids)
+
+    fits = [(formula,
+             _validate_reference_levels(table, metadata, meta, formula,
+                                        reference_levels))
+            for formula, reference_levels in fits]
+
+    table, dropped_features, dropped_samples = _prefilter(table, prv_cut,
+                                                          lib_cut)
+    if verbose and (len(dropped_features) or len(dropped_samples)):
+        print('%d features and %d samples, which ANCOM-BC would exclude (by'
+              ' prv_cut and lib_cut), were dropped before running it.'
+              % (len(dropped_features), len(dropped_samples)))
+
     with tempfile.TemporaryDirectory() as temp_dir_name:
-        biom_fp = os.path.join(temp_dir_name, 'input.biom.tsv')
         meta_fp = os.path.join(temp_dir_name, 'input.map.txt')
 
-        table.to_csv(biom_fp, sep='\t', header=True)
+        table_options = _write_table(table, temp_dir_name)
         meta.to_csv(meta_fp, sep='\t', header=True)
 
-        output_loaf = DataLoafPackageDirFmt()
-
-        cmd = ['run_ancombc.R',
-               '--inp_abundances_path', biom_fp,
-               '--inp_metadata_path', meta_fp,
-               '--md_column_types', md_column_types_json,
-               '--formula', str(formula),
-               '--p_adj_method', p_adj_method,
-               '--prv_cut', str(prv_cut),
-               '--lib_cut', str(lib_cut),
-               '--reference_levels', str(reference_levels),
-               '--tol', str(tol),
-               '--max_iter', str(max_iter),
-               '--conserve', str(conserve),
-               '--alpha', str(alpha),
-               '--output_loaf', str(output_loaf)
-               ]
+        output_loafs = [DataLoafPackageDirFmt() for _ in fits]
+
+        jobs = _split_jobs(n_jobs, len(fits))
+        n_processes = len(jobs)
+        options = {**table_options,
+                   'inp_metadata_path': meta_fp,
+                   'md_column_types': md_column_types_json,
+                   'p_adj_method': p_adj_method,
+                   'prv_cut': str(prv_cut),
+                   'lib_cut': str(lib_cut),
+                   'tol': str(tol),
+                   'max_iter': str(max_iter),
+                   'conserve': str(conserve),
+                   'alpha': str(alpha)}
+        requests = []
+        for indices, n_cl in jobs:
+            requests.append({**options, 'n_cl': str(n_cl), 'fits': json.dumps([
+                {'formula': str(fits[i][0]),
+                 'reference_levels': str(fits[i][1]),
+                 'output_loaf': str(output_loafs[i])}
+                for i in indices])})
+
+        workers = _get_workers(n_processes)
+
+        def run(i):
+            if workers is None:
+                cmd = ['run_ancombc.R']
+                for name, value in requests[i].items():
+                    cmd.extend(['--' + name, value])
+                run_commands([cmd], verbose=verbose)
+            else:
+                workers[i].run(requests[i])
 
         try:
-            run_commands([cmd])
+            if n_processes == 1:
+                run(0)
+            else:
+                with ThreadPoolExecutor(max_workers=n_processes) as executor:
+                    # list() re-raises the first error of any process
+                    list(executor.map(run, range(n_processes)))
         except subprocess.CalledProcessError as e:
-            raise Exception('An error was encountered while running ANCOM-BC'
-                            ' in R (return code %d), please inspect stdout and'
-                            ' stderr to learn more.' % e.returncode)
-
-        return output_loaf
+            message = ('An error was encountered while running ANCOM-BC in R'
+                       ' (return code %d), please inspect stdout and stderr'
+                       ' to learn more.' % e.returncode)
+            # a worker reports R's error message as the error's stderr
+            if e.stderr:
+                message += ' R reported: %s' % e.stderr
+            raise Exception(message)
+
+        return output_loafs
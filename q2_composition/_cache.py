@@ -0,0 +1,135 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+# Caching is opt-in: results are only cached if this names a directory (which
+# is created if necessary).
+CACHE_DIR_VARIABLE = 'Q2_COMPOSITION_CACHE_DIR'
+# The size, in megabytes, that the cache directory is kept within by evicting
+# its least recently used entries.
+CACHE_SIZE_VARIABLE = 'Q2_COMPOSITION_CACHE_SIZE'
+_DEFAULT_CACHE_SIZE = 1024
+
+_SUFFIX = '.npz'
+
+
+class ResultCache:
+    """A directory of arrays, keyed by content hashes, with LRU eviction
+
+    Each entry is a single .npz file, named by its key. Entries are written
+    atomically, so that concurrent runs sharing a cache never read a partial
+    entry. Reading an entry updates its modification time, which is what
+    entries are evicted by (oldest first) when the cache outgrows max_bytes.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_environment(cls):
+        """The cache configured by the environment, or None"""
+        directory = os.environ.get(CACHE_DIR_VARIABLE)
+        if not directory:
+            return None
+        size = float(os.environ.get(CACHE_SIZE_VARIABLE,
+                                    _DEFAULT_CACHE_SIZE))
+        return cls(directory, int(size * 2 ** 20))
+
+    def get(self, key):
+        """The arrays stored under key, or None if there aren't any"""
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (OSError, ValueError):
+            # missing, evicted while being read, or unreadable
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return arrays
+
+    def put(self, key, arrays):
+        """Store a dict of arrays under key, then evict as necessary"""
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                np.savez(fh, **arrays)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + _SUFFIX)
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(_SUFFIX):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # already evicted by a concurrent run
+                pass
+            total -= size
+
+
+def content_key(*parts):
+    """A hex digest of strings, numbers, arrays and (nested) tuples of them
+    """
+    digest = hashlib.sha256()
+    _update(digest, parts)
+    return digest.hexdigest()
+
+
+def table_key(table):
+    """A hex digest of the contents (ids and values) of a biom Table"""
+    matrix = table.matrix_data.tocsr()
+    matrix.sum_duplicates()
+    matrix.sort_indices()
+    return content_key(
+        tuple(table.ids()), tuple(table.ids(axis='observation')),
+        matrix.shape, matrix.data.astype(np.float64),
+        matrix.indices.astype(np.int64), matrix.indptr.astype(np.int64))
+
+
+def _update(digest, part):
+    # each part is tagged with its type and length, so that different
+    # sequences of parts never produce the same stream of bytes
+    if isinstance(part, (tuple, list)):
+        digest.update(b'T%d;' % len(part))
+        for p in part:
+            _update(digest, p)
+    elif isinstance(part, np.ndarray):
+        part = np.ascontiguousarray(part)
+        digest.update(b'A%s%r;%d;' % (part.dtype.str.encode(), part.shape,
+                                      part.nbytes))
+        digest.update(part.data)
+    else:
+        data = repr(part).encode('utf8')
+        digest.update(b'S%d;' % len(data))
+        digest.update(data)
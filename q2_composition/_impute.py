@@ -6,18 +6,191 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+from datetime import datetime
+
 import biom
+import h5py
+import numpy as np
+
+import qiime2
+from q2_types.feature_table import BIOMV210Format
+
+from ._ancom_stats import _BLOCK_ENTRIES
 
 
 def add_pseudocount(table: biom.Table,
-                    pseudocount: int = 1) -> biom.Table:
-    # This is ugly, and it requires a sparse and dense representation to
-    # be in memory at the same time, but biom.Table.transform only operates
-    # on non-zero values, so it isn't useful here (as we need to operate on
-    # all values).
-    result = biom.Table(
-        [v + pseudocount
-         for v in table.iter_data(dense=True, axis='observation')],
-        table.ids(axis='observation'),
-        table.ids())
+                    pseudocount: float = 1,
+                    dtype: str = 'float64',
+                    block_size: int = None) -> BIOMV210Format:
+    # biom.Table.transform only operates on non-zero values, so it isn't
+    # useful here (as we need to operate on all values). The (necessarily
+    # dense) result is instead streamed straight into the output file, one
+    # block at a time, so only a single dense block is ever held in memory.
+    result = BIOMV210Format()
+    with h5py.File(str(result), 'w') as fh:
+        _write_dense_hdf5(fh, table, pseudocount, dtype, block_size)
+    return result
+
+
+def add_scaled_pseudocount(table: biom.Table,
+                           pseudocount: float = 1,
+                           dtype: str = 'float64',
+                           block_size: int = None) -> BIOMV210Format:
+    depths = _sample_depths(table)
+    # each sample receives a pseudocount proportional to its depth, so that
+    # the imputed values are comparable across samples in relative terms
+    fill = pseudocount * depths / np.median(depths)
+
+    result = BIOMV210Format()
+    with h5py.File(str(result), 'w') as fh:
+        _write_dense_hdf5(fh, table, fill, dtype, block_size)
+    return result
+
+
+def multiplicative_replacement(table: biom.Table,
+                               delta: float = None,
+                               dtype: str = 'float64',
+                               block_size: int = None) -> BIOMV210Format:
+    depths = _sample_depths(table)
+    n_observations = table.shape[0]
+    if delta is None:
+        delta = (1 / n_observations) ** 2
+
+    dtype = np.dtype(dtype)
+    matrix = table.matrix_data.astype(dtype).tocsr()
+    matrix.eliminate_zeros()
+    matrix.sum_duplicates()
+
+    n_zeros = n_observations - np.bincount(matrix.indices,
+                                           minlength=table.shape[1])
+    remainder = 1 - delta * n_zeros
+    if (remainder <= 0).any():
+        raise ValueError('`delta` is too large: replacing all zeros with '
+                         '%r leaves no mass for the non-zero values of at '
+                         'least one sample.' % delta)
+
+    # Zeros are replaced by delta, and the non-zero values of each sample are
+    # closed and rescaled by that sample's remainder. Only the non-zero
+    # values need to be touched here: they are stored relative to delta,
+    # which is filled in for every entry as the output is written.
+    scale = (remainder / depths).astype(dtype)
+    matrix.data *= scale[matrix.indices]
+    matrix.data -= dtype.type(delta)
+
+    result = BIOMV210Format()
+    with h5py.File(str(result), 'w') as fh:
+        _write_dense_hdf5(fh, table, delta, dtype, block_size, matrix=matrix)
     return result
+
+
+def _sample_depths(table):
+    depths = table.sum(axis='sample')
+    if (depths <= 0).any():
+        empty = table.ids()[depths <= 0]
+        raise ValueError('Zeros cannot be replaced in samples that contain '
+                         'no observations. Empty samples: %s'
+                         % ', '.join(empty))
+    return depths
+
+
+def _write_dense_hdf5(h5grp, table, fill, dtype='float64', block_size=None,
+                      matrix=None):
+    """Write table, with fill added to every entry, as a dense BIOM v2.1 file
+
+    fill is either a scalar or one value per sample. If provided, the sparse
+    values in matrix are added to fill in place of the table's own values;
+    the table then only supplies the ids and the shape.
+
+    The layout mirrors biom.Table.to_hdf5: the matrix is stored once in CSR
+    order under "observation" and once in CSC order under "sample". Both are
+    written incrementally from the sparse input, one block of rows (i.e.,
+    observations or samples, respectively) at a time. All arithmetic is
+    performed in dtype, which is also the dtype of the stored values.
+    """
+    n_observations, n_samples = table.shape
+    n_entries = n_observations * n_samples
+
+    h5grp.attrs['id'] = table.table_id if table.table_id else 'No Table ID'
+    h5grp.attrs['type'] = table.type if table.type else ''
+    h5grp.attrs['format-url'] = 'http://biom-format.org'
+    h5grp.attrs['format-version'] = (2, 1)
+    h5grp.attrs['generated-by'] = 'qiime2 %s' % qiime2.__version__
+    h5grp.attrs['creation-date'] = datetime.now().isoformat()
+    h5grp.attrs['shape'] = (n_observations, n_samples)
+    h5grp.attrs['nnz'] = n_entries
+
+    dtype = np.dtype(dtype)
+    if matrix is None:
+        matrix = table.matrix_data
+    matrix = matrix.astype(dtype, copy=False).tocsr()
+    # the block fill below relies on there being no duplicate entries
+    matrix.sum_duplicates()
+    fill = np.asarray(fill, dtype=dtype)
+
+    # the CSC representation of the table is the CSR representation of its
+    # transpose, so both axes can be written by the same code. Per-sample
+    # fill values run along the columns of the former and the rows of the
+    # latter.
+    for axis, rows, row_fill in (
+            ('observation', matrix, fill.reshape(1, -1)),
+            ('sample', matrix.tocsc().T, fill.reshape(-1, 1))):
+        grp = h5grp.create_group(axis)
+        grp.create_group('metadata')
+        grp.create_group('group-metadata')
+        _write_ids(grp, table.ids(axis=axis))
+        _write_dense_matrix(grp.create_group('matrix'), rows,
+                            np.broadcast_to(row_fill, rows.shape), dtype,
+                            block_size)
+
+
+def _write_ids(grp, ids):
+    if len(ids) > 0:
+        grp.create_dataset('ids', shape=(len(ids),),
+                           dtype=h5py.special_dtype(vlen=str),
+                           data=[i.encode('utf8') for i in ids],
+                           compression='gzip')
+    else:
+        # empty variable length string datasets are not supported
+        grp.create_dataset('ids', shape=(0,), data=[])
+
+
+def _write_dense_matrix(grp, matrix, fill, dtype, block_size=None):
+    n_rows, n_cols = matrix.shape
+    n_entries = n_rows * n_cols
+    if block_size is None:
+        block_size = _BLOCK_ENTRIES // max(1, n_cols)
+    block_size = max(1, min(block_size, n_rows))
+
+    compression = 'gzip' if n_entries > 0 else None
+    data = grp.create_dataset('data', shape=(n_entries,), dtype=dtype,
+                              compression=compression)
+    indices = grp.create_dataset('indices', shape=(n_entries,),
+                                 dtype=np.int32, compression=compression)
+    indptr_dtype = np.int32 if n_entries <= np.iinfo(np.int32).max \
+        else np.int64
+    grp.create_dataset('indptr',
+                       data=np.arange(n_rows + 1, dtype=indptr_dtype) * n_cols,
+                       compression=compression)
+
+    buffer = np.empty((block_size, n_cols), dtype=dtype)
+    block_indices = np.tile(np.arange(n_cols, dtype=np.int32), block_size)
+    for start in range(0, n_rows, block_size):
+        stop = min(start + block_size, n_rows)
+        block = buffer[:stop - start]
+        _fill_block(block, matrix, start, stop, fill)
+        data[start * n_cols:stop * n_cols] = block.ravel()
+        indices[start * n_cols:stop * n_cols] = \
+            block_indices[:block.size]
+
+
+def _fill_block(block, matrix, start, stop, fill):
+    """Densify rows start:stop of a CSR matrix into block, adding fill
+
+    fill must have the same shape as matrix (it is typically a broadcast
+    view of a scalar or of a single row or column).
+    """
+    indptr = matrix.indptr[start:stop + 1]
+    lo, hi = indptr[0], indptr[-1]
+    rows = np.repeat(np.arange(stop - start), np.diff(indptr))
+    block[...] = fill[start:stop]
+    block[rows, matrix.indices[lo:hi]] += matrix.data[lo:hi]
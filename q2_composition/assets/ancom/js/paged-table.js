@@ -0,0 +1,78 @@
+// Render a table one page of rows at a time, rather than all of its rows at
+// once. The table is loaded from a JSON file as written by pandas'
+// DataFrame.to_json(orient='split'), with the names of the column index
+// levels added as "names". Rows can be filtered by their index (e.g., the
+// feature id).
+function pagedTable(container, url, pageSize) {
+  pageSize = pageSize || 25;
+  container = $(container);
+
+  $.getJSON(url).done(function(table) {
+    var rows = table.index.map(function(id, i) { return i; });
+    var page = 0;
+
+    // one header row per level of the column index
+    var multiLevel = table.names.length > 1;
+    var thead = $('<thead>');
+    table.names.forEach(function(name, level) {
+      var tr = $('<tr>').append($('<th>').text(name === null ? '' : name));
+      table.columns.forEach(function(column) {
+        tr.append($('<th>').text(multiLevel ? column[level] : column));
+      });
+      thead.append(tr);
+    });
+    var tbody = $('<tbody>');
+
+    var filter = $('<input type="search" class="form-control" placeholder="Filter by id">');
+    var info = $('<span class="paged-table-info">');
+    var prev = $('<button type="button" class="btn btn-default">Previous</button>');
+    var next = $('<button type="button" class="btn btn-default">Next</button>');
+
+    function render() {
+      var nPages = Math.max(1, Math.ceil(rows.length / pageSize));
+      page = Math.min(page, nPages - 1);
+      var start = page * pageSize;
+      var stop = Math.min(start + pageSize, rows.length);
+
+      tbody.empty();
+      rows.slice(start, stop).forEach(function(i) {
+        var tr = $('<tr>').append($('<th>').text(table.index[i]));
+        table.data[i].forEach(function(value) {
+          tr.append($('<td>').text(value === null ? 'NaN' : value));
+        });
+        tbody.append(tr);
+      });
+
+      info.text(rows.length ? 'Rows ' + (start + 1) + '-' + stop + ' of ' +
+                rows.length : 'No matching rows');
+      prev.prop('disabled', page === 0);
+      next.prop('disabled', page >= nPages - 1);
+    }
+
+    filter.on('input', function() {
+      var query = this.value.toLowerCase();
+      rows = [];
+      table.index.forEach(function(id, i) {
+        if (String(id).toLowerCase().indexOf(query) !== -1) {
+          rows.push(i);
+        }
+      });
+      page = 0;
+      render();
+    });
+    prev.on('click', function() { page -= 1; render(); });
+    next.on('click', function() { page += 1; render(); });
+
+    container.empty().append(
+      filter,
+      $('<table class="table table-striped table-hover">').append(thead, tbody),
+      $('<div class="btn-group">').append(prev, next),
+      ' ', info);
+    render();
+  }).fail(function() {
+    container.empty().append(
+      $('<p class="alert alert-danger">').text(
+        'Unable to load ' + url + '. Paged tables must be viewed through ' +
+        'a web server (e.g., QIIME 2 View), rather than opened as a file.'));
+  });
+}
@@ -10,7 +10,7 @@ import importlib
 
 import numpy as np
 
-from qiime2.plugin import (Int, Float, Bool, Str, List,
+from qiime2.plugin import (Int, Float, Bool, Str, List, Collection,
                            Choices, Citations, Plugin, Metadata,
                            MetadataColumn, Categorical, Range)
 from q2_types.feature_table import FeatureTable, Frequency, Composition
@@ -41,16 +41,31 @@ plugin.register_formats(FrictionlessCSVFileFormat, DataPackageSchemaFileFormat,
 plugin.register_semantic_type_to_format(FeatureData[DifferentialAbundance],
                                         DataLoafPackageDirFmt)
 
+# How the tables output by add_pseudocount, add_scaled_pseudocount and
+# multiplicative_replacement are written
+_output_parameters = {'dtype': Str % Choices(['float64', 'float32']),
+                      'block_size': Int % Range(1, None)}
+_output_parameter_descriptions = {
+    'dtype': 'The floating point precision of the resulting table. float32 '
+             'halves the size of the output at the cost of precision.',
+    'block_size': 'The number of features (or samples) that are densified '
+                  'and written to the output at a time. Smaller values '
+                  'reduce peak memory use. By default, this is chosen based '
+                  'on the number of samples (or features) in the table.'
+}
+
 plugin.methods.register_function(
     function=q2_composition.add_pseudocount,
     inputs={'table': FeatureTable[Frequency]},
-    parameters={'pseudocount': Int},
+    parameters={'pseudocount': Float,
+                **_output_parameters},
     outputs=[('composition_table', FeatureTable[Composition])],
     input_descriptions={
         'table': 'The feature table to which pseudocounts should be added.'
     },
     parameter_descriptions={
-        'pseudocount': 'The value to add to all counts in the feature table.'
+        'pseudocount': 'The value to add to all counts in the feature table.',
+        **_output_parameter_descriptions
     },
     output_descriptions={
         'composition_table': 'The resulting feature table.'
@@ -59,17 +74,174 @@ plugin.methods.register_function(
     description='Increment all counts in table by pseudocount.'
 )
 
+plugin.methods.register_function(
+    function=q2_composition.add_scaled_pseudocount,
+    inputs={'table': FeatureTable[Frequency]},
+    parameters={'pseudocount': Float % Range(0, None, inclusive_start=False),
+                **_output_parameters},
+    outputs=[('composition_table', FeatureTable[Composition])],
+    input_descriptions={
+        'table': 'The feature table to which pseudocounts should be added.'
+    },
+    parameter_descriptions={
+        'pseudocount': 'The value to add to all counts in a sample with the '
+                       'median total frequency. The value added to the '
+                       'counts of each other sample is scaled '
+                       'proportionally to its total frequency.',
+        **_output_parameter_descriptions
+    },
+    output_descriptions={
+        'composition_table': 'The resulting feature table.'
+    },
+    name='Add sample depth scaled pseudocounts to table.',
+    description='Increment all counts in each sample by a pseudocount that '
+                'is proportional to the total frequency of that sample.'
+)
+
+plugin.methods.register_function(
+    function=q2_composition.multiplicative_replacement,
+    inputs={'table': FeatureTable[Frequency]},
+    parameters={'delta': Float % Range(0, 1, inclusive_start=False),
+                **_output_parameters},
+    outputs=[('composition_table', FeatureTable[Composition])],
+    input_descriptions={
+        'table': 'The feature table in which zeros should be replaced.'
+    },
+    parameter_descriptions={
+        'delta': 'The relative abundance that zeros are replaced with. '
+                 'Defaults to the square of the reciprocal of the number '
+                 'of features in the table.',
+        **_output_parameter_descriptions
+    },
+    output_descriptions={
+        'composition_table': 'The resulting feature table, in which each '
+                             'sample sums to one.'
+    },
+    name='Replace zeros in table by multiplicative replacement.',
+    description='Convert the counts in each sample to relative abundances, '
+                'replacing zeros with a small value and rescaling the '
+                'non-zero values so that each sample still sums to one.',
+    citations=[citations['martinfernandez2003dealing']]
+)
+
 _transform_functions = q2_composition._ancom.transform_functions()
 _difference_functions = q2_composition._ancom.difference_functions()
+_significance_tests = q2_composition._ancom_stats.significance_tests()
+
+# The parameters that ancom and ancom_multiple share
+_ancom_parameters = {
+    'transform_function': Str % Choices(_transform_functions),
+    'difference_function': Str % Choices(_difference_functions),
+    'filter_missing': Bool,
+    'significance_test': Str % Choices(_significance_tests),
+    'pseudocount': Float % Range(0, None, inclusive_start=False),
+    'memory_budget': Int % Range(1, None),
+    'n_jobs': Int % Range(1, None),
+    'permutations': Int % Range(1, None),
+    'seed': Int,
+    'adaptive': Bool,
+    'compact_volcano': Bool,
+    'paged_tables': Bool,
+    'volcano_max_points': Int % Range(1, None),
+    'binary_format': Str % Choices(['parquet', 'arrow']),
+    'link_assets': Bool,
+    'rejected_abundances_only': Bool,
+}
+_ancom_parameter_descriptions = {
+    'transform_function': ('The method applied to transform feature '
+                           'values before generating volcano plots.'),
+    'difference_function': 'The method applied to visualize fold '
+                           'difference in feature abundances across '
+                           'groups for volcano plots.',
+    'significance_test': 'The statistical test applied to the log ratio '
+                         'of each pair of features: a one-way ANOVA '
+                         '(f_oneway), the rank-based Kruskal-Wallis '
+                         'H-test (kruskal), Welch\'s ANOVA (welch), '
+                         'which does not assume equal variances across '
+                         'groups, or a permutation test of the one-way '
+                         'ANOVA F statistic (permutation).',
+    'pseudocount': 'If provided, this value is treated as having been '
+                   'added to every entry of the table, which may then '
+                   'contain zeros (e.g., a frequency table). The '
+                   'pseudocount is never added to the table itself, so '
+                   'a sparse table is analyzed without being made '
+                   'dense. If not provided, the table must not contain '
+                   'zeros.',
+    'memory_budget': 'The approximate amount of memory, in megabytes, '
+                     'that may be used at once for the pairwise log-'
+                     'ratio statistics. Half is for the statistics: '
+                     'features are compared in square tiles that are '
+                     'sized to fit within it. The other half is for the '
+                     'p-values kept of the tiles, which are spilled to '
+                     'temporary files beyond it. By default, 256 '
+                     'megabytes.',
+    'n_jobs': 'The number of tiles of feature pairs to compare '
+              'concurrently. The memory budget for the statistics is '
+              'shared between them. Results do not depend on this '
+              'value.',
+    'permutations': 'The number of permutations of the sample groups '
+                    'used to compute p-values, if the significance '
+                    'test is "permutation". The smallest attainable '
+                    'p-value is 1 / (permutations + 1), so the number '
+                    'of permutations must exceed (number of features - '
+                    '1) / 0.05 for any comparison to be rejected: the '
+                    'default can not reject any comparison of a table of '
+                    'more than 50 features, and a warning is issued '
+                    'when too few permutations are requested.',
+    'seed': 'The seed of the permutations, if the significance test is '
+            '"permutation", and of the order in which features are '
+            'compared, if adaptive. If not provided, results may differ '
+            'between runs.',
+    'adaptive': 'If True, a feature\'s remaining comparisons are '
+                'skipped once its W is too low to be rejected, whatever '
+                'their outcome. The same features are rejected, but '
+                'the W of the features that were decided early (which '
+                'are flagged in the results) is a lower bound.',
+    'compact_volcano': 'If True, the volcano plot\'s data is written to a '
+                       'separate table that the plot loads, rather than '
+                       'being embedded in the page, which keeps the '
+                       'page small for large tables. The visualization '
+                       'must then be viewed through a web server (as by '
+                       'QIIME 2 View), rather than opened as a file.',
+    'paged_tables': 'If True, the tables of significant features are '
+                    'written to separate files that the page loads and '
+                    'shows a page of rows at a time, rather than being '
+                    'embedded in the page, which keeps the page small '
+                    'when many features are significant. As with '
+                    'compact_volcano, the visualization must then be '
+                    'viewed through a web server.',
+    'volcano_max_points': 'If provided, at most this many features are '
+                          'drawn in the volcano plot (or all of the '
+                          'significant features, if there are more). '
+                          'Significant features are always drawn; '
+                          'dense regions of the others are thinned, so '
+                          'that outliers are kept. The exported data '
+                          'includes all features.',
+    'binary_format': 'If provided, the result tables (ancom, percent-'
+                     'abundances and data) are also written in this '
+                     'binary format (Parquet, or Arrow IPC), for '
+                     'tools that load them at scale. Float columns are '
+                     'stored as float32 where that is exact.',
+    'link_assets': 'If True, the visualization\'s static assets (scripts, '
+                   'styles and licenses) are hardlinked to the installed '
+                   'copies where possible, rather than copied, which saves '
+                   'space when many visualizations are written to the same '
+                   'file system. The assets must then not be edited in '
+                   'place.',
+    'rejected_abundances_only': 'If True, the percentile abundances '
+                                '(percent-abundances.tsv) are only computed '
+                                'and reported for the features for which '
+                                'the null hypothesis is rejected, which is '
+                                'faster for large tables. By default, they '
+                                'are reported for all features.'
+}
 
 plugin.visualizers.register_function(
     function=q2_composition.ancom,
-    inputs={'table': FeatureTable[Composition]},
+    inputs={'table': FeatureTable[Composition | Frequency]},
     parameters={
         'metadata': MetadataColumn[Categorical],
-        'transform_function': Str % Choices(_transform_functions),
-        'difference_function': Str % Choices(_difference_functions),
-        'filter_missing': Bool,
+        **_ancom_parameters,
     },
     input_descriptions={
         'table': 'The feature table to be used for ANCOM computation.'
@@ -77,20 +249,50 @@ plugin.visualizers.register_function(
     parameter_descriptions={
         'metadata': ('The categorical sample metadata column to test for '
                      'differential abundance across.'),
-        'transform_function': ('The method applied to transform feature '
-                               'values before generating volcano plots.'),
-        'difference_function': 'The method applied to visualize fold '
-                               'difference in feature abundances across '
-                               'groups for volcano plots.',
         'filter_missing': 'If True, samples with missing metadata '
                           'values will be filtered from the table '
                           'prior to analysis. If False, an error '
                           'will be raised if there are any missing '
-                          'metadata values.'},
+                          'metadata values.',
+        **_ancom_parameter_descriptions},
     name='Apply ANCOM to identify features that differ in abundance.',
     description=('Apply Analysis of Composition of Microbiomes (ANCOM) to'
                  ' identify features that are differentially abundant across'
-                 ' groups.'),
+                 ' groups. If the Q2_COMPOSITION_CACHE_DIR environment'
+                 ' variable names a directory, the statistics are cached'
+                 ' there (within Q2_COMPOSITION_CACHE_SIZE megabytes, 1024'
+                 ' by default), so that re-running with different'
+                 ' visualization parameters skips them.'),
+    citations=[citations['mandal2015ancom']]
+)
+
+plugin.visualizers.register_function(
+    function=q2_composition.ancom_multiple,
+    inputs={'table': FeatureTable[Composition | Frequency]},
+    parameters={
+        'metadata': Metadata,
+        **_ancom_parameters,
+    },
+    input_descriptions={
+        'table': 'The feature table to be used for ANCOM computation.'
+    },
+    parameter_descriptions={
+        'metadata': ('The sample metadata. Each of its categorical columns '
+                     'is tested for differential abundance across.'),
+        'filter_missing': 'If True, samples with missing values in any of '
+                          'the categorical metadata columns will be '
+                          'filtered from the table prior to analysis. If '
+                          'False, an error will be raised if there are any '
+                          'missing metadata values.',
+        **_ancom_parameter_descriptions},
+    name='Apply ANCOM to each of several metadata columns.',
+    description=('Apply Analysis of Composition of Microbiomes (ANCOM) to'
+                 ' identify features that are differentially abundant across'
+                 ' the groups of each categorical metadata column. The log-'
+                 'ratio statistics that do not depend on the grouping are '
+                 'computed once and shared by all of the columns, which are '
+                 'therefore tested on the same samples. Statistics are '
+                 'cached as by ancom.'),
     citations=[citations['mandal2015ancom']]
 )
 
@@ -110,6 +312,7 @@ plugin.methods.register_function(
         'max_iter': Int,
         'conserve': Bool,
         'alpha': Float,
+        'n_jobs': Int % Range(1, None),
     },
     outputs=[('differentials', FeatureData[DifferentialAbundance])],
     input_descriptions={
@@ -138,6 +341,8 @@ plugin.methods.register_function(
                     ' small and/or the number of differentially abundant taxa'
                     ' is believed to be large.',
         'alpha': 'Level of significance.',
+        'n_jobs': 'The number of cores used by ANCOM-BC\'s parallel cluster'
+                  ' (its n_cl parameter).',
     },
     output_descriptions={
         'differentials': 'The calculated per-feature differentials.',
@@ -145,7 +350,13 @@ plugin.methods.register_function(
     name=('Analysis of Composition of Microbiomes with Bias Correction'),
     description=('Apply Analysis of Compositions of Microbiomes with Bias'
                  ' Correction (ANCOM-BC) to identify features that are'
-                 ' differentially abundant across groups.'),
+                 ' differentially abundant across groups. If the'
+                 ' Q2_COMPOSITION_ANCOMBC_WORKER environment variable is set'
+                 ' (to 1), R and its libraries are loaded once per Python'
+                 ' process, by a worker that runs each fit, rather than once'
+                 ' per fit. The worker is stopped once it has been idle for'
+                 ' Q2_COMPOSITION_ANCOMBC_WORKER_TIMEOUT seconds (300 by'
+                 ' default).'),
     citations=[citations['lin2020ancombc']],
     examples={
         'ancombc_single_formula': ex.ancombc_single_formula,
@@ -154,6 +365,81 @@ plugin.methods.register_function(
     }
 )
 
+plugin.methods.register_function(
+    function=q2_composition.ancombc_batch,
+    inputs={'table': FeatureTable[Frequency]},
+    parameters={
+        'metadata': Metadata,
+        'formulas': List[Str],
+        'p_adj_method': Str % Choices(['holm', 'hochberg', 'hommel',
+                                       'bonferroni', 'BH', 'BY',
+                                       'fdr', 'none']),
+        'prv_cut': Float,
+        'lib_cut': Int,
+        'reference_levels': List[Str],
+        'tol': Float,
+        'max_iter': Int,
+        'conserve': Bool,
+        'alpha': Float,
+        'n_jobs': Int % Range(1, None),
+    },
+    outputs=[('differentials',
+              Collection[FeatureData[DifferentialAbundance]])],
+    input_descriptions={
+        'table': 'The feature table to be used for ANCOM-BC computation.'
+    },
+    parameter_descriptions={
+        'metadata': 'The sample metadata.',
+        'formulas': 'The formulas to fit, each describing how the microbial'
+                    ' absolute abundances for each taxon depend on the'
+                    ' variables within the `metadata`.',
+        'p_adj_method': 'Method to adjust p-values.',
+        'prv_cut': 'A numerical fraction between 0-1. Taxa with prevalences'
+                   ' less than this value will be excluded from the analysis.',
+        'lib_cut': 'A numerical threshold for filtering samples based on'
+                   ' library sizes. Samples with library sizes less than this'
+                   ' value will be excluded from the analysis.',
+        'reference_levels': 'Define the reference level(s) to be used for'
+                            ' categorical columns found in the `formulas`.'
+                            ' Each reference level applies to every formula'
+                            ' with a term of its column. These categorical'
+                            ' factors are dummy coded relative to the'
+                            ' reference(s) provided. The syntax is as'
+                            ' follows: "column_name::column_value"',
+        'tol': 'The iteration convergence tolerance for the E-M algorithm.',
+        'max_iter': 'The maximum number of iterations for the E-M algorithm.',
+        'conserve': 'Whether to use a conservative variance estimator for the'
+                    ' test statistic. It is recommended if the sample size is'
+                    ' small and/or the number of differentially abundant taxa'
+                    ' is believed to be large.',
+        'alpha': 'Level of significance.',
+        'n_jobs': 'The number of cores to use. The formulas are split'
+                  ' between up to this many R processes, which are run'
+                  ' concurrently and share the cores as equally as'
+                  ' possible through ANCOM-BC\'s parallel cluster (its n_cl'
+                  ' parameter), using no more than this many in total.'
+                  ' Persistent R workers (see Q2_COMPOSITION_ANCOMBC_WORKER)'
+                  ' run one fit at a time, so concurrent calls that share'
+                  ' them wait for each other.',
+    },
+    output_descriptions={
+        'differentials': 'The calculated per-feature differentials of each'
+                         ' formula, keyed by the formula with each run of'
+                         ' characters other than letters, digits, "-" and'
+                         ' "_" replaced by "_" (e.g., "a_b" for "a + b").'
+                         ' The formula itself is recorded in the metadata of'
+                         ' each result.',
+    },
+    name=('Analysis of Composition of Microbiomes with Bias Correction, for'
+          ' several formulas'),
+    description=('Apply ANCOM-BC, as by the ancombc action, with each of'
+                 ' several formulas. The metadata and table are validated'
+                 ' and exported once, and all of the formulas are fit in one'
+                 ' R session, so that each additional formula only costs its'
+                 ' model fit.'),
+    citations=[citations['lin2020ancombc']]
+)
+
 plugin.visualizers.register_function(
     function=q2_composition.tabulate,
     inputs={'data': FeatureData[DifferentialAbundance]},
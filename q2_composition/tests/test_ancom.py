@@ -6,16 +6,27 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import json
 import unittest
 import os
+from unittest import mock
 
+import numpy.testing as npt
 import pandas.testing as pdt
 import numpy as np
 import pandas as pd
 
+import biom
 import qiime2
 from qiime2.plugin.testing import TestPluginBase
-from q2_composition import ancom
+from skbio.stats.composition import clr
+from q2_composition import ancom, ancom_multiple
+from q2_composition._ancom import (_transform, _downsample_volcano,
+                                   TEMPLATES)
+
+
+def _to_biom(table):
+    return biom.Table(table.T.values, table.columns, table.index)
 
 
 class AncomTests(TestPluginBase):
@@ -53,7 +64,7 @@ class AncomTests(TestPluginBase):
                       index=pd.Index(self.example_samples, name='id'))
         )
         ancom(output_dir=self.temp_dir.name,
-              table=self.otu_table + 1, metadata=c)
+              table=_to_biom(self.otu_table + 1), metadata=c)
 
         res = pd.read_csv(os.path.join(self.temp_dir.name, 'ancom.tsv'),
                           index_col=0, sep='\t')
@@ -81,6 +92,56 @@ class AncomTests(TestPluginBase):
             self.assertIn('<th>Percentile</th>', html)
             self.assertIn('<th>Group</th>', html)
             self.assertIn('<th>O1</th>', html)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.temp_dir.name, 'significant-features.json')))
+
+    def test_ancom_rejected_abundances_only(self):
+        c = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'a', 'a', '1', '1', '1'], name='n',
+                      index=pd.Index(self.example_samples, name='id'))
+        )
+        percentiles = {}
+        for rejected_abundances_only in False, True:
+            ancom(output_dir=self.temp_dir.name,
+                  table=_to_biom(self.otu_table + 1), metadata=c,
+                  rejected_abundances_only=rejected_abundances_only)
+            percentiles[rejected_abundances_only] = pd.read_csv(
+                os.path.join(self.temp_dir.name, 'percent-abundances.tsv'),
+                index_col=0, header=[0, 1], sep='\t')
+
+        # by default, the percentiles of all of the features are reported
+        self.assertEqual(list(percentiles[False].index), self.example_obs)
+        self.assertEqual(list(percentiles[True].index), ['O1', 'O2'])
+        pdt.assert_frame_equal(percentiles[True],
+                               percentiles[False].loc[['O1', 'O2']])
+
+    def test_ancom_paged_tables(self):
+        c = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'a', 'a', '1', '1', '1'], name='n',
+                      index=pd.Index(self.example_samples, name='id'))
+        )
+        ancom(output_dir=self.temp_dir.name,
+              table=_to_biom(self.otu_table + 1), metadata=c,
+              paged_tables=True)
+
+        # the tables of significant features are loaded by the page
+        with open(self.index_fp, 'r') as fh:
+            html = fh.read()
+            self.assertIn("'percent-abundances.json'", html)
+            self.assertNotIn('<th>O1</th>', html)
+        with open(os.path.join(self.temp_dir.name,
+                               'significant-features.json')) as fh:
+            obs = json.load(fh)
+        self.assertEqual(obs['index'], ['O1', 'O2'])
+        self.assertEqual(obs['columns'], ['W'])
+        self.assertEqual(obs['data'], [[5], [5]])
+        with open(os.path.join(self.temp_dir.name,
+                               'percent-abundances.json')) as fh:
+            obs = json.load(fh)
+        self.assertEqual(obs['names'], ['Percentile', 'Group'])
+        self.assertEqual(obs['index'], ['O1', 'O2'])
+        self.assertEqual(obs['columns'][:2], [[0.0, '1'], [25.0, '1']])
+        self.assertEqual(len(obs['data'][0]), 10)
 
     def test_ancom_3class_anova(self):
         c = qiime2.CategoricalMetadataColumn(
@@ -88,7 +149,8 @@ class AncomTests(TestPluginBase):
                       index=pd.Index(self.example_samples, name='id'))
         )
         ancom(output_dir=self.temp_dir.name,
-              table=self.otu_table_3class + 1, metadata=c)
+              table=_to_biom(self.otu_table_3class + 1),
+              metadata=c)
 
         res = pd.read_csv(os.path.join(self.temp_dir.name, 'ancom.tsv'),
                           index_col=0, sep='\t')
@@ -100,6 +162,200 @@ class AncomTests(TestPluginBase):
             index=self.example_obs)
         pdt.assert_frame_equal(res, exp)
 
+    def test_ancom_significance_test(self):
+        c = qiime2.CategoricalMetadataColumn(
+            pd.Series(['0', '0', '1', '1', '2', '2'], name='n',
+                      index=pd.Index(self.example_samples, name='id'))
+        )
+        for significance_test in 'kruskal', 'welch', 'permutation':
+            ancom(output_dir=self.temp_dir.name,
+                  table=_to_biom(self.otu_table_3class + 1), metadata=c,
+                  significance_test=significance_test, permutations=199,
+                  seed=0)
+
+            res = pd.read_csv(os.path.join(self.temp_dir.name, 'ancom.tsv'),
+                              index_col=0, sep='\t')
+            self.assertEqual(sorted(res.index), self.example_obs)
+            self.assertEqual(list(res.columns),
+                             ['W', 'Reject null hypothesis'])
+
+    def test_ancom_adaptive(self):
+        c = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'a', 'a', '1', '1', '1'], name='n',
+                      index=pd.Index(self.example_samples, name='id'))
+        )
+        ancom(output_dir=self.temp_dir.name,
+              table=_to_biom(self.otu_table + 1), metadata=c, adaptive=True,
+              seed=0)
+
+        res = pd.read_csv(os.path.join(self.temp_dir.name, 'ancom.tsv'),
+                          index_col=0, sep='\t')
+        self.assertEqual(list(res.columns),
+                         ['W', 'Reject null hypothesis', 'Decided early'])
+        self.assertEqual(sorted(res.index[res['Reject null hypothesis']]),
+                         ['O1', 'O2'])
+
+    def test_ancom_compact_volcano(self):
+        c = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'a', 'a', '1', '1', '1'], name='n',
+                      index=pd.Index(self.example_samples, name='id'))
+        )
+        ancom(output_dir=self.temp_dir.name,
+              table=_to_biom(self.otu_table + 1), metadata=c,
+              compact_volcano=True, volcano_max_points=4)
+
+        with open(self.index_fp) as fh:
+            html = fh.read()
+        self.assertIn('"url": "volcano.tsv"', html)
+        self.assertNotIn('"values": [', html)
+        self.assertIn('4 of the\n      7 features are drawn', html)
+
+        volcano = pd.read_csv(os.path.join(self.temp_dir.name,
+                                           'volcano.tsv'),
+                              index_col=0, sep='\t')
+        self.assertEqual(list(volcano.columns), ['clr', 'W'])
+        self.assertEqual(len(volcano), 4)
+        # the significant features are always drawn
+        self.assertTrue({'O1', 'O2'}.issubset(volcano.index))
+        data = pd.read_csv(os.path.join(self.temp_dir.name, 'data.tsv'),
+                           index_col=0, sep='\t')
+        self.assertEqual(len(data), 7)
+
+    def test_ancom_assets(self):
+        c = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'a', 'a', '1', '1', '1'], name='n',
+                      index=pd.Index(self.example_samples, name='id'))
+        )
+        for _ in range(2):
+            ancom(output_dir=self.temp_dir.name,
+                  table=_to_biom(self.otu_table + 1), metadata=c)
+
+        assets = os.path.join(TEMPLATES, 'ancom')
+        for fp in 'js/vega.min.js', 'css/spinkit.css', 'licenses/vega.txt':
+            with open(os.path.join(assets, fp), 'rb') as fh:
+                exp = fh.read()
+            with open(os.path.join(self.temp_dir.name, fp), 'rb') as fh:
+                self.assertEqual(fh.read(), exp)
+            # assets are copied by default
+            self.assertFalse(os.path.samefile(
+                os.path.join(assets, fp), os.path.join(self.temp_dir.name,
+                                                       fp)))
+
+        # rendering the page leaves the installed template untouched
+        with open(os.path.join(assets, 'index.html')) as fh:
+            self.assertIn('{% extends', fh.read())
+        with open(self.index_fp) as fh:
+            self.assertNotIn('{% extends', fh.read())
+
+    def test_ancom_link_assets(self):
+        c = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'a', 'a', '1', '1', '1'], name='n',
+                      index=pd.Index(self.example_samples, name='id'))
+        )
+        source = os.path.join(TEMPLATES, 'ancom', 'js/vega.min.js')
+        installed = os.path.join(self.temp_dir.name, 'js/vega.min.js')
+        # assets can only be hardlinked within a file system; they are copied
+        # otherwise
+        linkable = (os.stat(TEMPLATES).st_dev ==
+                    os.stat(self.temp_dir.name).st_dev)
+        with open(source, 'rb') as fh:
+            exp = fh.read()
+        # copying over a linked asset doesn't write through to the installed
+        # one
+        for link_assets in True, True, False:
+            ancom(output_dir=self.temp_dir.name,
+                  table=_to_biom(self.otu_table + 1), metadata=c,
+                  link_assets=link_assets)
+
+            with open(installed, 'rb') as fh:
+                self.assertEqual(fh.read(), exp)
+            self.assertEqual(os.path.samefile(installed, source),
+                             link_assets and linkable)
+
+    def test_ancom_binary_format(self):
+        c = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'a', 'a', '1', '1', '1'], name='n',
+                      index=pd.Index(self.example_samples, name='id'))
+        )
+        for binary_format, read in (('parquet', pd.read_parquet),
+                                    ('arrow', pd.read_feather)):
+            ancom(output_dir=self.temp_dir.name,
+                  table=_to_biom(self.otu_table + 1), metadata=c,
+                  binary_format=binary_format)
+
+            for name in 'ancom', 'percent-abundances', 'data':
+                exp = pd.read_csv(
+                    os.path.join(self.temp_dir.name, '%s.tsv' % name),
+                    index_col=0,
+                    header=[0, 1] if name == 'percent-abundances' else 0,
+                    sep='\t')
+                obs = read(os.path.join(self.temp_dir.name,
+                                        '%s.%s' % (name, binary_format)))
+                self.assertEqual(list(obs.index), list(exp.index))
+                self.assertEqual(obs.shape, exp.shape)
+                npt.assert_allclose(obs.values.astype(float),
+                                    exp.values.astype(float), rtol=1e-12)
+
+            # the percentiles of counts are exact in float32, the clr
+            # transformed differences aren't
+            obs = read(os.path.join(self.temp_dir.name,
+                                    'percent-abundances.%s' % binary_format))
+            self.assertEqual(obs.columns.names, ['Percentile', 'Group'])
+            self.assertTrue((obs.dtypes == np.float32).all())
+            obs = read(os.path.join(self.temp_dir.name,
+                                    'data.%s' % binary_format))
+            self.assertEqual(obs['clr'].dtype, np.float64)
+
+    def test_downsample_volcano(self):
+        rng = np.random.default_rng(0)
+        # a dense cluster, a few outliers, and significant features
+        x = np.concatenate([rng.normal(0, 0.01, 1000), [5, -5, 4]])
+        y = np.concatenate([rng.integers(0, 3, 1000), [1, 2, 100]])
+        keep = np.zeros(1003, dtype=bool)
+        keep[-1] = True
+
+        obs = _downsample_volcano(x, y.astype(float), keep, 100)
+        self.assertLessEqual(obs.sum(), 100)
+        self.assertGreater(obs.sum(), 50)
+        self.assertTrue(obs[-3:].all())
+
+        # significant features are kept beyond the limit
+        npt.assert_array_equal(_downsample_volcano(x, y, keep, 1), keep)
+        self.assertTrue(_downsample_volcano(x, y, keep, 2000).all())
+
+    def test_ancom_pseudocount(self):
+        c = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'a', 'a', '1', '1', '1'], name='n',
+                      index=pd.Index(self.example_samples, name='id'))
+        )
+        # a sparse table, with a pseudocount, matches the equivalent dense
+        # table that the pseudocount has already been added to
+        t = self.otu_table.copy()
+        t.iloc[[0, 4], [2, 3]] = 0
+        dense_dir = os.path.join(self.temp_dir.name, 'dense')
+        os.mkdir(dense_dir)
+        ancom(output_dir=dense_dir, table=_to_biom(t + 0.5), metadata=c)
+        ancom(output_dir=self.temp_dir.name, table=_to_biom(t), metadata=c,
+              pseudocount=0.5)
+
+        for fn in 'ancom.tsv', 'percent-abundances.tsv', 'data.tsv':
+            obs = pd.read_csv(os.path.join(self.temp_dir.name, fn),
+                              index_col=0, sep='\t')
+            exp = pd.read_csv(os.path.join(dense_dir, fn), index_col=0,
+                              sep='\t')
+            pdt.assert_frame_equal(obs, exp)
+
+    def test_ancom_zeros_without_pseudocount(self):
+        c = qiime2.CategoricalMetadataColumn(
+            pd.Series(['a', 'a', 'a', '1', '1', '1'], name='n',
+                      index=pd.Index(self.example_samples, name='id'))
+        )
+        t = self.otu_table.copy()
+        t.iloc[0, 2] = 0
+        with self.assertRaisesRegex(ValueError, 'Cannot handle zeros'):
+            ancom(output_dir=self.temp_dir.name, table=_to_biom(t),
+                  metadata=c)
+
     def test_ancom_integer_indices(self):
         # The idea behind this test is to use integer indices to confirm
         # that the metadata column mapping is joining on labels, not on
@@ -113,7 +369,8 @@ class AncomTests(TestPluginBase):
                       index=pd.Index(['6', '5', '4', '3', '2', '1'],
                                      name='id'))
         )
-        ancom(output_dir=self.temp_dir.name, table=t + 1, metadata=c)
+        ancom(output_dir=self.temp_dir.name, table=_to_biom(t + 1),
+              metadata=c)
 
         with open(self.index_fp, 'r') as fh:
             html = fh.read()
@@ -127,7 +384,8 @@ class AncomTests(TestPluginBase):
             pd.Series(['0', '0', '1', '2'], name='n',
                       index=pd.Index(short_index, name='id'))
         )
-        ancom(output_dir=self.temp_dir.name, table=t+1, metadata=c)
+        ancom(output_dir=self.temp_dir.name, table=_to_biom(t + 1),
+              metadata=c)
 
         self.assertTrue(os.path.exists(self.index_fp))
         self.assertTrue(os.path.getsize(self.index_fp) > 0)
@@ -146,7 +404,8 @@ class AncomTests(TestPluginBase):
             pd.Series(['0', '0', '1'], name='n',
                       index=pd.Index(short_index, name='id'))
         )
-        ancom(output_dir=self.temp_dir.name, table=t+1, metadata=c)
+        ancom(output_dir=self.temp_dir.name, table=_to_biom(t + 1),
+              metadata=c)
 
         self.assertTrue(os.path.exists(self.index_fp))
         self.assertTrue(os.path.getsize(self.index_fp) > 0)
@@ -165,7 +424,7 @@ class AncomTests(TestPluginBase):
                                      name='id'))
         )
 
-        ancom(output_dir=self.temp_dir.name, table=t+1, metadata=c,
+        ancom(output_dir=self.temp_dir.name, table=_to_biom(t + 1), metadata=c,
               transform_function='log')
 
         with open(os.path.join(self.temp_dir.name, 'index.html')) as fh:
@@ -186,8 +445,8 @@ class AncomTests(TestPluginBase):
                                      name='id'))
         )
 
-        ancom(output_dir=self.temp_dir.name, table=t +
-              1, metadata=c, filter_missing=True)
+        ancom(output_dir=self.temp_dir.name, table=_to_biom(t + 1),
+              metadata=c, filter_missing=True)
 
         with open(self.index_fp, 'r') as fh:
             html = fh.read()
@@ -207,8 +466,140 @@ class AncomTests(TestPluginBase):
 
         with self.assertRaisesRegex(ValueError, 'Metadata column n is missing'
                                     ' values for samples S5, S6'):
-            ancom(output_dir=self.temp_dir.name, table=t +
-                  1, metadata=c, filter_missing=False)
+            ancom(output_dir=self.temp_dir.name, table=_to_biom(t + 1),
+                  metadata=c, filter_missing=False)
+
+
+class AncomMultipleTests(TestPluginBase):
+    package = 'q2_composition.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.example_obs = ['O1', 'O2', 'O3', 'O4', 'O5', 'O6', 'O7']
+        self.example_samples = ['S1', 'S2', 'S3', 'S4', 'S5', 'S6']
+        self.otu_table = pd.DataFrame([[9, 9, 19, 19, 29, 29],
+                                       [10, 11, 20, 20, 29, 28],
+                                       [9, 10, 9, 9, 10, 9],
+                                       [9, 10, 9, 9, 9, 8],
+                                       [9, 10, 9, 9, 9, 9],
+                                       [9, 10, 9, 9, 9, 10],
+                                       [9, 12, 9, 9, 9, 11]],
+                                      index=self.example_obs,
+                                      columns=self.example_samples).T + 1
+        self.otu_table = _to_biom(self.otu_table)
+        self.metadata = qiime2.Metadata(pd.DataFrame(
+            {'three': ['0', '0', '1', '1', '2', '2'],
+             'two': ['a', 'a', 'a', 'b', 'b', 'b']},
+            index=pd.Index(self.example_samples, name='id')))
+
+    def test_ancom_multiple(self):
+        ancom_multiple(output_dir=self.temp_dir.name, table=self.otu_table,
+                       metadata=self.metadata)
+
+        with open(os.path.join(self.temp_dir.name, 'index.html')) as fh:
+            html = fh.read()
+            self.assertIn('<a href="column-1/index.html">three</a>', html)
+            self.assertIn('<a href="column-2/index.html">two</a>', html)
+
+        # each column's results match those of testing it on its own
+        for i, column in enumerate(['three', 'two'], start=1):
+            exp_dir = os.path.join(self.temp_dir.name, 'exp-%s' % column)
+            os.mkdir(exp_dir)
+            ancom(output_dir=exp_dir, table=self.otu_table,
+                  metadata=self.metadata.get_column(column))
+            for fn in 'ancom.tsv', 'percent-abundances.tsv':
+                obs = pd.read_csv(os.path.join(self.temp_dir.name,
+                                               'column-%d' % i, fn),
+                                  index_col=0, sep='\t')
+                exp = pd.read_csv(os.path.join(exp_dir, fn), index_col=0,
+                                  sep='\t')
+                pdt.assert_frame_equal(obs, exp)
+
+    def test_ancom_multiple_cache(self):
+        cache_dir = os.path.join(self.temp_dir.name, 'cache')
+        with mock.patch.dict(os.environ,
+                             {'Q2_COMPOSITION_CACHE_DIR': cache_dir}):
+            exp_dir = os.path.join(self.temp_dir.name, 'exp')
+            os.mkdir(exp_dir)
+            ancom_multiple(output_dir=exp_dir, table=self.otu_table,
+                           metadata=self.metadata)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            # re-running with different visualization parameters skips the
+            # statistics, but produces the same results
+            obs_dir = os.path.join(self.temp_dir.name, 'obs')
+            os.mkdir(obs_dir)
+            with mock.patch('q2_composition._ancom.ancom_tests') as tests:
+                ancom_multiple(output_dir=obs_dir, table=self.otu_table,
+                               metadata=self.metadata,
+                               transform_function='log')
+                tests.assert_not_called()
+            for i in 1, 2:
+                for fn in 'ancom.tsv', 'percent-abundances.tsv':
+                    obs = pd.read_csv(os.path.join(
+                        obs_dir, 'column-%d' % i, fn), index_col=0, sep='\t')
+                    exp = pd.read_csv(os.path.join(
+                        exp_dir, 'column-%d' % i, fn), index_col=0, sep='\t')
+                    pdt.assert_frame_equal(obs, exp)
+
+            # a column (or test) that wasn't cached is computed on its own
+            ancom(output_dir=obs_dir, table=self.otu_table,
+                  metadata=self.metadata.get_column('two'),
+                  significance_test='kruskal')
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+
+    def test_ancom_multiple_filter_missing(self):
+        df = self.metadata.to_dataframe()
+        df.loc['S6', 'two'] = np.nan
+        metadata = qiime2.Metadata(df)
+
+        with self.assertRaisesRegex(ValueError, 'Metadata column two is '
+                                    'missing values for samples S6'):
+            ancom_multiple(output_dir=self.temp_dir.name,
+                           table=self.otu_table, metadata=metadata)
+
+        ancom_multiple(output_dir=self.temp_dir.name, table=self.otu_table,
+                       metadata=metadata, filter_missing=True)
+
+        # S6 is dropped from the tests of all columns, not just of the
+        # column it is missing a value in
+        exp_dir = os.path.join(self.temp_dir.name, 'exp')
+        os.mkdir(exp_dir)
+        table = self.otu_table.filter(['S6'], axis='sample', invert=True,
+                                      inplace=False)
+        ancom(output_dir=exp_dir, table=table,
+              metadata=self.metadata.get_column('three'))
+        obs = pd.read_csv(os.path.join(self.temp_dir.name, 'column-1',
+                                       'ancom.tsv'), index_col=0, sep='\t')
+        exp = pd.read_csv(os.path.join(exp_dir, 'ancom.tsv'), index_col=0,
+                          sep='\t')
+        pdt.assert_frame_equal(obs, exp)
+
+
+class TransformTests(unittest.TestCase):
+
+    def setUp(self):
+        self.matrix = np.array([[1, 2, 3, 4], [5, 6, 7, 8], [9, 1, 2, 3]])
+
+    def test_transform(self):
+        npt.assert_allclose(_transform(self.matrix, 'sqrt'),
+                            np.sqrt(self.matrix))
+        npt.assert_allclose(_transform(self.matrix, 'log'),
+                            np.log(self.matrix))
+        npt.assert_allclose(_transform(self.matrix, 'clr'),
+                            clr(self.matrix))
+
+    def test_transform_inplace(self):
+        for transform_function in 'sqrt', 'log', 'clr':
+            exp = _transform(self.matrix, transform_function)
+            matrix = self.matrix.astype(np.float64)
+            obs = _transform(matrix, transform_function, inplace=True)
+            self.assertIs(obs, matrix)
+            npt.assert_allclose(obs, exp)
+
+    def test_transform_inplace_integers(self):
+        with self.assertRaisesRegex(ValueError, 'floating point'):
+            _transform(self.matrix, 'clr', inplace=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,548 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import unittest
+from unittest import mock
+
+import biom
+import numpy as np
+import numpy.testing as npt
+import pandas as pd
+import pandas.testing as pdt
+import scipy.sparse
+from scipy.stats import f_oneway, kruskal, f
+
+from q2_composition import _ancom_stats
+from q2_composition._ancom_stats import (ancom_test, ancom_tests,
+                                         ancom_reject, percentile_abundances,
+                                         w_statistic, w_statistics,
+                                         group_means, f_statistic,
+                                         _log_ratio_stats, _group_stats,
+                                         _pairwise_total, _f_oneway_pvalues,
+                                         _pairwise_ranks, _kruskal_pvalues,
+                                         _welch_pvalues, _permutation_pvalues,
+                                         _permuted_labels,
+                                         adaptive_w_statistics, _rounds,
+                                         _holm_count, _tiles, _tile_size,
+                                         _WCounter, _executor)
+
+
+class AncomStatsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.example_obs = ['O1', 'O2', 'O3', 'O4', 'O5', 'O6', 'O7']
+        self.example_samples = ['S1', 'S2', 'S3', 'S4', 'S5', 'S6']
+        self.otu_table = pd.DataFrame([[9, 9, 9, 19, 19, 19],
+                                       [10, 11, 10, 20, 20, 20],
+                                       [9, 10, 9, 9, 10, 9],
+                                       [9, 10, 9, 9, 9, 8],
+                                       [9, 10, 9, 9, 9, 9],
+                                       [9, 10, 9, 9, 9, 10],
+                                       [9, 12, 9, 9, 9, 11]],
+                                      index=self.example_obs,
+                                      columns=self.example_samples).T + 1
+        self.otu_table_3class = pd.DataFrame(
+            [[9, 9, 19, 19, 29, 29],
+             [10, 11, 20, 20, 29, 28],
+             [9, 10, 9, 9, 10, 9],
+             [9, 10, 9, 9, 9, 8],
+             [9, 10, 9, 9, 9, 9],
+             [9, 10, 9, 9, 9, 10],
+             [9, 12, 9, 9, 9, 11]],
+            index=self.example_obs,
+            columns=self.example_samples).T + 1
+
+        rng = np.random.default_rng(0)
+        self.labels = np.repeat([0, 1, 2], [8, 7, 9])
+        effect = np.ones((3, 30))
+        effect[0, :6] = 8
+        self.counts = rng.poisson(
+            rng.gamma(1, 20, size=30) * effect[self.labels]) + 1
+
+    def test_ancom_test(self):
+        grouping = pd.Series(['a', 'a', 'a', '1', '1', '1'],
+                             index=self.example_samples)
+        obs = ancom_test(self.otu_table, grouping)
+        exp = pd.DataFrame(
+            {'W': np.array([5, 5, 2, 2, 2, 2, 2]),
+             'Reject null hypothesis': np.array([True, True, False, False,
+                                                 False, False, False])},
+            index=self.example_obs)
+        pdt.assert_frame_equal(obs, exp)
+
+    def test_ancom_test_3class(self):
+        grouping = pd.Series(['0', '0', '1', '1', '2', '2'],
+                             index=self.example_samples)
+        obs = ancom_test(self.otu_table_3class, grouping)
+        exp = pd.DataFrame(
+            {'W': np.array([5, 5, 3, 3, 2, 2, 2]),
+             'Reject null hypothesis': np.array([True, True, False, False,
+                                                 False, False, False])},
+            index=self.example_obs)
+        pdt.assert_frame_equal(obs, exp)
+
+    def test_ancom_test_aligns_grouping(self):
+        grouping = pd.Series(['1', '1', '1', 'a', 'a', 'a'],
+                             index=self.example_samples[::-1])
+        obs = ancom_test(self.otu_table, grouping)
+        npt.assert_array_equal(obs['W'], [5, 5, 2, 2, 2, 2, 2])
+
+    def test_ancom_tests(self):
+        groupings = pd.DataFrame(
+            {'two': ['a', 'a', 'a', '1', '1', '1'],
+             'three': ['0', '0', '1', '1', '2', '2']},
+            index=self.example_samples)
+        obs = ancom_tests(self.otu_table, groupings)
+
+        self.assertEqual(list(obs), ['two', 'three'])
+        for column in groupings:
+            pdt.assert_frame_equal(
+                obs[column], ancom_test(self.otu_table, groupings[column]))
+
+    def test_ancom_tests_adaptive(self):
+        groupings = pd.DataFrame(
+            {'two': ['a', 'a', 'a', '1', '1', '1'],
+             'three': ['0', '0', '1', '1', '2', '2']},
+            index=self.example_samples)
+        exp = ancom_tests(self.otu_table, groupings)
+        obs = ancom_tests(self.otu_table, groupings, adaptive=True, seed=0)
+
+        for column in groupings:
+            self.assertEqual(list(obs[column].columns),
+                             ['W', 'Reject null hypothesis', 'Decided early'])
+            pdt.assert_series_equal(obs[column]['Reject null hypothesis'],
+                                    exp[column]['Reject null hypothesis'])
+
+    def test_ancom_tests_invalid_grouping(self):
+        groupings = pd.DataFrame(
+            {'two': ['a', 'a', 'a', '1', '1', '1'],
+             'one': ['a'] * 6},
+            index=self.example_samples)
+        with self.assertRaisesRegex(ValueError, 'are the same'):
+            ancom_tests(self.otu_table, groupings)
+
+    def test_ancom_test_sparse_pseudocount(self):
+        counts = self.counts - 1
+        table = biom.Table(scipy.sparse.csr_matrix(counts.T),
+                           ['O%d' % i for i in range(30)],
+                           ['S%d' % i for i in range(24)])
+        grouping = pd.Series(self.labels, index=table.ids())
+        dense = pd.DataFrame(counts + 0.5, index=table.ids(),
+                             columns=table.ids(axis='observation'))
+
+        for test in 'f_oneway', 'kruskal', 'welch':
+            obs = ancom_test(table, grouping, significance_test=test,
+                             pseudocount=0.5)
+            exp = ancom_test(dense, grouping, significance_test=test)
+            pdt.assert_frame_equal(obs, exp)
+
+        obs = percentile_abundances(table, grouping, pseudocount=0.5)
+        exp = percentile_abundances(dense, grouping)
+        pdt.assert_frame_equal(obs, exp)
+
+    def test_ancom_test_zeros(self):
+        grouping = pd.Series(['a', 'a', 'a', '1', '1', '1'],
+                             index=self.example_samples)
+        with self.assertRaisesRegex(ValueError, 'Cannot handle zeros'):
+            ancom_test(self.otu_table - 10, grouping)
+
+    def test_ancom_test_unique_groups(self):
+        grouping = pd.Series(['a', 'b', 'c', 'd', 'e', 'f'],
+                             index=self.example_samples)
+        with self.assertRaisesRegex(ValueError, 'are unique'):
+            ancom_test(self.otu_table, grouping)
+
+    def test_ancom_test_single_group(self):
+        grouping = pd.Series(['a'] * 6, index=self.example_samples)
+        with self.assertRaisesRegex(ValueError, 'are the same'):
+            ancom_test(self.otu_table, grouping)
+
+    def test_f_oneway_pvalues(self):
+        log_matrix = np.log(self.counts)
+        stats = _log_ratio_stats(log_matrix)
+        tile = slice(0, 30)
+        obs = _f_oneway_pvalues(_pairwise_total(stats, tile, tile),
+                                _group_stats(stats, self.labels),
+                                tile, tile)
+
+        for i in range(30):
+            for j in range(30):
+                if i == j:
+                    continue
+                ratio = log_matrix[:, i] - log_matrix[:, j]
+                _, exp = f_oneway(*[ratio[self.labels == k]
+                                    for k in range(3)])
+                self.assertAlmostEqual(obs[i, j], exp)
+
+    def test_f_oneway_pvalues_constant_ratio(self):
+        log_matrix = np.log(np.array([[1, 2, 3], [2, 4, 5], [3, 6, 1],
+                                      [4, 8, 2]]))
+        stats = _log_ratio_stats(log_matrix)
+        tile = slice(0, 3)
+        obs = _f_oneway_pvalues(
+            _pairwise_total(stats, tile, tile),
+            _group_stats(stats, np.array([0, 0, 1, 1])), tile, tile)
+        # features 0 and 1 are proportional, so their log ratio is constant
+        self.assertTrue(np.isnan(obs[0, 1]))
+        self.assertTrue(np.isnan(obs[1, 0]))
+        self.assertFalse(np.isnan(obs[0, 2]))
+
+    def test_kruskal_pvalues(self):
+        log_matrix = np.log(self.counts)
+        stats = _log_ratio_stats(log_matrix)
+        rows, cols = slice(0, 12), slice(5, 30)
+        obs = _kruskal_pvalues(_pairwise_ranks(stats, rows, cols),
+                               _group_stats(stats, self.labels),
+                               rows, cols)
+
+        for i in range(12):
+            for j in range(5, 30):
+                if i == j:
+                    continue
+                ratio = log_matrix[:, i] - log_matrix[:, j]
+                _, exp = kruskal(*[ratio[self.labels == k]
+                                   for k in range(3)])
+                self.assertAlmostEqual(obs[i, j - 5], exp)
+
+    def test_welch_pvalues(self):
+        log_matrix = np.log(self.counts)
+        stats = _log_ratio_stats(log_matrix)
+        rows, cols = slice(0, 12), slice(5, 30)
+        obs = _welch_pvalues(stats, _group_stats(stats, self.labels),
+                             rows, cols)
+
+        exp = np.full_like(obs, np.nan)
+        for i in range(12):
+            for j in range(5, 30):
+                if i == j:
+                    continue
+                ratio = log_matrix[:, i] - log_matrix[:, j]
+                groups = [ratio[self.labels == k] for k in range(3)]
+                n = np.array([len(g) for g in groups])
+                m = np.array([g.mean() for g in groups])
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    w = n / np.array([g.var(ddof=1) for g in groups])
+                    mean = (w * m).sum() / w.sum()
+                    tmp = ((1 - w / w.sum()) ** 2 / (n - 1)).sum()
+                    stat = ((w * (m - mean) ** 2).sum() / 2) / \
+                        (1 + 2 / 8 * tmp)
+                exp[i, j - 5] = f.sf(stat, 2, 8 / (3 * tmp))
+        # log ratios that are constant within a group are undefined
+        npt.assert_allclose(obs, exp, atol=1e-12, equal_nan=True)
+
+    def test_permutation_pvalues(self):
+        log_matrix = np.log(self.counts[:, :10])
+        stats = _log_ratio_stats(log_matrix)
+        groups = _group_stats(stats, self.labels)
+        groups = groups._replace(permutations=_permuted_labels(
+            self.labels, 99, np.random.default_rng(0)))
+        rows, cols = slice(0, 4), slice(2, 10)
+        obs = _permutation_pvalues((stats, _pairwise_total(stats, rows, cols)),
+                                   groups, rows, cols)
+
+        permuted = groups.permutations
+        exp = np.full_like(obs, np.nan)
+        for i in range(4):
+            for j in range(2, 10):
+                if i == j:
+                    continue
+                ratio = log_matrix[:, i] - log_matrix[:, j]
+                stat = f_oneway(*[ratio[self.labels == k]
+                                  for k in range(3)])[0]
+                null = np.array([f_oneway(*[ratio[labels == k]
+                                            for k in range(3)])[0]
+                                 for labels in permuted])
+                extreme = (null >= stat * (1 - 1e-9)).sum()
+                exp[i, j - 2] = (extreme + 1) / 100
+        npt.assert_allclose(obs, exp, equal_nan=True)
+
+    def test_w_statistic_permutation(self):
+        log_matrix = np.log(self.counts)
+        exp = w_statistic(log_matrix, self.labels,
+                          significance_test='permutation', seed=42)
+
+        # tiles of 7 features, once the permuted labels are set aside
+        for memory_budget, n_jobs in (None, 2), (2 ** 18, 3):
+            obs = w_statistic(log_matrix, self.labels,
+                              significance_test='permutation', seed=42,
+                              memory_budget=memory_budget, n_jobs=n_jobs)
+            npt.assert_array_equal(obs, exp)
+        # the differentially abundant features stand out as clearly as with
+        # the one-way ANOVA
+        npt.assert_array_equal(ancom_reject(exp), ancom_reject(
+            w_statistic(log_matrix, self.labels)))
+
+    def test_w_statistic_permutation_too_few(self):
+        # the smallest p-value, 1 / 100, can't be rejected among the 29
+        # comparisons of each feature
+        log_matrix = np.log(self.counts)
+        with self.assertWarnsRegex(UserWarning, 'At least 580 permutations'):
+            obs = w_statistic(log_matrix, self.labels,
+                              significance_test='permutation',
+                              permutations=99, seed=42)
+        npt.assert_array_equal(obs, 0)
+
+    def test_w_statistic(self):
+        log_matrix = np.log(self.counts)
+        obs = w_statistic(log_matrix, self.labels)
+
+        exp = []
+        for i in range(30):
+            pvalues = []
+            for j in range(30):
+                if i != j:
+                    ratio = log_matrix[:, i] - log_matrix[:, j]
+                    pvalues.append(f_oneway(*[ratio[self.labels == k]
+                                              for k in range(3)])[1])
+            pvalues = np.sort(pvalues)
+            adjusted = np.maximum.accumulate(pvalues * (29 - np.arange(29)))
+            exp.append((adjusted < 0.05).sum())
+        npt.assert_array_equal(obs, exp)
+
+    def test_w_statistic_tiled(self):
+        log_matrix = np.log(self.counts)
+        exp = w_statistic(log_matrix, self.labels)
+
+        for memory_budget in 1, 8 * 6 * 7 ** 2, 8 * 6 * 29 ** 2, 2 ** 30:
+            obs = w_statistic(log_matrix, self.labels,
+                              memory_budget=memory_budget)
+            npt.assert_array_equal(obs, exp)
+
+    def test_w_statistic_bounded_candidates(self):
+        log_matrix = np.log(self.counts)
+        exp = w_statistic(log_matrix, self.labels, alpha=0.5)
+        counters = []
+
+        class Counter(_WCounter):
+            def __init__(self, *args):
+                super().__init__(*args)
+                counters.append(self)
+
+        # a budget of 2352 bytes, half of which holds 73 candidates, far
+        # fewer than the comparisons with p-values below alpha
+        with mock.patch.object(_ancom_stats, '_WCounter', Counter):
+            obs = w_statistic(log_matrix, self.labels, alpha=0.5,
+                              memory_budget=8 * 6 * 7 ** 2)
+        npt.assert_array_equal(obs, exp)
+        self.assertGreater(exp.sum(), 2 * 73)
+        buffer = counters[0].candidates
+        self.assertEqual(buffer.capacity, 73)
+        # at most a tile's (4 by 4) candidates are added beyond capacity
+        # before they are spilled, and W is computed from partitions of at
+        # most capacity candidates
+        self.assertLessEqual(buffer.peak, 2 * 73)
+        # the spilled candidates are removed
+        self.assertIsNone(buffer._directory)
+
+    def test_w_statistics(self):
+        log_matrix = np.log(self.counts)
+        labels = [self.labels, self.labels % 2, np.arange(24) // 12]
+        exp = [w_statistic(log_matrix, grouping) for grouping in labels]
+
+        for memory_budget in None, 8 * 6 * 7 ** 2:
+            obs = w_statistics(log_matrix, labels,
+                               memory_budget=memory_budget, n_jobs=2)
+            self.assertEqual(len(obs), 3)
+            for o, e in zip(obs, exp):
+                npt.assert_array_equal(o, e)
+
+    def test_w_statistic_significance_tests(self):
+        log_matrix = np.log(self.counts)
+        for test in 'kruskal', 'welch':
+            exp = w_statistic(log_matrix, self.labels,
+                              significance_test=test)
+            obs = w_statistic(log_matrix, self.labels,
+                              significance_test=test,
+                              memory_budget=8 * 6 * 7 ** 2, n_jobs=2)
+            npt.assert_array_equal(obs, exp)
+            # the differentially abundant features stand out as clearly as
+            # with the one-way ANOVA
+            npt.assert_array_equal(ancom_reject(exp), ancom_reject(
+                w_statistic(log_matrix, self.labels)))
+
+    def test_w_statistic_n_jobs(self):
+        log_matrix = np.log(self.counts)
+        exp = w_statistic(log_matrix, self.labels)
+
+        for n_jobs in 2, 3, 8:
+            obs = w_statistic(log_matrix, self.labels,
+                              memory_budget=8 * 6 * 7 ** 2, n_jobs=n_jobs)
+            npt.assert_array_equal(obs, exp)
+
+    def test_adaptive_w_statistics(self):
+        rng = np.random.default_rng(1)
+        labels = np.repeat([0, 1, 2], [8, 7, 9])
+        effect = np.ones((3, 200))
+        effect[0, :12] = 8
+        log_matrix = np.log(rng.poisson(
+            rng.gamma(1, 20, size=200) * effect[labels]) + 1)
+        groupings = [labels, labels % 2, np.arange(24) // 12]
+
+        for test in 'f_oneway', 'kruskal':
+            exp = w_statistics(log_matrix, groupings, significance_test=test)
+            obs = adaptive_w_statistics(log_matrix, groupings,
+                                        significance_test=test, seed=0)
+            for (W, decided), exp_W in zip(obs, exp):
+                # the reject calls are those of the exact W, which the W of
+                # the features that were decided early is a lower bound of
+                npt.assert_array_equal(ancom_reject(W), ancom_reject(exp_W))
+                npt.assert_array_equal(W[~decided], exp_W[~decided])
+                self.assertTrue((W[decided] <= exp_W[decided]).all())
+                self.assertFalse(ancom_reject(W)[decided].any())
+            # the null features of the first grouping are decided early
+            self.assertGreater(obs[0][1][12:].mean(), 0.5)
+
+        # the blocks are far smaller than the memory budget, so don't
+        # depend on how it is shared between jobs
+        exp = adaptive_w_statistics(log_matrix, groupings, seed=0)
+        obs = adaptive_w_statistics(log_matrix, groupings, seed=0, n_jobs=3)
+        for (o_W, o_decided), (e_W, e_decided) in zip(obs, exp):
+            npt.assert_array_equal(o_W, e_W)
+            npt.assert_array_equal(o_decided, e_decided)
+
+    def test_executor_window(self):
+        submitted = []
+
+        def items():
+            for i in range(20):
+                submitted.append(i)
+                yield i
+
+        with _executor(3) as executor:
+            obs = executor.map(lambda x: 2 * x, items())
+            for i, result in enumerate(obs):
+                self.assertEqual(result, 2 * i)
+                # the window of six calls in flight, and the next item
+                self.assertLessEqual(len(submitted) - i, 7)
+        self.assertEqual(len(submitted), 20)
+
+    def test_rounds(self):
+        for n_blocks in 1, 2, 5, 8:
+            pairs = [tuple(sorted(tile)) for tiles in _rounds(n_blocks)
+                     for tile in tiles]
+            exp = [(a, b) for a in range(n_blocks)
+                   for b in range(a, n_blocks)]
+            self.assertEqual(sorted(pairs), exp)
+
+    def test_tile_size(self):
+        self.assertEqual(_tile_size(100), 100)
+        self.assertEqual(_tile_size(100, 8 * 6 * 7 ** 2), 7)
+        self.assertEqual(_tile_size(100, 8 * (6 * 7 ** 2 + 10 * 7), 6, 10), 7)
+        self.assertEqual(_tile_size(100, 1), 1)
+        self.assertEqual(_tile_size(100, 2 ** 30), 100)
+
+    def test_tiles(self):
+        obs = [(r.start, c.start) for r, c in _tiles(5, 2)]
+        self.assertEqual(obs, [(0, 0), (0, 2), (0, 4), (2, 2), (2, 4),
+                               (4, 4)])
+
+    def test_holm_count(self):
+        # the candidate (below alpha) p-values of three features, with three
+        # comparisons each: [0.001, 0.03, 0.04], [0.001, 0.01, 0.02] and
+        # [0.001, 0.5, 0.9]
+        features = np.array([0, 1, 0, 1, 0, 2, 1])
+        pvalues = np.array([0.04, 0.01, 0.001, 0.02, 0.03, 0.001, 0.001])
+        undefined = np.zeros(3, dtype=int)
+        npt.assert_array_equal(
+            _holm_count(features, pvalues, undefined, 3, 0.05), [1, 3, 1])
+
+    def test_holm_count_undefined(self):
+        # [0.001, 0.01, nan], [0.001, 0.3, nan] and [nan, nan, nan]
+        features = np.array([0, 0, 1])
+        pvalues = np.array([0.001, 0.01, 0.001])
+        undefined = np.array([1, 1, 3])
+        # undefined comparisons are counted once all others are rejected
+        npt.assert_array_equal(
+            _holm_count(features, pvalues, undefined, 3, 0.05), [3, 1, 3])
+
+    def test_holm_count_unevaluated(self):
+        # of five comparisons each, [0.001, 0.03, 0.04] and
+        # [0.001, 0.01, 0.02] have been evaluated
+        features = np.array([0, 1, 0, 1, 0, 1])
+        pvalues = np.array([0.04, 0.01, 0.001, 0.02, 0.03, 0.001])
+        undefined = np.zeros(2, dtype=int)
+        # the unevaluated comparisons are either all rejected, or none are
+        npt.assert_array_equal(
+            _holm_count(features, pvalues, undefined, 5, 0.05,
+                        unevaluated=np.array([2, 2])), [3, 5])
+        npt.assert_array_equal(
+            _holm_count(features, pvalues, undefined, 5, 0.05), [1, 2])
+
+    def test_group_means(self):
+        obs = group_means(self.counts, self.labels)
+        exp = [self.counts[self.labels == k].mean(axis=0) for k in range(3)]
+        npt.assert_allclose(obs, exp)
+
+    def test_f_statistic(self):
+        matrix = np.log(self.counts)
+        obs = f_statistic(matrix, self.labels)
+        exp = f_oneway(*[matrix[self.labels == k] for k in range(3)])[0]
+        npt.assert_allclose(obs, exp)
+
+    def test_f_statistic_constant(self):
+        matrix = np.array([[0.1, 1.0, 2.0], [0.1, 1.0, 3.0],
+                           [0.1, 2.0, 4.0], [0.1, 2.0, 5.0]])
+        obs = f_statistic(matrix, np.array([0, 0, 1, 1]))
+        # constant overall, constant within groups, and neither
+        self.assertTrue(np.isnan(obs[0]))
+        self.assertEqual(obs[1], np.inf)
+        self.assertAlmostEqual(obs[2], 8.0)
+
+    def test_ancom_reject_below_theta(self):
+        W = np.array([0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0])
+        npt.assert_array_equal(ancom_reject(W), np.zeros(12, dtype=bool))
+
+    def test_ancom_reject(self):
+        W = np.array([9, 9, 8, 1, 0, 1, 0, 2, 1, 0])
+        npt.assert_array_equal(ancom_reject(W),
+                               [True, True, True] + [False] * 7)
+
+    def test_percentile_abundances(self):
+        grouping = pd.Series(['a', 'a', 'a', '1', '1', '1'],
+                             index=self.example_samples)
+        obs = percentile_abundances(self.otu_table, grouping)
+
+        self.assertEqual(list(obs.columns.names), ['Percentile', 'Group'])
+        self.assertEqual(list(obs.index), self.example_obs)
+        self.assertEqual(obs.loc['O1', (50.0, '1')], 20)
+        self.assertEqual(obs.loc['O1', (50.0, 'a')], 10)
+        self.assertEqual(obs.loc['O7', (100.0, '1')], 12)
+        self.assertEqual(obs.loc['O7', (0.0, 'a')], 10)
+
+    def test_percentile_abundances_features(self):
+        # unequal, interleaved groups
+        grouping = pd.Series(['b', 'a', 'b', 'c', 'a', 'b'],
+                             index=self.example_samples)
+        features = np.array([True, False, False, True, False, False, True])
+        obs = percentile_abundances(self.otu_table, grouping,
+                                    features=features, pseudocount=0.5)
+
+        self.assertEqual(list(obs.index), ['O1', 'O4', 'O7'])
+        self.assertEqual(list(obs.columns[:2]), [(0.0, 'a'), (25.0, 'a')])
+        for group in 'abc':
+            members = self.otu_table[(grouping == group).values]
+            exp = np.percentile(members[['O1', 'O4', 'O7']] + 0.5,
+                                [0, 25, 50, 75, 100], axis=0)
+            for percentile, values in zip([0, 25, 50, 75, 100], exp):
+                npt.assert_allclose(obs[(percentile, group)], values)
+
+        # a sparse table gives the same percentiles
+        table = biom.Table(self.otu_table.values.T, self.example_obs,
+                           self.example_samples)
+        pdt.assert_frame_equal(
+            percentile_abundances(table, grouping, features=features,
+                                  pseudocount=0.5), obs)
+
+        # no features
+        obs = percentile_abundances(self.otu_table, grouping,
+                                    features=np.zeros(7, dtype=bool))
+        self.assertEqual(obs.shape, (0, 15))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,14 +6,27 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
 import pandas as pd
 import numpy as np
+import scipy.io
 from biom.table import Table
 
 from qiime2.plugin.testing import TestPluginBase
 from qiime2 import Metadata, Artifact
 
-from q2_composition._ancombc import ancombc
+from q2_composition import _ancombc
+from q2_composition._format import DataPackageSchemaFileFormat
+from q2_composition._ancombc import ancombc, ancombc_batch
 
 
 class TestBase(TestPluginBase):
@@ -315,3 +328,330 @@ class TestANCOMBC(TestBase):
                                     ' level value appears to contain a `:`.*'):
             ancombc(table=self.table, metadata=self.md, formula='bodysite',
                     reference_levels=['bodysite::tongue:'])
+
+
+class TestANCOMBCBatch(TestBase):
+    def test_batch_matches_ancombc(self):
+        formulas = ['bodysite', 'bodysite + animal']
+        obs = ancombc_batch(table=self.table, metadata=self.md,
+                            formulas=formulas,
+                            reference_levels=['bodysite::tongue'])
+        self.assertEqual(list(obs), ['bodysite', 'bodysite_animal'])
+
+        for formula, dataloaf in zip(formulas, obs.values()):
+            exp = ancombc(table=self.table, metadata=self.md,
+                          formula=formula,
+                          reference_levels=['bodysite::tongue'])
+            with open(str(dataloaf.nutrition_facts.view(
+                    DataPackageSchemaFileFormat))) as fh:
+                self.assertEqual(json.load(fh)['metadata']['formula'],
+                                 formula)
+            obs_slices = dict(dataloaf.data_slices.iter_views(pd.DataFrame))
+            for name, slice in exp.data_slices.iter_views(pd.DataFrame):
+                pd.testing.assert_frame_equal(obs_slices[name], slice)
+
+    def test_batch_n_jobs(self):
+        formulas = ['bodysite', 'animal', 'bodysite + animal']
+        exp = ancombc_batch(table=self.table, metadata=self.md,
+                            formulas=formulas)
+        with mock.patch.object(_ancombc, 'run_commands',
+                               wraps=_ancombc.run_commands) as run_commands:
+            obs = ancombc_batch(table=self.table, metadata=self.md,
+                                formulas=formulas, n_jobs=2)
+        # one R process for the first and third formulas, and one for the
+        # second, each with one core
+        self.assertEqual(run_commands.call_count, 2)
+        for call in run_commands.call_args_list:
+            cmd = call.args[0][0]
+            self.assertEqual(cmd[cmd.index('--n_cl') + 1], '1')
+
+        self.assertEqual(list(obs), list(exp))
+        for key, dataloaf in obs.items():
+            obs_slices = dict(dataloaf.data_slices.iter_views(pd.DataFrame))
+            for name, slice in exp[key].data_slices.iter_views(
+                    pd.DataFrame):
+                pd.testing.assert_frame_equal(obs_slices[name], slice)
+
+    def test_split_jobs(self):
+        self.assertEqual(_ancombc._split_jobs(1, 3), [([0, 1, 2], 1)])
+        self.assertEqual(_ancombc._split_jobs(2, 3), [([0, 2], 1), ([1], 1)])
+        self.assertEqual(_ancombc._split_jobs(5, 2), [([0], 3), ([1], 2)])
+        self.assertEqual(_ancombc._split_jobs(4, 1), [([0], 4)])
+        for n_jobs in range(1, 9):
+            for n_fits in range(1, 6):
+                jobs = _ancombc._split_jobs(n_jobs, n_fits)
+                # every fit is run once, and the cores used add up to n_jobs
+                self.assertEqual(sorted(i for fits, _ in jobs for i in fits),
+                                 list(range(n_fits)))
+                self.assertEqual(sum(n_cl for _, n_cl in jobs), n_jobs)
+                self.assertLessEqual(len(jobs), n_jobs)
+
+    def test_batch_n_jobs_workers(self):
+        workers = [mock.Mock(), mock.Mock()]
+        with mock.patch.object(_ancombc, '_get_workers',
+                               return_value=workers) as get_workers:
+            ancombc_batch(table=self.table, metadata=self.md,
+                          formulas=['bodysite', 'animal'], n_jobs=5)
+        # one worker per process, sharing the five cores
+        get_workers.assert_called_once_with(2)
+        requests = [worker.run.call_args.args[0] for worker in workers]
+        self.assertEqual([r['n_cl'] for r in requests], ['3', '2'])
+        self.assertEqual([[fit['formula'] for fit in json.loads(r['fits'])]
+                          for r in requests], [['bodysite'], ['animal']])
+
+    def test_batch_r_error_message(self):
+        worker = mock.Mock()
+        worker.run.side_effect = subprocess.CalledProcessError(
+            1, ['run_ancombc.R'],
+            stderr='Input file path does not exist: missing.tsv')
+        with mock.patch.object(_ancombc, '_get_workers',
+                               return_value=[worker]):
+            with self.assertRaisesRegex(
+                    Exception, r'return code 1.*R reported: Input file path '
+                               r'does not exist: missing\.tsv'):
+                ancombc_batch(table=self.table, metadata=self.md,
+                              formulas=['bodysite'])
+
+    def test_batch_reference_levels(self):
+        with mock.patch.object(_ancombc, '_ancombc_fits',
+                               return_value=['loaf1', 'loaf2']) as fits:
+            obs = ancombc_batch(table=self.table, metadata=self.md,
+                                formulas=['bodysite', 'animal'],
+                                reference_levels=['animal::dog'])
+        self.assertEqual(obs, {'bodysite': 'loaf1', 'animal': 'loaf2'})
+        self.assertEqual(fits.call_args.kwargs['fits'],
+                         [('bodysite', None), ('animal', ['animal::dog'])])
+
+    def test_batch_reference_level_col_not_in_formulas_failure(self):
+        with self.assertRaisesRegex(ValueError, '"animal" was not found'
+                                    ' within the terms of any `formula`'):
+            ancombc_batch(table=self.table, metadata=self.md,
+                          formulas=['bodysite', 'month'],
+                          reference_levels=['animal::dog'])
+
+    def test_collection_keys(self):
+        self.assertEqual(
+            _ancombc._collection_keys(['bodysite', 'bodysite + animal',
+                                       'bodysite*animal', 'C(month)', '+']),
+            ['bodysite', 'bodysite_animal', 'bodysite_animal-3', 'C_month',
+             'formula'])
+
+    def test_batch_repeated_formula_failure(self):
+        with self.assertRaisesRegex(ValueError, 'only be provided once'):
+            ancombc_batch(table=self.table, metadata=self.md,
+                          formulas=['bodysite', 'bodysite'])
+
+
+class TestWriteTable(TestBase):
+    def test_write_table(self):
+        table = pd.DataFrame([[0.0, 3.0, 0.0], [1.0, 0.0, 0.0]],
+                             index=['S1', '1E5'], columns=['f1', 'f2', 'f3'])
+        with tempfile.TemporaryDirectory() as temp_dir_name:
+            obs = _ancombc._write_table(table, temp_dir_name)
+            abundances = scipy.io.mmread(obs['inp_abundances_path'])
+            with open(obs['inp_feature_ids_path']) as fh:
+                feature_ids = fh.read().splitlines()
+            with open(obs['inp_sample_ids_path']) as fh:
+                sample_ids = fh.read().splitlines()
+
+        # only the nonzero entries, of the transposed table, as integers
+        self.assertEqual(abundances.nnz, 2)
+        self.assertEqual(abundances.dtype, np.int64)
+        np.testing.assert_array_equal(abundances.toarray(), table.values.T)
+        self.assertEqual(feature_ids, ['f1', 'f2', 'f3'])
+        self.assertEqual(sample_ids, ['S1', '1E5'])
+
+        table.iloc[0, 1] = 0.5
+        with tempfile.TemporaryDirectory() as temp_dir_name:
+            obs = _ancombc._write_table(table, temp_dir_name)
+            abundances = scipy.io.mmread(obs['inp_abundances_path'])
+        np.testing.assert_array_equal(abundances.toarray(), table.values.T)
+
+    @unittest.skipUnless(shutil.which('Rscript')
+                         and shutil.which(_ancombc.RWorker.command[0]),
+                         'requires R and run_ancombc.R')
+    def test_write_table_read_in_r(self):
+        # the table that R reads matches the one it read from the TSV that
+        # was written before
+        table = pd.DataFrame([[0.0, 3.0, 0.0], [1.0, 0.0, 0.5]],
+                             index=['S1', '1E5'], columns=['f1', 'f2', '007'])
+        script = """
+        args <- commandArgs(trailingOnly = TRUE)
+        suppressMessages(library(tidyverse))
+        mtx <- as.matrix(Matrix::readMM(args[1]))
+        rownames(mtx) <- readLines(args[2], encoding = "UTF-8")
+        colnames(mtx) <- readLines(args[3], encoding = "UTF-8")
+        tsv <- read_tsv(args[4], col_names = TRUE,
+                        col_types = cols("character",
+                                         .default = col_double())) |>
+          column_to_rownames("...1") |>
+          t()
+        storage.mode(mtx) <- "double"
+        stopifnot(identical(dimnames(mtx), dimnames(tsv)),
+                  isTRUE(all.equal(mtx, tsv)))
+        """
+        with tempfile.TemporaryDirectory() as temp_dir_name:
+            options = _ancombc._write_table(table, temp_dir_name)
+            tsv_fp = os.path.join(temp_dir_name, 'input.biom.tsv')
+            table.to_csv(tsv_fp, sep='\t', header=True)
+            subprocess.run(['Rscript', '-e', script,
+                            options['inp_abundances_path'],
+                            options['inp_feature_ids_path'],
+                            options['inp_sample_ids_path'], tsv_fp],
+                           check=True)
+
+
+class TestPrefilter(TestBase):
+    def setUp(self):
+        super().setUp()
+        # 10 samples, of which f2 is present in 1 and f3 in none
+        self.prefilter_table = pd.DataFrame(
+            {'f1': [5] * 10, 'f2': [0] * 9 + [4], 'f3': [0] * 10,
+             'f4': [1, 1, 0, 0, 0, 0, 0, 0, 0, 2]},
+            index=['S%d' % i for i in range(10)], dtype=float)
+
+    def test_prefilter_features(self):
+        obs, features, samples = _ancombc._prefilter(self.prefilter_table,
+                                                     prv_cut=0.1, lib_cut=0)
+        # a prevalence of exactly prv_cut is excluded by only one of
+        # ANCOM-BC's formulations of the cut, so f2 is left to R
+        self.assertEqual(list(obs.columns), ['f1', 'f2', 'f4'])
+        self.assertEqual(list(features), ['f3'])
+        self.assertEqual(list(samples), [])
+
+        obs, features, _ = _ancombc._prefilter(self.prefilter_table,
+                                               prv_cut=0.25, lib_cut=0)
+        self.assertEqual(list(obs.columns), ['f1', 'f4'])
+        self.assertEqual(list(features), ['f2', 'f3'])
+
+    def test_prefilter_samples(self):
+        obs, _, samples = _ancombc._prefilter(self.prefilter_table,
+                                              prv_cut=0.25, lib_cut=6)
+        self.assertEqual(list(obs.index), ['S0', 'S1', 'S9'])
+        self.assertEqual(len(samples), 7)
+
+        # dropping S0 and S1 would change the prevalence of f4 (from 0.3 to
+        # 0.125) that R computes, so no samples are dropped
+        table = self.prefilter_table.copy()
+        table.loc[['S0', 'S1'], 'f1'] = 1
+        obs, _, samples = _ancombc._prefilter(table, prv_cut=0.25, lib_cut=3)
+        self.assertEqual(len(obs.index), 10)
+        self.assertEqual(list(samples), [])
+
+    def test_prefilter_output_unchanged(self):
+        exp = ancombc(table=self.table, metadata=self.md,
+                      formula='bodysite', prv_cut=0.3, lib_cut=1000)
+
+        def unfiltered(table, prv_cut, lib_cut):
+            return table, table.columns[:0], table.index[:0]
+
+        with mock.patch.object(_ancombc, '_prefilter', unfiltered):
+            obs = ancombc(table=self.table, metadata=self.md,
+                          formula='bodysite', prv_cut=0.3, lib_cut=1000)
+        obs = dict(obs.data_slices.iter_views(pd.DataFrame))
+        for name, slice in exp.data_slices.iter_views(pd.DataFrame):
+            pd.testing.assert_frame_equal(obs[name], slice)
+
+    def test_prefilter_verbose(self):
+        for verbose in True, False:
+            stdout = io.StringIO()
+            with mock.patch.object(_ancombc, 'run_commands') as run_commands, \
+                    mock.patch.dict(os.environ,
+                                    {_ancombc.WORKER_VARIABLE: ''}), \
+                    contextlib.redirect_stdout(stdout):
+                _ancombc._ancombc_fits(
+                    self.table, self.md, [('bodysite', None)], 'holm',
+                    prv_cut=0.3, lib_cut=1000, tol=1e-05, max_iter=100,
+                    conserve=False, alpha=0.05, verbose=verbose)
+            # what was dropped is reported along with the commands
+            self.assertEqual('were dropped' in stdout.getvalue(), verbose)
+            self.assertEqual(run_commands.call_args.kwargs['verbose'],
+                             verbose)
+
+
+class TestANCOMBCWorker(TestBase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(
+            os.environ, {_ancombc.WORKER_VARIABLE: '1',
+                         _ancombc.WORKER_TIMEOUT_VARIABLE: '60'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self._stop_worker)
+
+    def _stop_worker(self):
+        for worker in _ancombc._workers:
+            worker.close()
+        _ancombc._workers.clear()
+
+    def _slices(self, dataloaf):
+        return dict(dataloaf.data_slices.iter_views(pd.DataFrame))
+
+    def test_worker_matches_subprocess(self):
+        obs = [ancombc(table=self.table, metadata=self.md,
+                       formula='bodysite')
+               for _ in range(2)]
+        self.assertEqual(len(_ancombc._workers), 1)
+
+        with mock.patch.dict(os.environ, {_ancombc.WORKER_VARIABLE: ''}):
+            exp = self._slices(ancombc(table=self.table, metadata=self.md,
+                                       formula='bodysite'))
+        self.assertEqual(_ancombc._workers, [])
+        for dataloaf in obs:
+            obs_slices = self._slices(dataloaf)
+            self.assertEqual(obs_slices.keys(), exp.keys())
+            for name, slice in exp.items():
+                pd.testing.assert_frame_equal(obs_slices[name], slice)
+
+    def test_worker_error_and_crash_recovery(self):
+        ancombc(table=self.table, metadata=self.md, formula='bodysite')
+        worker, = _ancombc._workers
+        process = worker._process
+
+        # an error in R is reported, and the worker keeps serving requests
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            worker.run({'inp_abundances_path': 'missing.tsv'})
+        self.assertIn('missing.tsv', cm.exception.stderr)
+        self.assertIs(worker._process, process)
+
+        # a worker that died is replaced by the next request
+        process.kill()
+        process.wait()
+        ancombc(table=self.table, metadata=self.md, formula='bodysite')
+        self.assertIsNotNone(worker._process)
+        self.assertIsNot(worker._process, process)
+
+    @unittest.skipUnless(shutil.which(_ancombc.RWorker.command[0]),
+                         'requires R and run_ancombc.R')
+    def test_worker_run_once(self):
+        worker = _ancombc.RWorker()
+        self.addCleanup(worker.close)
+        request = {'inp_abundances_path': 'missing.mtx'}
+        with self.assertRaisesRegex(subprocess.CalledProcessError,
+                                    'returned non-zero') as cm:
+            worker.run(request)
+        self.assertEqual(cm.exception.stderr,
+                         'Input file path does not exist: missing.mtx')
+        process = worker._process
+        self.assertIsNone(process.poll())
+
+        # a worker that died while idle is detected, and replaced before
+        # the next request is sent
+        process.kill()
+        process.wait()
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            worker.run(request)
+        self.assertIsNotNone(cm.exception.stderr)
+        self.assertIsNot(worker._process, process)
+        self.assertIsNone(worker._process.poll())
+
+    def test_worker_idle_timeout(self):
+        with mock.patch.dict(os.environ,
+                             {_ancombc.WORKER_TIMEOUT_VARIABLE: '0.5'}):
+            ancombc(table=self.table, metadata=self.md, formula='bodysite')
+        worker, = _ancombc._workers
+        process = worker._process
+
+        # the worker exits once its stdin is closed
+        self.assertEqual(process.wait(timeout=60), 0)
+        self.assertIsNone(worker._process)
@@ -0,0 +1,95 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2016-2023, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import biom
+import numpy as np
+import numpy.testing as npt
+import scipy.sparse
+
+from q2_composition._cache import ResultCache, content_key, table_key
+
+
+class ResultCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_get_put(self):
+        cache = ResultCache(self.temp_dir.name, 2 ** 20)
+        self.assertIsNone(cache.get('a'))
+
+        cache.put('a', {'W': np.arange(3), 'group': np.array(['x', 'y'])})
+        obs = cache.get('a')
+        npt.assert_array_equal(obs['W'], [0, 1, 2])
+        npt.assert_array_equal(obs['group'], ['x', 'y'])
+        self.assertEqual(os.listdir(self.temp_dir.name), ['a.npz'])
+
+    def test_evicts_least_recently_used(self):
+        cache = ResultCache(self.temp_dir.name, 2 ** 20)
+        arrays = {'x': np.zeros(2 ** 15)}
+        for i, key in enumerate('abc'):
+            cache.put(key, arrays)
+            os.utime(os.path.join(self.temp_dir.name, key + '.npz'),
+                     (i, i))
+        # reading an entry makes it the most recently used
+        cache.get('a')
+
+        # each entry is a quarter of a megabyte (and a header), so only two
+        # fit
+        cache.max_bytes = 2 ** 19 + 2 ** 12
+        cache.put('d', arrays)
+        self.assertEqual(sorted(os.listdir(self.temp_dir.name)),
+                         ['a.npz', 'd.npz'])
+
+    def test_from_environment(self):
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertIsNone(ResultCache.from_environment())
+
+        cache_dir = os.path.join(self.temp_dir.name, 'cache')
+        with mock.patch.dict(os.environ,
+                             {'Q2_COMPOSITION_CACHE_DIR': cache_dir,
+                              'Q2_COMPOSITION_CACHE_SIZE': '0.5'}):
+            cache = ResultCache.from_environment()
+        self.assertTrue(os.path.isdir(cache_dir))
+        self.assertEqual(cache.max_bytes, 2 ** 19)
+
+
+class ContentKeyTests(unittest.TestCase):
+
+    def test_content_key(self):
+        self.assertEqual(content_key('a', 1, np.arange(3)),
+                         content_key('a', 1, np.arange(3)))
+        self.assertNotEqual(content_key('a', 1), content_key('a', 1.0))
+        self.assertNotEqual(content_key(('a', 'b')), content_key('a', 'b'))
+        self.assertNotEqual(content_key(np.arange(3)),
+                            content_key(np.arange(3.0)))
+
+    def test_table_key(self):
+        data = np.array([[0, 1, 3], [1, 1, 2]])
+        table = biom.Table(data, ['O1', 'O2'], ['S1', 'S2', 'S3'])
+        # the storage of the matrix doesn't matter, only its contents
+        same = biom.Table(scipy.sparse.csc_matrix(data.astype(float)),
+                          ['O1', 'O2'], ['S1', 'S2', 'S3'])
+        self.assertEqual(table_key(table), table_key(same))
+
+        renamed = biom.Table(data, ['O1', 'O2'], ['S1', 'S2', 'S4'])
+        self.assertNotEqual(table_key(table), table_key(renamed))
+        changed = biom.Table(data + 1, ['O1', 'O2'], ['S1', 'S2', 'S3'])
+        self.assertNotEqual(table_key(table), table_key(changed))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,9 +7,14 @@
 # ----------------------------------------------------------------------------
 
 import unittest
+import tracemalloc
+
+import h5py
 import numpy as np
-from q2_composition import add_pseudocount
-from biom import Table
+import scipy.sparse
+from q2_composition import (add_pseudocount, add_scaled_pseudocount,
+                            multiplicative_replacement)
+from biom import Table, load_table
 
 
 class TestAdd_Pseudocount(unittest.TestCase):
@@ -18,7 +23,7 @@ class TestAdd_Pseudocount(unittest.TestCase):
         t = Table(np.array([[0, 1, 3], [1, 1, 2]]),
                   ['O1', 'O2'],
                   ['S1', 'S2', 'S3'])
-        obs = add_pseudocount(t)
+        obs = load_table(str(add_pseudocount(t)))
         exp = Table(np.array([[1, 2, 4], [2, 2, 3]]),
                     ['O1', 'O2'],
                     ['S1', 'S2', 'S3'])
@@ -28,12 +33,151 @@ class TestAdd_Pseudocount(unittest.TestCase):
         t = Table(np.array([[0, 1, 3], [1, 1, 2]]),
                   ['O1', 'O2'],
                   ['S1', 'S2', 'S3'])
-        obs = add_pseudocount(t, 2)
+        obs = load_table(str(add_pseudocount(t, 2)))
         exp = Table(np.array([[2, 3, 5], [3, 3, 4]]),
                     ['O1', 'O2'],
                     ['S1', 'S2', 'S3'])
         self.assertEqual(obs, exp)
 
+    def test_add_pseudocount_fractional(self):
+        t = Table(np.array([[0, 1, 3], [1, 1, 2]]),
+                  ['O1', 'O2'],
+                  ['S1', 'S2', 'S3'])
+        obs = load_table(str(add_pseudocount(t, 0.5)))
+        exp = Table(np.array([[0.5, 1.5, 3.5], [1.5, 1.5, 2.5]]),
+                    ['O1', 'O2'],
+                    ['S1', 'S2', 'S3'])
+        self.assertEqual(obs, exp)
+
+    def test_add_pseudocount_float32(self):
+        t = Table(np.array([[0, 1, 3], [1, 1, 2]]),
+                  ['O1', 'O2'],
+                  ['S1', 'S2', 'S3'])
+        result = add_pseudocount(t, 0.5, dtype='float32')
+
+        with h5py.File(str(result), 'r') as fh:
+            self.assertEqual(fh['observation/matrix/data'].dtype, np.float32)
+            self.assertEqual(fh['sample/matrix/data'].dtype, np.float32)
+
+        obs = load_table(str(result))
+        exp = Table(np.array([[0.5, 1.5, 3.5], [1.5, 1.5, 2.5]]),
+                    ['O1', 'O2'],
+                    ['S1', 'S2', 'S3'])
+        self.assertEqual(obs, exp)
+
+    def test_add_pseudocount_sparse_input(self):
+        data = scipy.sparse.random(300, 40, density=0.1, format='csr',
+                                   random_state=0)
+        t = Table(data, ['O%d' % i for i in range(300)],
+                  ['S%d' % i for i in range(40)])
+        obs = load_table(str(add_pseudocount(t)))
+        exp = Table(data.toarray() + 1, t.ids(axis='observation'), t.ids())
+        self.assertEqual(obs, exp)
+
+    def test_add_pseudocount_block_size(self):
+        data = scipy.sparse.random(300, 40, density=0.1, format='csr',
+                                   random_state=0)
+        t = Table(data, ['O%d' % i for i in range(300)],
+                  ['S%d' % i for i in range(40)])
+        exp = data.toarray() + 1
+
+        for block_size in 1, 7, 40, 1000:
+            result = add_pseudocount(t, block_size=block_size)
+            obs = load_table(str(result))
+            self.assertEqual(obs, Table(exp, t.ids(axis='observation'),
+                                        t.ids()))
+
+            # the sample oriented (CSC) copy of the matrix is written
+            # independently, so confirm that it matches as well
+            with h5py.File(str(result), 'r') as fh:
+                grp = fh['sample/matrix']
+                csc = scipy.sparse.csc_matrix(
+                    (grp['data'][:], grp['indices'][:], grp['indptr'][:]),
+                    shape=(300, 40))
+            np.testing.assert_array_equal(csc.toarray(), exp)
+
+    def test_add_pseudocount_peak_memory(self):
+        data = scipy.sparse.random(2000, 500, density=0.05, format='csr',
+                                   random_state=0)
+        t = Table(data, ['O%d' % i for i in range(2000)],
+                  ['S%d' % i for i in range(500)])
+        dense_nbytes = 2000 * 500 * np.dtype(np.float64).itemsize
+
+        tracemalloc.start()
+        try:
+            add_pseudocount(t, block_size=100)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        # the result is streamed to disk, so peak memory is bounded by the
+        # sparse input plus a single dense block, rather than by the size of
+        # the (dense) output
+        self.assertLess(peak, 0.5 * dense_nbytes)
+
+
+class TestAddScaledPseudocount(unittest.TestCase):
+
+    def test_add_scaled_pseudocount(self):
+        t = Table(np.array([[0, 1, 3], [1, 1, 2]]),
+                  ['O1', 'O2'],
+                  ['S1', 'S2', 'S3'])
+        # sample depths are 1, 2 and 5, so the median depth is 2
+        obs = load_table(str(add_scaled_pseudocount(t, 2)))
+        exp = Table(np.array([[1, 3, 8], [2, 3, 7]]),
+                    ['O1', 'O2'],
+                    ['S1', 'S2', 'S3'])
+        self.assertEqual(obs, exp)
+
+    def test_add_scaled_pseudocount_empty_sample(self):
+        t = Table(np.array([[0, 1, 3], [0, 1, 2]]),
+                  ['O1', 'O2'],
+                  ['S1', 'S2', 'S3'])
+        with self.assertRaisesRegex(ValueError, 'Empty samples: S1'):
+            add_scaled_pseudocount(t)
+
+
+class TestMultiplicativeReplacement(unittest.TestCase):
+
+    def test_multiplicative_replacement(self):
+        t = Table(np.array([[0, 1, 3], [1, 1, 2], [3, 2, 0]]),
+                  ['O1', 'O2', 'O3'],
+                  ['S1', 'S2', 'S3'])
+        obs = load_table(str(multiplicative_replacement(t, delta=0.1)))
+        exp = np.array([[0.1, 0.25, 0.54],
+                        [0.225, 0.25, 0.36],
+                        [0.675, 0.5, 0.1]])
+        np.testing.assert_allclose(obs.matrix_data.toarray(), exp)
+        np.testing.assert_allclose(obs.sum(axis='sample'), 1)
+
+    def test_multiplicative_replacement_default_delta(self):
+        data = scipy.sparse.random(300, 40, density=0.1, format='csr',
+                                   random_state=0)
+        t = Table(data, ['O%d' % i for i in range(300)],
+                  ['S%d' % i for i in range(40)])
+        obs = load_table(str(multiplicative_replacement(t, block_size=7)))
+
+        dense = data.toarray()
+        delta = (1 / 300) ** 2
+        n_zeros = (dense == 0).sum(axis=0)
+        exp = np.where(dense == 0, delta,
+                       dense / dense.sum(axis=0) * (1 - delta * n_zeros))
+        np.testing.assert_allclose(obs.matrix_data.toarray(), exp)
+
+    def test_multiplicative_replacement_delta_too_large(self):
+        t = Table(np.array([[0, 1, 3], [1, 1, 2], [0, 2, 0]]),
+                  ['O1', 'O2', 'O3'],
+                  ['S1', 'S2', 'S3'])
+        with self.assertRaisesRegex(ValueError, '`delta` is too large'):
+            multiplicative_replacement(t, delta=0.5)
+
+    def test_multiplicative_replacement_empty_sample(self):
+        t = Table(np.array([[0, 1, 3], [0, 1, 2]]),
+                  ['O1', 'O2'],
+                  ['S1', 'S2', 'S3'])
+        with self.assertRaisesRegex(ValueError, 'Empty samples: S1'):
+            multiplicative_replacement(t)
+
 
 if __name__ == '__main__':
     unittest.main()
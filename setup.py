@@ -33,6 +33,7 @@ setup(
             'assets/ancom/css/*',
             'assets/ancom/js/*',
             'assets/ancom/licenses/*',
+            'assets/ancom_multiple/index.html',
             'assets/diff_abundance_plots/index.html',
         ],
         'q2_composition.tests': ['data/*'],